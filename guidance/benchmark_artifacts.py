@@ -0,0 +1,185 @@
+"""
+Compares the size and speed of the artifact encodings on page text.
+
+The text artifacts of the pipeline are written by the artifacts module of the AWSClientsLayer.
+This script compresses page text with gzip and zstd at several levels, one page and one
+document of --pages pages at a time like input_doc.txt and report.txt, and reports the
+compression ratio, the compression and decompression throughput and the size of the
+input_doc.txt files of a million pages. Without --files, synthetic pages resembling the Textract text of the sample
+mortgage documents are generated.
+
+    python benchmark_artifacts.py
+    python benchmark_artifacts.py --pages 20 --files result_files/customer123/*/*/pages_*.txt
+    python benchmark_artifacts.py --json
+
+zstd is only measured when compression.zstd (Python 3.14) or the zstandard package is installed.
+Throughput is measured on one core of the machine running the script; a Lambda function gets a
+full vCPU at 1769 MB of memory and a proportional share below it.
+"""
+import argparse
+import glob
+import gzip
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+GUIDANCE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(GUIDANCE_DIR, 'lambda', 'layers', 'aws_clients', 'python'))
+
+import artifacts  # noqa: E402
+
+GZIP_LEVELS = [1, 6, 9]
+ZSTD_LEVELS = [1, 3, 9, 19]
+PAGES_PER_MILLION = 1_000_000
+MAGIC_NUMBERS = {'gzip': b'\x1f\x8b', 'zstd': b'\x28\xb5\x2f\xfd'}
+
+
+def generate_pages(count: int, seed: int = 11) -> List[str]:
+    """Pages with the form lines, key values and tables Textract returns for loan applications and statements."""
+    rng = random.Random(seed)
+    names = ['John Doe', 'Maria Garcia', 'Wei Chen', 'Aisha Khan', 'Carlos Silva', 'Emma Miller']
+    labels = ['Borrower Name', 'Social Security Number', 'Date of Birth', 'Current Address', 'Employer Name',
+              'Position/Title', 'Gross Monthly Income', 'Loan Amount', 'Loan Purpose', 'Property Address',
+              'Account Number', 'Statement Period', 'Opening Balance', 'Closing Balance', 'Phone']
+    sentences = [
+        'I/We certify that the information provided in this application is true and correct as of the date set forth opposite my/our signature.',
+        'The Lender and its agents may verify or reverify any information contained in this application from any source named herein.',
+        'Any intentional or negligent misrepresentation of this information may result in civil liability and/or criminal penalties.',
+        'This statement reflects all transactions posted to your account during the statement period.',
+        'Please examine this statement promptly and report any discrepancies within 60 days.',
+    ]
+    merchants = ['PAYROLL DEPOSIT', 'ONLINE TRANSFER', 'GROCERY MART', 'CITY UTILITIES', 'MORTGAGE PAYMENT',
+                 'ATM WITHDRAWAL', 'CARD PURCHASE', 'INTEREST PAID']
+
+    pages = []
+    for number in range(count):
+        name = rng.choice(names)
+        lines = ["Uniform Residential Loan Application" if number % 2 == 0 else "Account Statement",
+                 f"Page {number % 6 + 1} of 6"]
+        for label in rng.sample(labels, 10):
+            value = rng.choice([name, f"{rng.randint(100, 999)}-{rng.randint(10, 99)}-{rng.randint(1000, 9999)}",
+                                f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/{rng.randint(1950, 2024)}",
+                                f"${rng.randint(1000, 900000):,}.{rng.randint(0, 99):02d}",
+                                f"{rng.randint(1, 9999)} {rng.choice(['Main Street', 'Oak Avenue', 'Pine Road'])}"])
+            lines.append(f"{label}: {value}")
+        lines += rng.sample(sentences, 2)
+        lines.append("Date Description Amount Balance")
+        balance = rng.randint(100, 20000)
+        for _ in range(rng.randint(15, 30)):
+            amount = rng.randint(-2500, 4000) + rng.randint(0, 99) / 100
+            balance += amount
+            lines.append(f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d} {rng.choice(merchants)} "
+                         f"{rng.randint(100000, 999999)} {amount:,.2f} {balance:,.2f}")
+        pages.append("\n".join(lines) + "\n")
+    return pages
+
+
+def codecs() -> List[Tuple[str, Callable[[bytes], bytes], Callable[[bytes], bytes]]]:
+    """Name, compress and decompress function of each encoding and level."""
+    result = [('identity', lambda data: data, lambda data: data)]
+    for level in GZIP_LEVELS:
+        result.append((f"gzip-{level}", lambda data, level=level: gzip.compress(data, compresslevel=level, mtime=0),
+                       lambda data: artifacts.decode(data, 'gzip')))
+    zstd = artifacts._zstd()
+    if zstd is not None:
+        for level in ZSTD_LEVELS:
+            result.append((f"zstd-{level}", lambda data, level=level: zstd.compress(data, level=level),
+                           lambda data: artifacts.decode(data, 'zstd')))
+    return result
+
+
+def measure(function: Callable[[bytes], bytes], items: List[bytes], repeat: int) -> Tuple[List[bytes], float]:
+    """Apply the function to every item, return the outputs and the best of repeat total durations."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [function(item) for item in items]
+        durations.append(time.perf_counter() - start)
+    return outputs, min(durations)
+
+
+def benchmark(pages: List[str], pages_per_document: int, repeat: int) -> Dict:
+    page_items = [page.encode('utf-8') for page in pages]
+    document_items = [b"".join(page_items[index:index + pages_per_document])
+                      for index in range(0, len(page_items), pages_per_document)]
+    total_bytes = sum(len(item) for item in page_items)
+
+    results = {}
+    for name, compress, decompress in codecs():
+        row = {}
+        for artifact, items in (('page', page_items), ('document', document_items)):
+            compressed, compress_seconds = measure(compress, items, repeat)
+            restored, decompress_seconds = measure(decompress, compressed, repeat)
+            if restored != items:
+                raise RuntimeError(f"{name} did not restore the {artifact} text")
+            compressed_bytes = sum(len(item) for item in compressed)
+            row[artifact] = {
+                'ratio': total_bytes / compressed_bytes,
+                'bytes_per_page': compressed_bytes / len(page_items),
+                'compress_mb_per_s': total_bytes / compress_seconds / 1e6,
+                'decompress_mb_per_s': total_bytes / decompress_seconds / 1e6,
+                'compress_ms_per_page': compress_seconds * 1000 / len(page_items),
+            }
+        # input_doc.txt of a million pages, the pages_*.txt parts are always stored uncompressed
+        row['gb_per_million_pages'] = row['document']['bytes_per_page'] * PAGES_PER_MILLION / 1e9
+        results[name] = row
+    return {
+        'pages': len(page_items),
+        'pages_per_document': pages_per_document,
+        'mean_page_bytes': total_bytes / len(page_items),
+        'median_page_bytes': statistics.median(len(item) for item in page_items),
+        'encodings': results
+    }
+
+
+def print_report(report: Dict) -> None:
+    print(f"{report['pages']} pages, mean {report['mean_page_bytes']:.0f} bytes, "
+          f"median {report['median_page_bytes']:.0f} bytes, {report['pages_per_document']} pages per document")
+    print(f"{'encoding':<10} {'artifact':<9} {'ratio':>6} {'B/page':>7} {'comp MB/s':>10} {'dec MB/s':>9} "
+          f"{'comp ms/page':>13} {'GB/1M pages':>12}")
+    for name, row in report['encodings'].items():
+        for artifact in ('page', 'document'):
+            stats = row[artifact]
+            storage = f"{row['gb_per_million_pages']:.3f}" if artifact == 'document' else ''
+            print(f"{name:<10} {artifact:<9} {stats['ratio']:6.2f} {stats['bytes_per_page']:7.0f} "
+                  f"{stats['compress_mb_per_s']:10.1f} {stats['decompress_mb_per_s']:9.1f} "
+                  f"{stats['compress_ms_per_page']:13.3f} {storage:>12}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Compare the artifact encodings on page text')
+    parser.add_argument('--files', nargs='*', help='page text files to use instead of synthetic pages')
+    parser.add_argument('--pages', type=int, default=10, help='pages per document artifact')
+    parser.add_argument('--count', type=int, default=500, help='synthetic pages to generate')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the fastest is reported')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    if args.files:
+        pages = []
+        for pattern in args.files:
+            for path in sorted(glob.glob(pattern)):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                # downloaded artifacts are still compressed, recognize them by their magic number
+                encoding = next((name for name, magic in MAGIC_NUMBERS.items() if data.startswith(magic)), None)
+                pages.append(artifacts.decode(data, encoding).decode('utf-8'))
+        if not pages:
+            parser.error('no files matched --files')
+    else:
+        pages = generate_pages(args.count)
+
+    report = benchmark(pages, args.pages, args.repeat)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
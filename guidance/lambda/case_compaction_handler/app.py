@@ -0,0 +1,284 @@
+import io
+import json
+import os
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from aws_clients import lazy_client
+import artifacts
+from instrumentation import emit_metric, handler_span, set_trace, span, timed
+
+OUTPUT_BUCKET_NAME = os.environ['OUTPUT_BUCKET_NAME']
+CASE_VALIDATION_TABLE_NAME = os.environ['CASE_VALIDATION_TABLE_NAME']
+ANALYTICS_PREFIX = os.environ.get('ANALYTICS_PREFIX', 'analytics/')
+EXTRACTED_FIELDS_PREFIX = f"{ANALYTICS_PREFIX}extracted_fields/"
+STATE_KEY = f"{ANALYTICS_PREFIX}_state/compaction.json"
+# Sparse index of the case validation table, the summaries by the hour of their last update
+UPDATED_INDEX_NAME = 'updated_hour-updated_at-index'
+UPDATED_HOUR_FORMAT = '%Y-%m-%dT%H'
+CASE_PROJECTION = 'case_id, documents, updated_at, case_status, cross_document_status'
+
+# Documents validated during the last minutes may still be written to the case summary
+# by a slower validation, they are left to the next run
+SETTLE_SECONDS = int(os.environ.get('COMPACTION_SETTLE_SECONDS', '300'))
+ROWS_PER_FILE = int(os.environ.get('COMPACTION_ROWS_PER_FILE', '100000'))
+MAX_WORKERS = 16
+
+# Columns of every row, followed by the extracted fields flattened into columns named field__<key>__<nested key>
+METADATA_COLUMNS = ['case_id', 'job_id', 'document_class', 'document_type', 'document_key', 'validation_status',
+                    'needs_manual_review', 'validated_at', 'case_status', 'cross_document_status', 'compacted_at']
+FIELD_PREFIX = 'field__'
+FIELD_SEPARATOR = '__'
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+s3 = lazy_client('s3')
+dynamodb = lazy_client('dynamodb')
+
+
+@timed('S3.GetObject')
+def load_state() -> Dict:
+    """Read the watermark of the last run, an empty state before the first run."""
+    try:
+        return json.loads(artifacts.get_text(OUTPUT_BUCKET_NAME, STATE_KEY))
+    except s3.exceptions.NoSuchKey:
+        return {}
+
+@timed('S3.PutObject')
+def save_state(state: Dict) -> None:
+    artifacts.put_text(OUTPUT_BUCKET_NAME, STATE_KEY, json.dumps(state, indent=2),
+                       content_type='application/json')
+
+def utc_now() -> datetime:
+    """The current time as the naive UTC datetime of the case summary timestamps."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+@timed('DynamoDB.Query')
+def query_updated_cases(since: str) -> List[Dict]:
+    """
+    Read the validation summaries of the cases updated after the watermark, one query of
+    the updated_hour index per hour from the hour of the watermark to the current hour.
+
+    The index holds a case under the hour of its latest update only, which can be after
+    the end of the window. The hours are read in order up to the current hour, checked
+    again after every query, so a case that moves to a later hour during the run is still
+    found there. select_documents keeps the documents of the window.
+
+    Args:
+        since: ISO timestamp of the watermark
+
+    Returns:
+        List[Dict]: case_id, status and documents of each updated case, at its latest update
+    """
+    from boto3.dynamodb.types import TypeDeserializer
+    deserializer = TypeDeserializer()
+    cases: Dict[str, Dict] = {}
+    paginator = dynamodb.get_paginator('query')
+    hour = datetime.strptime(since[:13], UPDATED_HOUR_FORMAT)
+    while hour.strftime(UPDATED_HOUR_FORMAT) <= utc_now().strftime(UPDATED_HOUR_FORMAT):
+        for page in paginator.paginate(
+                TableName=CASE_VALIDATION_TABLE_NAME,
+                IndexName=UPDATED_INDEX_NAME,
+                KeyConditionExpression='updated_hour = :hour AND updated_at > :since',
+                ExpressionAttributeValues={':hour': {'S': hour.strftime(UPDATED_HOUR_FORMAT)},
+                                           ':since': {'S': since}},
+                ProjectionExpression=CASE_PROJECTION):
+            for item in page.get('Items', []):
+                case = {k: deserializer.deserialize(v) for k, v in item.items()}
+                # a case read again after moving to a later hour
+                if case['case_id'] not in cases or cases[case['case_id']]['updated_at'] < case['updated_at']:
+                    cases[case['case_id']] = case
+        hour += timedelta(hours=1)
+    return list(cases.values())
+
+@timed('DynamoDB.Scan')
+def scan_cases() -> List[Dict]:
+    """
+    Read the validation summaries of every case, for the first run only. Summaries written
+    before the updated_hour index existed are not part of it until their next update.
+    """
+    from boto3.dynamodb.types import TypeDeserializer
+    deserializer = TypeDeserializer()
+    cases = []
+    for page in dynamodb.get_paginator('scan').paginate(TableName=CASE_VALIDATION_TABLE_NAME,
+                                                        ProjectionExpression=CASE_PROJECTION):
+        for item in page.get('Items', []):
+            cases.append({k: deserializer.deserialize(v) for k, v in item.items()})
+    return cases
+
+def select_documents(cases: List[Dict], since: str, until: str) -> List[Tuple[Dict, str, Dict]]:
+    """The (case, document key, document entry) of the documents validated in the window (since, until]."""
+    selected = []
+    for case in cases:
+        for document_key, entry in case.get('documents', {}).items():
+            if since < entry['timestamp'] <= until:
+                selected.append((case, document_key, entry))
+    return selected
+
+def parse_extracted_json(content: str) -> Optional[Dict]:
+    """Parse the JSON written by the flow Storage node, which may be surrounded by text."""
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        start, end = content.find('{'), content.rfind('}') + 1
+        if start == -1 or end == 0:
+            return None
+        return json.loads(content[start:end])
+
+def flatten_fields(fields: Dict, prefix: str = FIELD_PREFIX) -> Dict[str, Any]:
+    """Flatten nested objects into columns, lists are kept as JSON text."""
+    columns = {}
+    for key, value in fields.items():
+        column = f"{prefix}{key}"
+        if isinstance(value, dict):
+            columns.update(flatten_fields(value, f"{column}{FIELD_SEPARATOR}"))
+        elif isinstance(value, list):
+            columns[column] = json.dumps(value)
+        else:
+            columns[column] = value
+    return columns
+
+def build_row(case: Dict, document_key: str, entry: Dict, compacted_at: str) -> Optional[Dict]:
+    """Read the extracted JSON of a validated document and flatten it into a row."""
+    try:
+        fields = parse_extracted_json(artifacts.get_text(OUTPUT_BUCKET_NAME, document_key))
+    except Exception as e:
+        logger.warning(f"Skipping unreadable document", extra={
+            "case_id": case['case_id'],
+            "document_key": document_key,
+            "error": str(e)
+        })
+        return None
+    if not isinstance(fields, dict):
+        return None
+
+    # keys are <case_id>/<job_id>/<document class>/pages_<indexes>.json
+    parts = document_key.split('/')
+    return {
+        'case_id': case['case_id'],
+        'job_id': parts[-3] if len(parts) >= 3 else None,
+        'document_class': parts[-2] if len(parts) >= 2 else entry['document_type'],
+        'document_type': entry['document_type'],
+        'document_key': document_key,
+        'validation_status': entry['validation_status'],
+        'needs_manual_review': bool(entry['needs_manual_review']),
+        'validated_at': entry['timestamp'],
+        'case_status': case.get('case_status'),
+        'cross_document_status': case.get('cross_document_status'),
+        'compacted_at': compacted_at,
+        **flatten_fields(fields)
+    }
+
+def column_values(rows: List[Dict], column: str) -> List[Any]:
+    """
+    The values of a metadata column with one type. Integers become floats next to floats and
+    any other mix of types becomes text.
+    """
+    values = [row.get(column) for row in rows]
+    types = {type(value) for value in values if value is not None}
+    if len(types) <= 1 or types == {int, float}:
+        return [float(value) if value is not None and types == {int, float} else value for value in values]
+    return text_values(rows, column)
+
+def text_values(rows: List[Dict], column: str) -> List[Optional[str]]:
+    """
+    The values of a column as text. The extracted fields are always text, the flows do not
+    always return the same type and every file of the dataset must have the same schema.
+    """
+    return [None if value is None else value if isinstance(value, str) else json.dumps(value)
+            for value in (row.get(column) for row in rows)]
+
+def partition_rows(rows: List[Dict]) -> Dict[Tuple[str, str], List[Dict]]:
+    """Group the rows by document class and validation date."""
+    partitions: Dict[Tuple[str, str], List[Dict]] = {}
+    for row in rows:
+        partitions.setdefault((row['document_class'], row['validated_at'][:10]), []).append(row)
+    return partitions
+
+def partition_prefix(document_class: str, validated_date: str) -> str:
+    safe_class = re.sub(r'[^A-Za-z0-9_-]', '_', document_class)
+    return f"{EXTRACTED_FIELDS_PREFIX}document_class={safe_class}/validated_date={validated_date}/"
+
+def chunks(rows: List[Dict], size: int) -> Iterator[List[Dict]]:
+    for index in range(0, len(rows), size):
+        yield rows[index:index + size]
+
+@timed('S3.PutObject')
+def write_parquet(rows: List[Dict], key: str) -> None:
+    """Write the rows as one zstd compressed Parquet file, sorted by case for the column statistics."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rows = sorted(rows, key=lambda row: (row['case_id'], row['document_key']))
+    field_columns = sorted({column for row in rows for column in row if column.startswith(FIELD_PREFIX)})
+    table = pa.table({
+        **{column: column_values(rows, column) for column in METADATA_COLUMNS},
+        **{column: pa.array(text_values(rows, column), type=pa.string()) for column in field_columns}
+    })
+
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='zstd')
+    s3.put_object(Bucket=OUTPUT_BUCKET_NAME, Key=key, Body=buffer.getvalue(),
+                  ContentType='application/vnd.apache.parquet')
+
+def compact(since: str, until: str, compacted_at: str) -> Dict:
+    """
+    Write the documents validated in the window (since, until] to Parquet.
+
+    The file names are derived from the start of the window. A run that failed before
+    saving the watermark is repeated over a window with the same start, and overwrites
+    the files it wrote with files holding the same rows and the ones validated since.
+
+    Returns:
+        Dict: Numbers of cases, documents, rows and the keys of the written files
+    """
+    cases = query_updated_cases(since) if since else scan_cases()
+    documents = select_documents(cases, since, until)
+    set_trace(cases=len(cases))
+
+    with span('Compaction.ReadDocuments', documents=len(documents)):
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            rows = [row for row in executor.map(lambda document: build_row(*document, compacted_at), documents) if row]
+
+    run_name = re.sub(r'[^0-9T]', '', since) or 'initial'
+    files = []
+    for (document_class, validated_date), partition in sorted(partition_rows(rows).items()):
+        for number, chunk in enumerate(chunks(partition, ROWS_PER_FILE)):
+            key = f"{partition_prefix(document_class, validated_date)}part-{run_name}-{number:04d}.parquet"
+            write_parquet(chunk, key)
+            files.append(key)
+
+    return {'cases': len(cases), 'documents': len(documents), 'rows': len(rows), 'files': files}
+
+@handler_span('Compaction')
+def lambda_handler(event: Dict, context) -> Dict:
+    """
+    Lambda function handler run on a schedule. Compacts the extracted fields of the
+    documents validated since the previous run into Parquet files partitioned by
+    document class and validation date, then advances the watermark.
+
+    Args:
+        event (Dict): The schedule event, not used.
+        context: The Lambda context object.
+
+    Returns:
+        Dict: The compaction summary and the new watermark.
+    """
+    state = load_state()
+    since = state.get('watermark', '')
+    # the case summaries use naive UTC ISO timestamps, which compare like strings
+    now = utc_now()
+    until = (now - timedelta(seconds=SETTLE_SECONDS)).isoformat()
+    if until <= since:
+        return {'watermark': since, 'cases': 0, 'documents': 0, 'rows': 0, 'files': []}
+
+    logger.info(f"Compacting documents validated after '{since}' until '{until}'")
+    summary = compact(since, until, now.isoformat())
+    save_state({'watermark': until, 'previous_watermark': since, 'compacted_at': now.isoformat(),
+                'rows': summary['rows'], 'files': summary['files']})
+
+    emit_metric('CompactedDocuments', summary['rows'], unit='Count')
+    logger.info(f"Compacted {summary['rows']} documents of {summary['cases']} cases into {len(summary['files'])} files")
+    return {'watermark': until, **summary}
@@ -0,0 +1,155 @@
+import json
+import os
+import logging
+from typing import Dict, List, Optional
+from aws_clients import lazy_client
+import job_status
+from instrumentation import handler_span, set_trace, timed
+
+IDP_TEXTRACT_JOBS_TABLE_NAME = os.environ['IDP_TEXTRACT_JOBS_TABLE_NAME']
+CASE_PROGRESS_TABLE_NAME = os.environ.get('CASE_PROGRESS_TABLE_NAME')
+CASE_VALIDATION_TABLE_NAME = os.environ.get('CASE_VALIDATION_TABLE_NAME')
+
+# stage durations of a job, the attribute at which each stage starts and ends
+LATENCY_STAGES = [
+    ('textract', 'started_at', 'textract_completed_at'),
+    ('classification', 'textract_completed_at', 'classified_at'),
+    ('analysis', 'classified_at', 'analyzed_at'),
+    ('validation', 'analyzed_at', 'completed_at'),
+    ('end_to_end', 'started_at', 'completed_at'),
+]
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+dynamodb = lazy_client('dynamodb')
+
+
+@timed('DynamoDB.Query')
+def query_case_jobs(case_id: str) -> List[Dict]:
+    """The job items of a case from the case_number index, oldest first."""
+    jobs = []
+    paginator = dynamodb.get_paginator('query')
+    for page in paginator.paginate(
+            TableName=IDP_TEXTRACT_JOBS_TABLE_NAME,
+            IndexName=job_status.CASE_INDEX_NAME,
+            KeyConditionExpression='case_number = :case_id',
+            ExpressionAttributeValues={':case_id': {'S': case_id}}):
+        jobs += [job_status.from_dynamo(item) for item in page.get('Items', [])]
+    return jobs
+
+@timed('DynamoDB.GetItem')
+def get_case_item(table_name: Optional[str], case_id: str, projection: str) -> Dict:
+    """The projected attributes of the item of a case, empty when the table is not configured or has no item."""
+    if not table_name:
+        return {}
+    response = dynamodb.get_item(TableName=table_name, Key={'case_id': {'S': case_id}},
+                                 ProjectionExpression=projection)
+    return job_status.from_dynamo(response.get('Item', {}))
+
+def job_stage(job: Dict) -> str:
+    """TEXTRACT, ANALYSIS, VALIDATION or COMPLETED, from the job status and its documents."""
+    status = job.get('job_status', job_status.TEXTRACT)
+    if status != job_status.CLASSIFIED:
+        return status
+    documents = job.get('documents', {}).values()
+    if any('analyzed_at' not in document for document in documents):
+        return 'ANALYSIS'
+    return 'VALIDATION'
+
+def summarize_job(job: Dict) -> Dict:
+    """The stage, document counts and stage latencies in milliseconds of a job item."""
+    documents = job.get('documents', {})
+    analyzed_at = [document['analyzed_at'] for document in documents.values() if 'analyzed_at' in document]
+    # analysis ends with its last document
+    timestamps = {**job, 'analyzed_at': max(analyzed_at) if analyzed_at and len(analyzed_at) == len(documents) else None}
+    latency = {}
+    for stage, start, end in LATENCY_STAGES:
+        if timestamps.get(start) and timestamps.get(end):
+            latency[stage] = timestamps[end] - timestamps[start]
+    return {
+        'job_id': job['job_id'],
+        'object_key': job.get('object_key'),
+        'stage': job_stage(job),
+        'started_at': job.get('started_at'),
+        'completed_at': job.get('completed_at'),
+        'page_count': job.get('page_count'),
+        'document_count': job.get('document_count'),
+        'analyzed': len(analyzed_at),
+        'validated': sum(1 for document in documents.values() if document.get('validation') not in (None, 'NOT_VALIDATED')),
+        'failed': sum(1 for document in documents.values()
+                      if document.get('analysis') == 'FAILED' or document.get('validation') == 'NOT_VALIDATED'),
+        'latency_ms': latency,
+        'documents': documents
+    }
+
+def get_case_status(case_id: str) -> Optional[Dict]:
+    """
+    Answer "where is case X?" with key lookups only: a query of the case index of the jobs
+    table and a GetItem on the case progress and case validation tables.
+
+    Returns:
+        Optional[Dict]: The status, latency breakdown and jobs of the case, None for an unknown case
+    """
+    jobs = [summarize_job(job) for job in query_case_jobs(case_id)]
+    progress = get_case_item(CASE_PROGRESS_TABLE_NAME, case_id,
+                             'pending, completions, completed_at, jobs, documents, validated, failed')
+    validation = get_case_item(CASE_VALIDATION_TABLE_NAME, case_id,
+                               'case_status, needs_manual_review, cross_document_status, updated_at')
+    if not jobs and not progress and not validation:
+        return None
+
+    if progress:
+        completed = progress.get('pending') == 0 and bool(progress.get('completions'))
+    else:
+        completed = bool(jobs) and all(job['stage'] == job_status.COMPLETED for job in jobs)
+    # the slowest job of the case for each stage
+    latency = {}
+    for job in jobs:
+        for stage, milliseconds in job['latency_ms'].items():
+            latency[stage] = max(latency.get(stage, 0), milliseconds)
+    return {
+        'case_id': case_id,
+        'status': job_status.COMPLETED if completed else 'IN_PROGRESS',
+        'stages': {stage: sum(1 for job in jobs if job['stage'] == stage)
+                   for stage in sorted({job['stage'] for job in jobs})},
+        'pending': progress.get('pending'),
+        'completions': progress.get('completions', 0),
+        'completed_at': progress.get('completed_at'),
+        'pages': sum(job['page_count'] or 0 for job in jobs),
+        'documents': sum(job['document_count'] or 0 for job in jobs),
+        'validation_status': validation.get('case_status'),
+        'needs_manual_review': validation.get('needs_manual_review'),
+        'cross_document_status': validation.get('cross_document_status'),
+        'latency_ms': latency,
+        'jobs': jobs
+    }
+
+def response(status_code: int, body: Dict) -> Dict:
+    return {
+        'statusCode': status_code,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps(body, default=str)
+    }
+
+@handler_span('CaseStatus')
+def lambda_handler(event: Dict, context) -> Dict:
+    """
+    Lambda function handler of GET /cases/{case_id}, also invoked directly with {"case_id": "..."}.
+
+    Args:
+        event (Dict): The API Gateway proxy event or the direct invocation payload.
+        context: The Lambda context object.
+
+    Returns:
+        Dict: The API Gateway proxy response with the case status as JSON.
+    """
+    case_id = (event.get('pathParameters') or {}).get('case_id') or event.get('case_id')
+    if not case_id:
+        return response(400, {'message': 'case_id is required'})
+    set_trace(case_id=case_id)
+
+    status = get_case_status(case_id)
+    if status is None:
+        return response(404, {'message': f"Case {case_id} not found"})
+    logger.info(f"Case {case_id} is {status['status']}")
+    return response(200, status)
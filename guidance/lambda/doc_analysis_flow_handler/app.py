@@ -1,10 +1,15 @@
 import json
-import boto3
 from datetime import datetime
 import os
 import logging
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Union
 import traceback
+from aws_clients import lazy_client
+import artifacts
+import case_progress
+import claim_check
+import job_status
+from instrumentation import handler_span, set_trace, span, timed
 
 OUTPUT_BUCKET_NAME = os.environ['OUTPUT_BUCKET_NAME']
 QUEUE_URL = os.environ['QUEUE_URL']
@@ -12,9 +17,9 @@ VALIDATION_QUEUE_URL = os.environ['VALIDATION_QUEUE_URL']
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-s3 = boto3.client('s3')
-sqs = boto3.client('sqs')
-bedrock_agent = boto3.client('bedrock-agent-runtime')
+s3 = lazy_client('s3')
+sqs = lazy_client('sqs')
+bedrock_agent = lazy_client('bedrock-agent-runtime')
 
 def validate_sqs_event(sqs_event: Dict):
     """
@@ -42,8 +47,9 @@ def extract_previous_result(sqs_event: Dict) -> Dict:
         Dict: The previous result data.
     """
     body = sqs_event["Records"][0]["body"]
-    return json.loads(body)
+    return claim_check.loads(body)
 
+@timed('SQS.DeleteMessage')
 def delete_sqs_message(sqs_event: Dict):
     """
     Delete the SQS message from the queue.
@@ -54,6 +60,7 @@ def delete_sqs_message(sqs_event: Dict):
     receipt_handle = sqs_event["Records"][0]["receiptHandle"]
     sqs.delete_message(QueueUrl=QUEUE_URL, ReceiptHandle=receipt_handle)
 
+@timed('BedrockFlow.Analyze')
 def invoke_bedrock_flow(flow_id: str, flow_alias_id: str, document: Dict) -> Dict:
     """
     Invoke the Bedrock prompt flow.
@@ -105,6 +112,7 @@ def process_bedrock_result(result):
         outcome += result['flowCompletionEvent']['completionReason']
     return outcome
 
+@timed('S3.PutObject')
 def save_to_s3(content: str, bucket_name: str, file_key: str) -> Optional[str]:
     """
     Save a string content to an Amazon S3 bucket with a specified file key.
@@ -118,133 +126,46 @@ def save_to_s3(content: str, bucket_name: str, file_key: str) -> Optional[str]:
         Optional[str]: The file key if the operation is successful, None otherwise.
     """
     try:
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=file_key,
-            Body=content.encode('utf-8')
-        )
+        artifacts.put_text(bucket_name, file_key, content)
         logger.info(f"Successfully saved content to S3 bucket '{bucket_name}' with key '{file_key}'")
         return file_key
     except Exception as e:
         logger.error(f"Error saving content to S3: {e}")
         return None
 
-def find_json_files_in_directory(bucket: str, directory: str) -> List[str]:
+@timed('S3.HeadObject')
+def json_file_exists(bucket: str, key: str) -> bool:
     """
-    Find all JSON files in a given S3 directory and its subdirectories.
-    
+    Check whether the flow wrote the JSON file of a document.
+
+    The Storage node of the extraction flows writes the JSON to the JSON_s3key of the
+    manifest, flows without a Storage node write nothing to validate.
+
     Args:
         bucket: S3 bucket name
-        directory: Directory prefix to search in
-        
+        key: The JSON_s3key of the document
+
     Returns:
-        List[str]: List of JSON file keys found
+        bool: True if the JSON file exists
     """
-    json_files = []
     try:
-        logger.info(f"Starting S3 directory scan", extra={
-            "bucket": bucket,
-            "directory": directory,
-            "starting_path": f"s3://{bucket}/{directory}"
-        })
-
-        # Validate inputs
-        if not bucket or not directory:
-            logger.error("Invalid bucket or directory", extra={
-                "bucket": bucket,
-                "directory": directory
-            })
-            return []
-
-        # Try to list the directory first to verify access
-        try:
-            s3.head_bucket(Bucket=bucket)
-        except Exception as e:
-            logger.error("Error accessing bucket", extra={
-                "bucket": bucket,
-                "error": str(e),
-                "error_type": str(type(e).__name__)
-            })
-            return []
-
-        paginator = s3.get_paginator('list_objects_v2')
-        
-        # Debug: Print pagination parameters
-        logger.debug("Pagination parameters", extra={
-            "bucket": bucket,
-            "prefix": directory
-        })
-
-        try:
-            page_count = 0
-            total_objects = 0
-            
-            for page in paginator.paginate(Bucket=bucket, Prefix=directory):
-                page_count += 1
-                contents = page.get('Contents', [])
-                total_objects += len(contents)
-                
-                logger.debug("Processing S3 page", extra={
-                    "page_number": page_count,
-                    "objects_in_page": len(contents)
-                })
-                
-                for obj in contents:
-                    obj_key = obj['Key']
-                    
-                    # Debug: Print each object being checked
-                    logger.debug("Checking object", extra={
-                        "key": obj_key,
-                        "size": obj.get('Size', 0),
-                        "last_modified": str(obj.get('LastModified', ''))
-                    })
-                    
-                    if obj_key.endswith('.json'):
-                        logger.info(f"Found JSON file", extra={
-                            "json_file": obj_key,
-                            "directory": directory,
-                            "size": obj.get('Size', 0)
-                        })
-                        json_files.append(obj_key)
-
-            # Summary logging
-            logger.info(f"Completed directory scan", extra={
-                "directory": directory,
-                "files_found": len(json_files),
-                "total_pages": page_count,
-                "total_objects": total_objects,
-                "json_files": json_files
-            })
-
-        except Exception as e:
-            logger.error("Error during pagination", extra={
-                "error": str(e),
-                "error_type": str(type(e).__name__),
-                "bucket": bucket,
-                "directory": directory
-            })
-            logger.info(traceback.format_exc())
-            return []
-        
-        return json_files
-        
-    except Exception as e:
-        logger.error("Error scanning directory for JSON files", extra={
-            "error": str(e),
-            "error_type": str(type(e).__name__),
-            "bucket": bucket,
-            "directory": directory,
-            "traceback": traceback.format_exc()
-        })
-        return []
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except s3.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
 
-def process_document(document: Dict, case_id: str):
+def process_document(document: Dict, case_id: str, job_id: Optional[str] = None,
+                     job_started_at: Optional[int] = None):
     """
     Process a document by invoking the Bedrock prompt flow and saving the result to S3.
 
     Args:
         document (Dict): The document data.
         case_id (str): The case ID.
+        job_id (Optional[str]): The Textract job the document was classified from.
+        job_started_at (Optional[int]): Epoch milliseconds at which the Textract job was started.
     """
     try:
         flow_id = document["run_flow_id"]
@@ -274,59 +195,37 @@ def process_document(document: Dict, case_id: str):
                 "case_id": case_id,
                 "doc_key": document['doc_text_s3key']
             })
+            with span('CaseProgress.Advance'):
+                case_progress.advance(case_id, f"analyze:{document['doc_text_s3key']}", -1, failed=1)
+            record_analysis(job_id, document, 'FAILED')
             return
 
-        # Get the case directory (two levels up from the document directory)
-        # Split the path and rebuild it to ensure proper formatting
-        path_parts = directory.split('/')
-        if len(path_parts) >= 2:
-            case_directory = '/'.join(path_parts[:-2]) if path_parts[:-2] else ''
-        else:
-            case_directory = ''
-        
-        logger.info(f"Scanning for JSON files", extra={
-            "case_id": case_id,
-            "case_directory": case_directory,
-            "document_directory": directory,
-            "path_parts": path_parts,
-            "full_path": f"s3://{OUTPUT_BUCKET_NAME}/{case_directory}"
-        })
-
-        # Find all JSON files in the case directory and its subdirectories
-        json_files = find_json_files_in_directory(OUTPUT_BUCKET_NAME, case_directory)
-        
-        if not json_files:
-            logger.warning(f"No JSON files found", extra={
+        # Only the JSON of this document is validated, the other documents of the case
+        # are validated by their own analysis
+        json_key = document.get('JSON_s3key')
+        json_keys = [json_key] if json_key and json_file_exists(OUTPUT_BUCKET_NAME, json_key) else []
+        if not json_keys:
+            logger.info(f"No JSON file to validate", extra={
                 "case_id": case_id,
-                "case_directory": case_directory,
-                "document_directory": directory
+                "json_key": json_key
             })
-            return
 
-        logger.info(f"Found JSON files to process", extra={
-            "case_id": case_id,
-            "num_files": len(json_files),
-            "files": json_files
-        })
+        # A large outcome is stored in S3 once and the validation message carries a pointer to it
+        with span('ClaimCheck.Offload'):
+            processed_data = claim_check.offload(outcome, OUTPUT_BUCKET_NAME)
 
-        # Process each JSON file found
-        for json_key in json_files:
-            try:
-                logger.info(f"Sending validation message for JSON file", extra={
-                    "case_id": case_id,
-                    "json_key": json_key
-                })
-                
-                send_validation_message(case_id, document, outcome, json_key)
-                
-            except Exception as e:
-                logger.error(f"Error processing JSON file", extra={
-                    "error": str(e),
-                    "error_type": str(type(e).__name__),
-                    "case_id": case_id,
-                    "json_key": json_key
-                })
-                continue
+        # The analysis of the document hands one unit of pending case work to each validation,
+        # registered before the messages are sent so a fast validation cannot complete the case early
+        with span('CaseProgress.Advance'):
+            case_progress.advance(case_id, f"analyze:{document['doc_text_s3key']}", len(json_keys) - 1)
+        record_analysis(job_id, document, 'ANALYZED' if json_keys else 'NO_JSON')
+
+        for json_key in json_keys:
+            if not send_validation_message(case_id, document, processed_data, json_key, job_id, job_started_at):
+                # the validation will never run, its unit is finished here
+                with span('CaseProgress.Advance'):
+                    case_progress.advance(case_id, f"validate:{json_key}", -1, failed=1)
+                record_analysis(job_id, document, 'FAILED')
 
     except Exception as e:
         # Log the full traceback at debug level for troubleshooting
@@ -345,15 +244,42 @@ def process_document(document: Dict, case_id: str):
         # Re-raise the exception to be handled by the caller
         raise
 
-def send_validation_message(case_id: str, document: Dict, outcome: str, json_key: str):
+@timed('DynamoDB.UpdateItem')
+def record_analysis(job_id: Optional[str], document: Dict, analysis: str):
+    """
+    Record the analysis status of a document in the item of its Textract job.
+
+    Args:
+        job_id: The Textract job the document was classified from
+        document: The document data
+        analysis: ANALYZED, NO_JSON when there is no JSON to validate, or FAILED
+    """
+    try:
+        job_status.record_document(job_id, document.get('doc_text_s3key', ''),
+                                   analysis=analysis, analyzed_at=job_status.now_ms())
+    except Exception as e:
+        logger.error(f"Error recording the analysis status", extra={
+            "error": str(e),
+            "job_id": job_id,
+            "doc_key": document.get('doc_text_s3key')
+        })
+
+@timed('SQS.SendMessage')
+def send_validation_message(case_id: str, document: Dict, outcome: Union[str, Dict], json_key: str,
+                            job_id: Optional[str] = None, job_started_at: Optional[int] = None):
     """
     Send a validation message for a specific JSON file.
     
     Args:
         case_id: The case ID
         document: The document data
-        outcome: The processed outcome
+        outcome: The processed outcome, or a claim check pointer to it
         json_key: The S3 key of the JSON file to validate
+        job_id: The Textract job the document was classified from
+        job_started_at: Epoch milliseconds at which the Textract job was started
+
+    Returns:
+        bool: True if the message was sent
     """
     try:
         validation_message = {
@@ -366,6 +292,10 @@ def send_validation_message(case_id: str, document: Dict, outcome: str, json_key
                 'related_txt': document['doc_text_s3key']
             }
         }
+        # the start time of the job travels to the validation, which reports the end-to-end latency
+        if job_id:
+            validation_message['job_id'] = job_id
+            validation_message['job_started_at'] = job_started_at
         
         logger.info(f"Sending validation message", extra={
             "case_id": case_id,
@@ -382,6 +312,7 @@ def send_validation_message(case_id: str, document: Dict, outcome: str, json_key
             "json_key": json_key,
             "message_id": response.get('MessageId')
         })
+        return True
         
     except Exception as e:
         logger.error(f"Error sending validation message", extra={
@@ -390,7 +321,9 @@ def send_validation_message(case_id: str, document: Dict, outcome: str, json_key
             "json_key": json_key
         })
         logger.info(traceback.format_exc())
+        return False
 
+@handler_span('Analysis')
 def lambda_handler(sqs_event: Dict, context) -> bool:
     """
     Lambda function handler for processing SQS events.
@@ -403,12 +336,16 @@ def lambda_handler(sqs_event: Dict, context) -> bool:
         bool: True if the function executed successfully, False otherwise.
     """
     logger.info(f"Processing event", extra={"event": json.dumps(sqs_event)})
+    claim_check.clear_cache()
     
     try:
         validate_sqs_event(sqs_event)
         previous_result = extract_previous_result(sqs_event)
         case_id = previous_result["case_id"]
         document_manifest = previous_result["documents"]
+        job_id = previous_result.get("job_id")
+        job_started_at = previous_result.get("job_started_at")
+        set_trace(case_id=case_id, job_id=job_id)
 
         logger.info(f"Processing documents", extra={
             "case_id": case_id,
@@ -418,14 +355,21 @@ def lambda_handler(sqs_event: Dict, context) -> bool:
         processed_count = 0
         for document in document_manifest:
             try:
-                process_document(document, case_id)
+                process_document(document, case_id, job_id, job_started_at)
                 processed_count += 1
+            except case_progress.CaseProgressError:
+                # the message is retried to send the CaseCompleted event, the recorded units are not counted again
+                raise
             except Exception as e:
                 logger.error(f"Error processing individual document", extra={
                     "error": str(e),
                     "case_id": case_id,
                     "doc_key": document.get('doc_text_s3key')
                 })
+                # The message is not retried, the document is finished as failed so the case can complete
+                with span('CaseProgress.Advance'):
+                    case_progress.advance(case_id, f"analyze:{document.get('doc_text_s3key')}", -1, failed=1)
+                record_analysis(job_id, document, 'FAILED')
                 # Continue processing other documents even if one fails
                 continue
 
@@ -438,6 +382,8 @@ def lambda_handler(sqs_event: Dict, context) -> bool:
         delete_sqs_message(sqs_event)
         return True
         
+    except case_progress.CaseProgressError:
+        raise
     except Exception as e:
         logger.error(f"Error processing SQS event", extra={
             "error": str(e)
@@ -2,22 +2,33 @@ import json
 import os
 import re
 from datetime import datetime
-from textractor.entities.lazy_document import LazyDocument
-from textractor.data.constants import TextractAPI
-import boto3
 import json
 from io import BytesIO
 from botocore.exceptions import ClientError
 from urllib.parse import urlparse
 import logging
-from typing import List, Dict, Any, Tuple, Optional
+from typing import List, Dict, Any, Tuple, Optional, TYPE_CHECKING
 import traceback
-
-s3 = boto3.client('s3')
-sqs = boto3.client('sqs')
-textract = boto3.client('textract')
-bedrock_agent_runtime = boto3.client('bedrock-agent-runtime')
-dynamodb = boto3.client('dynamodb')
+from concurrent.futures import ThreadPoolExecutor
+from aws_clients import lazy_client
+import artifacts
+import case_progress
+import claim_check
+import job_status
+from instrumentation import emit_metric, get_trace, handler_span, set_trace, span, timed
+
+# textractor (~0.4s) and numpy (~0.15s) are imported where they are first used, so they are not part of the
+# module import on a cold start. numpy is only needed when an embedding gallery is configured.
+if TYPE_CHECKING:
+	from textractor.entities.lazy_document import LazyDocument
+	from embedding_gallery import EmbeddingGallery
+
+s3 = lazy_client('s3')
+sqs = lazy_client('sqs')
+textract = lazy_client('textract')
+bedrock_agent_runtime = lazy_client('bedrock-agent-runtime')
+dynamodb = lazy_client('dynamodb')
+bedrock_runtime = lazy_client('bedrock-runtime')
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -32,7 +43,24 @@ IDP_TEXTRACT_JOBS_TABLE_NAME = os.environ['IDP_TEXTRACT_JOBS_TABLE_NAME']
 IN_QUEUE_URL = os.environ['IN_QUEUE_URL']
 OUT_QUEUE_URL = os.environ['OUT_QUEUE_URL']
 IDP_FLOW_CLASS_TABLE_NAME = os.environ['IDP_FLOW_CLASS_TABLE_NAME']
-
+# Input token budget of a single classification flow call, larger documents are classified in page chunks
+CLASSIFY_MAX_INPUT_TOKENS = int(os.environ.get('CLASSIFY_MAX_INPUT_TOKENS', '150000'))
+# Optional gallery of labelled page embeddings (s3://bucket/prefix, without the file suffixes). Pages it matches
+# with high confidence are classified without the prompt flow, only the ambiguous pages are sent to the flow.
+EMBEDDING_GALLERY_S3_URI = os.environ.get('EMBEDDING_GALLERY_S3_URI', '')
+EMBEDDING_MODEL_ID = os.environ.get('EMBEDDING_MODEL_ID', 'amazon.titan-embed-text-v2:0')
+EMBEDDING_TOP_K = int(os.environ.get('EMBEDDING_TOP_K', '5'))
+EMBEDDING_MIN_SIMILARITY = float(os.environ.get('EMBEDDING_MIN_SIMILARITY', '0.85'))
+EMBEDDING_MIN_MARGIN = float(os.environ.get('EMBEDDING_MIN_MARGIN', '0.05'))
+# Titan text embeddings accept up to 50,000 characters
+EMBEDDING_MAX_CHARS = 40000
+EMBEDDING_WORKERS = 8
+GALLERY_LOCAL_PREFIX = "/tmp/embedding_gallery"
+
+# Loaded on first use and kept for the lifetime of the execution environment
+_gallery = None
+
+@handler_span('Classification')
 def lambda_handler(sqs_event: dict, context: Any) -> dict:
 	"""
 	AWS Lambda handler function to process SQS events containing Textract job results.
@@ -45,17 +73,26 @@ def lambda_handler(sqs_event: dict, context: Any) -> dict:
 		dict: A response containing processed document information.
 	"""
 	logger.info(f"Processing event: {json.dumps(sqs_event)}")
+	claim_check.clear_cache()
 	
 	# 1. Validate and get inputs
 	validate_sqs_event(sqs_event)
 	event = extract_sns_message(sqs_event) # from sqs event
 	validate_textract_job(event) 
 	job_id, doc_bucket, doc_key = extract_job_details(event) # from event payload
+	set_trace(job_id=job_id)
 	
 	# 2. Get the document content as plain text and source file informaiton
-	lazy_doc = load_textract_job(job_id)
-	text_content = generate_text_content(lazy_doc)
+	with span('Textract.GetDocumentAnalysis') as textract_span:
+		lazy_doc = load_textract_job(job_id)
+		page_blocks = generate_page_blocks(lazy_doc)
+		textract_span['pages'] = len(page_blocks)
+	text_content = wrap_page_blocks(page_blocks)
 	job_details = get_job_details(job_id) # from dynamodb
+	set_trace(case_id=job_details["lender_case_id"])
+	# the notification carries the completion time of the job
+	if job_details["started_at"] and event.get('Timestamp'):
+		emit_metric('TextractJobDuration', int(event['Timestamp']) - job_details["started_at"])
 	
 	# 3. Generate S3 file keys
 	output_path, raw_document_text_file, manifest_document_file = generate_output_paths(job_details, job_id)
@@ -63,22 +100,37 @@ def lambda_handler(sqs_event: dict, context: Any) -> dict:
 	# 4. Save the raw text for further processing later
 	save_to_s3(text_content, OUTPUT_BUCKET_NAME, raw_document_text_file)
 	
-	# 5. Get the supported classes and invoke the prompt flow
+	# 5. Get the supported classes, classify the pages the embedding gallery is confident about and invoke
+	#    the prompt flow for the others, in page chunks if they exceed the token budget
 	supported_class_list = get_supported_class_list_from_dynamodb()
-	classification_result = invoke_classification_flow(text_content, supported_class_list)
-
-	# 6. Save and parse result
+	page_classes = preclassify_pages(page_blocks, supported_class_list)
+	ambiguous_blocks = [block for index, block in enumerate(page_blocks) if index not in page_classes]
+	classification_result, flow_manifest = classify_document(ambiguous_blocks, supported_class_list)
+	doc_manifest = merge_preclassified_pages(page_classes, flow_manifest)
+	if page_classes:
+		classification_result += f"\n\n<gallery-classification>\n{json.dumps(page_classes)}</gallery-classification>"
+
+	# 6. Save result
 	save_to_s3(classification_result, OUTPUT_BUCKET_NAME, manifest_document_file)
-	json_response = get_text_in_tag(classification_result, 'json') # expect json to be inside a <json></json> tag in the result string
-	doc_manifest = json.loads(json_response)
 
 	# 7. save individual text files and format a message for the next step
 	response_doc_list = save_document_parts(doc_manifest, lazy_doc, output_path, supported_class_list)
 	final_response = {
 		"case_id": job_details["lender_case_id"],
+		"job_id": job_id,
+		"job_started_at": job_details["started_at"],
 		"documents": response_doc_list
 	}
-	send_to_sqs(json.dumps(final_response))
+	# the documents of the job are tracked in its item before the analysis can record them
+	record_classification(job_id, event.get('Timestamp'), len(page_blocks), response_doc_list)
+	# the job hands one unit of pending case work to the analysis of each document
+	with span('CaseProgress.Advance'):
+		case_progress.advance(job_details["lender_case_id"], f"classify:{job_id}", len(response_doc_list) - 1,
+			documents=len(response_doc_list))
+	# a large manifest is stored in S3 and the message only carries a pointer to it
+	with span('ClaimCheck.Offload'):
+		message = claim_check.dumps(final_response, OUTPUT_BUCKET_NAME)
+	send_to_sqs(message)
 
 	# 9. finally delete the processed queue item
 	delete_sqs_message(sqs_event)
@@ -86,7 +138,8 @@ def lambda_handler(sqs_event: dict, context: Any) -> dict:
 
 
 
-def save_to_s3(content: str, bucket_name: str, file_key: str) -> Optional[str]:
+@timed('S3.PutObject')
+def save_to_s3(content: str, bucket_name: str, file_key: str, encoding: Optional[str] = None) -> Optional[str]:
 	"""
 	Save a string content to an Amazon S3 bucket with a specified file key.
 
@@ -94,16 +147,13 @@ def save_to_s3(content: str, bucket_name: str, file_key: str) -> Optional[str]:
 		content (str): The content to be saved.
 		bucket_name (str): The name of the S3 bucket.
 		file_key (str): The file key (path) for the object in S3.
+		encoding (Optional[str]): gzip, zstd or identity, ARTIFACT_ENCODING when not given.
 
 	Returns:
 		Optional[str]: The file key if the operation is successful, None otherwise.
 	"""
 	try:
-		s3.put_object(
-			Bucket=bucket_name,
-			Key=file_key,
-			Body=content.encode('utf-8')
-		)
+		artifacts.put_text(bucket_name, file_key, content, encoding)
 		logger.info(f"Successfully saved content to S3 bucket '{bucket_name}' with key '{file_key}'")
 		return file_key
 	except Exception as e:
@@ -135,27 +185,192 @@ def extract_job_details(event: dict) -> Tuple[str, str, str]:
 	doc_key = event['DocumentLocation']['S3ObjectName']
 	return job_id, doc_bucket, doc_key
 
-def load_textract_job(job_id: str) -> LazyDocument:
+def load_textract_job(job_id: str) -> 'LazyDocument':
 	"""Load the completed Textract OCR job."""
-	return LazyDocument(job_id=job_id, api=TextractAPI.ANALYZE)
+	from textractor.entities.lazy_document import LazyDocument
+	from textractor.data.constants import TextractAPI
+	return LazyDocument(job_id=job_id, api=TextractAPI.ANALYZE, textract_client=textract)
+
+def generate_page_blocks(lazy_doc: 'LazyDocument') -> List[str]:
+	"""Generate the text of each page of the Textract job results wrapped in xml tags"""
+	return [
+		f"<page>\n<page-index>{page.page_num - 1}</page-index>\n<page-content>\n{page.get_text()}</page-content>\n</page>\n\n"
+		for page in lazy_doc.pages
+	]
+
+def wrap_page_blocks(page_blocks: List[str]) -> str:
+	"""Wrap page blocks into the document text expected by the classification prompt"""
+	return "<document-pages>\n" + "".join(page_blocks) + "</document-pages>"
+
+def estimate_tokens(text: str) -> int:
+	"""Rough token estimate, about 4 characters per token for English text."""
+	return len(text) // 4
+
+def plan_classification_chunks(page_blocks: List[str], classes_str: str, max_input_tokens: int = CLASSIFY_MAX_INPUT_TOKENS) -> List[List[str]]:
+	"""
+	Group the pages in document order into chunks whose classification prompt fits the token budget.
+
+	Pages are never split, a single page larger than the budget gets a chunk of its own.
+	"""
+	budget = max_input_tokens - estimate_tokens(classes_str) - estimate_tokens(wrap_page_blocks([]))
+	chunks, current, current_tokens = [], [], 0
+	for block in page_blocks:
+		block_tokens = estimate_tokens(block)
+		if current and current_tokens + block_tokens > budget:
+			chunks.append(current)
+			current, current_tokens = [], 0
+		current.append(block)
+		current_tokens += block_tokens
+	if current:
+		chunks.append(current)
+	return chunks
+
+def merge_document_manifests(manifests: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+	"""
+	Merge the manifests of consecutive page chunks.
+
+	The page indexes are global, so a document split by a chunk boundary shows up
+	as the last group of one chunk and the first group of the next with the same
+	class and consecutive pages. Those two groups are joined back.
+	"""
+	merged = []
+	for manifest in manifests:
+		for position, doc_class in enumerate(manifest):
+			previous = merged[-1] if merged else None
+			if position == 0 and previous and previous['class'] == doc_class['class'] \
+					and previous['page-indexes'] and doc_class['page-indexes'] \
+					and previous['page-indexes'][-1] + 1 == doc_class['page-indexes'][0]:
+				previous['page-indexes'] = previous['page-indexes'] + doc_class['page-indexes']
+			else:
+				merged.append(dict(doc_class))
+	return merged
+
+def classify_document(page_blocks: List[str], supported_class_list: List[dict]) -> Tuple[str, List[Dict[str, Any]]]:
+	"""
+	Classify the document pages, with one classification flow call per chunk of pages that fits the token budget.
 
-def generate_text_content(lazy_doc: LazyDocument) -> str:
-	"""Generate text content from the Textract job results and wrap each page in xml tags"""
-	text_content = "<document-pages>\n"
-	for page in lazy_doc.pages:
-		text_content += f"<page>\n<page-index>{page.page_num - 1}</page-index>\n<page-content>\n{page.get_text()}</page-content>\n</page>\n\n"
-	text_content += "</document-pages>"
-	return text_content
+	Returns:
+		Tuple[str, List[Dict[str, Any]]]: The raw flow responses and the merged document manifest.
+	"""
+	chunks = plan_classification_chunks(page_blocks, format_class_list(supported_class_list))
+	logger.info(f"Classifying {len(page_blocks)} pages in {len(chunks)} chunk(s)")
+
+	responses, manifests = [], []
+	for chunk in chunks:
+		classification_result = invoke_classification_flow(wrap_page_blocks(chunk), supported_class_list)
+		responses.append(classification_result)
+		json_response = get_text_in_tag(classification_result, 'json') # expect json to be inside a <json></json> tag in the result string
+		manifests.append(json.loads(json_response))
+	return "\n\n".join(responses), merge_document_manifests(manifests)
+
+def load_embedding_gallery() -> Optional['EmbeddingGallery']:
+	"""Download the embedding gallery to /tmp once and open it memory-mapped, None if no gallery is configured."""
+	global _gallery
+	if _gallery is None and EMBEDDING_GALLERY_S3_URI:
+		from embedding_gallery import EmbeddingGallery, MATRIX_SUFFIX, LABELS_SUFFIX
+		location = urlparse(EMBEDDING_GALLERY_S3_URI)
+		with span('S3.DownloadGallery'):
+			for suffix in (MATRIX_SUFFIX, LABELS_SUFFIX):
+				s3.download_file(location.netloc, location.path.lstrip('/') + suffix, GALLERY_LOCAL_PREFIX + suffix)
+		_gallery = EmbeddingGallery.load(GALLERY_LOCAL_PREFIX)
+		logger.info(f"Loaded embedding gallery with {len(_gallery)} pages")
+	return _gallery
+
+@timed('Bedrock.InvokeModel')
+def get_text_embedding(text: str) -> List[float]:
+	"""Get the Titan text embedding of a page."""
+	response = bedrock_runtime.invoke_model(
+		modelId=EMBEDDING_MODEL_ID,
+		body=json.dumps({"inputText": text[:EMBEDDING_MAX_CHARS] or " "}),
+		accept="application/json",
+		contentType="application/json"
+	)
+	return json.loads(response['body'].read())['embedding']
+
+def preclassify_pages(page_blocks: List[str], supported_class_list: List[dict]) -> Dict[int, str]:
+	"""
+	Classify the pages that closely match a known page of the embedding gallery.
+
+	Returns:
+		Dict[int, str]: The class name by page index of the confidently matched pages, empty without a gallery.
+	"""
+	gallery = load_embedding_gallery()
+	if gallery is None or not page_blocks:
+		return {}
+
+	import numpy as np
+	page_texts = [get_text_in_tag(block, 'page-content') or "" for block in page_blocks]
+	with ThreadPoolExecutor(max_workers=EMBEDDING_WORKERS) as executor:
+		# the worker threads do not share the context of the invocation, the trace is passed along
+		trace = get_trace()
+		def embed(text: str) -> List[float]:
+			set_trace(**trace)
+			return get_text_embedding(text)
+		embeddings = np.array(list(executor.map(embed, page_texts)), dtype=np.float32)
+
+	supported_classes = {item["class_name"] for item in supported_class_list}
+	page_classes = {}
+	for index, (class_name, similarity) in enumerate(gallery.classify(embeddings, EMBEDDING_TOP_K, EMBEDDING_MIN_SIMILARITY, EMBEDDING_MIN_MARGIN)):
+		if class_name in supported_classes:
+			page_classes[index] = class_name
+	logger.info(f"Embedding gallery classified {len(page_classes)} of {len(page_blocks)} pages")
+	return page_classes
+
+def merge_preclassified_pages(page_classes: Dict[int, str], flow_manifest: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+	"""
+	Combine the gallery page classes with the manifest the prompt flow returned for the remaining pages.
 
+	Consecutive gallery pages of the same class form one document, and a gallery
+	document directly next to a flow document of the same class is joined with it,
+	as the flow only saw part of that document. Flow documents are never joined
+	with each other, the flow decided where they split.
+	"""
+	documents = []
+	for index in sorted(page_classes):
+		previous = documents[-1] if documents else None
+		if previous and previous['class'] == page_classes[index] and previous['page-indexes'][-1] + 1 == index:
+			previous['page-indexes'].append(index)
+		else:
+			documents.append({'class': page_classes[index], 'page-indexes': [index], 'gallery': True})
+	documents += [dict(doc_class) for doc_class in flow_manifest]
+	documents.sort(key=lambda doc_class: doc_class['page-indexes'][0] if doc_class['page-indexes'] else float('inf'))
+
+	merged = []
+	for doc_class in documents:
+		previous = merged[-1] if merged else None
+		if previous and (previous.get('gallery') or doc_class.get('gallery')) \
+				and previous['class'] == doc_class['class'] \
+				and previous['page-indexes'] and doc_class['page-indexes'] \
+				and previous['page-indexes'][-1] + 1 == doc_class['page-indexes'][0]:
+			previous['page-indexes'] = previous['page-indexes'] + doc_class['page-indexes']
+			previous['gallery'] = previous.get('gallery') and doc_class.get('gallery')
+		else:
+			merged.append(doc_class)
+	for doc_class in merged:
+		doc_class.pop('gallery', None)
+	return merged
+
+@timed('DynamoDB.GetItem')
 def get_job_details(job_id: str) -> dict:
 	"""Retrieve job details from DynamoDB."""
 	job_details = dynamodb.get_item(TableName=IDP_TEXTRACT_JOBS_TABLE_NAME, Key={'job_id': {'S': job_id}})
 	return {
 		'lender_case_id': job_details['Item']['case_number']['S'],
 		'source_pdf_bucket': job_details['Item']['bucket_name']['S'],
-		'source_pdf_key': job_details['Item']['object_key']['S']
+		'source_pdf_key': job_details['Item']['object_key']['S'],
+		'started_at': int(job_details['Item']['started_at']['N']) if 'started_at' in job_details['Item'] else None
 	}
 
+@timed('DynamoDB.UpdateItem')
+def record_classification(job_id: str, textract_completed_at: Optional[int], page_count: int, documents: List[Dict[str, Any]]) -> None:
+	"""Record the page count and the classified documents in the item of the job."""
+	try:
+		job_status.record_classification(job_id, int(textract_completed_at) if textract_completed_at else None,
+			page_count, [document['doc_text_s3key'] for document in documents])
+	except Exception as e:
+		# the status of the job is informational, the documents are analyzed regardless
+		logger.error(f"Error recording the classification of job {job_id}: {e}")
+
 def generate_output_paths(job_details: dict, job_id: str) -> Tuple[str, str, str]:
 	"""Generate output file paths for resulting artifacts."""
 	output_path = f"{job_details['lender_case_id']}/{job_id}"
@@ -168,11 +383,13 @@ def parse_classification_response(response: str) -> List[dict]:
 	json_response = get_text_in_tag(response, 'json')
 	return json.loads(json_response)
 
+@timed('SQS.DeleteMessage')
 def delete_sqs_message(sqs_event: dict) -> None:
 	"""Delete the processed message from the SQS queue."""
 	receipt_handle = sqs_event['Records'][0]['receiptHandle']
 	sqs.delete_message(QueueUrl=IN_QUEUE_URL, ReceiptHandle=receipt_handle)
 
+@timed('SQS.SendMessage')
 def send_to_sqs(message: str) -> None:
 	"""Send a message to the output SQS queue."""
 	response = sqs.send_message(
@@ -183,14 +400,18 @@ def send_to_sqs(message: str) -> None:
 	logger.info(response['MessageId'])
 
 
-def invoke_classification_flow(text_content: str, supported_class_list: List[dict]) -> Any:
+def format_class_list(supported_class_list: List[dict]) -> str:
+	"""Format the supported classes for the classification prompt."""
 	classes_str = ""
 	for item in supported_class_list:
 		classes_str += f"<class_name>{item["class_name"]}<class_name> <expected_inputs>{item["expected_inputs"]}</expected_inputs>\n"
-	
+	return classes_str
+
+@timed('BedrockFlow.Classify')
+def invoke_classification_flow(text_content: str, supported_class_list: List[dict]) -> Any:
 	classify_inputs = {
 		"doc_text": text_content,
-		"class_list": classes_str
+		"class_list": format_class_list(supported_class_list)
 	}
 
 	try:
@@ -239,7 +460,8 @@ def save_document_parts(doc_manifest: List[Dict[str, Any]], lazy_doc, output_pat
 		
 		text = "".join(lazy_doc.pages[i].get_text() for i in doc_class['page-indexes'] if i < len(lazy_doc.pages))
 
-		save_to_s3(text, OUTPUT_BUCKET_NAME, txt_file)
+		# the S3 Retrieval node of the analysis flows reads the text as is, it is never compressed
+		save_to_s3(text, OUTPUT_BUCKET_NAME, txt_file, encoding='identity')
 		
 		response_doc_list.append({
 			"doc_text_s3key": txt_file,
@@ -257,6 +479,7 @@ def get_text_in_tag(string: str, tag: str) -> Optional[str]:
     return match.group(1) if match else None
 
 
+@timed('DynamoDB.Scan')
 def get_supported_class_list_from_dynamodb() -> List[Dict[str, str]]:
 	"""Retrieve a list of supported flow classes with their details from DynamoDB."""
 	response = dynamodb.scan(TableName=IDP_FLOW_CLASS_TABLE_NAME)
@@ -0,0 +1,124 @@
+import json
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# A gallery is stored as two files sharing a prefix: the float32 embedding matrix
+# (one L2-normalized row per known page) and the class label of each row.
+MATRIX_SUFFIX = ".npy"
+LABELS_SUFFIX = ".labels.json"
+
+# Rows scored per matrix product, bounds the memory used when the gallery is larger than RAM
+SEARCH_BLOCK_ROWS = 65536
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+	"""L2-normalize each row so the dot product of two rows is their cosine similarity."""
+	vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+	norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+	norms[norms == 0] = 1.0
+	return vectors / norms
+
+
+class EmbeddingGallery:
+	"""
+	Nearest-neighbour gallery of labelled page embeddings.
+
+	The embedding matrix is opened memory-mapped, so loading a gallery costs
+	nothing up front and only the pages of the file touched by a search are
+	read. A search is a blocked matrix product with the normalized queries.
+	"""
+
+	def __init__(self, matrix: np.ndarray, labels: Sequence[str]):
+		if matrix.ndim != 2 or matrix.shape[0] != len(labels):
+			raise ValueError(f"Expected one embedding row per label, got {matrix.shape} for {len(labels)} labels")
+		self.matrix = matrix
+		self.labels = np.asarray(labels, dtype=object)
+
+	@classmethod
+	def build(cls, embeddings: np.ndarray, labels: Sequence[str]) -> "EmbeddingGallery":
+		"""Create an in-memory gallery from raw embeddings of known pages."""
+		return cls(normalize_rows(embeddings), list(labels))
+
+	@classmethod
+	def load(cls, prefix: str) -> "EmbeddingGallery":
+		"""Open a gallery saved with save(), the matrix is memory-mapped read-only."""
+		matrix = np.load(prefix + MATRIX_SUFFIX, mmap_mode='r')
+		with open(prefix + LABELS_SUFFIX, encoding='utf-8') as f:
+			labels = json.load(f)
+		return cls(matrix, labels)
+
+	def save(self, prefix: str) -> Tuple[str, str]:
+		"""Write the gallery files and return their paths."""
+		directory = os.path.dirname(prefix)
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		np.save(prefix + MATRIX_SUFFIX, np.ascontiguousarray(self.matrix, dtype=np.float32))
+		with open(prefix + LABELS_SUFFIX, 'w', encoding='utf-8') as f:
+			json.dump(self.labels.tolist(), f)
+		return prefix + MATRIX_SUFFIX, prefix + LABELS_SUFFIX
+
+	def __len__(self) -> int:
+		return self.matrix.shape[0]
+
+	def search(self, queries: np.ndarray, k: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+		"""
+		Find the k most similar gallery rows of each query.
+
+		Args:
+			queries (np.ndarray): One embedding per row, or a single embedding.
+			k (int): Number of neighbours to return.
+
+		Returns:
+			Tuple[np.ndarray, np.ndarray]: The cosine similarities and row indexes,
+			both of shape (queries, k) and sorted by decreasing similarity.
+		"""
+		queries = normalize_rows(queries)
+		k = min(k, len(self))
+		best_scores = np.full((queries.shape[0], 0), -np.inf, dtype=np.float32)
+		best_indexes = np.zeros((queries.shape[0], 0), dtype=np.int64)
+
+		for start in range(0, len(self), SEARCH_BLOCK_ROWS):
+			block = np.asarray(self.matrix[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32)
+			scores = queries @ block.T
+			block_k = min(k, block.shape[0])
+			top = np.argpartition(-scores, block_k - 1, axis=1)[:, :block_k]
+			# keep the running top k of the blocks scanned so far
+			best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+			best_indexes = np.concatenate([best_indexes, top + start], axis=1)
+			if best_scores.shape[1] > k:
+				keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+				best_scores = np.take_along_axis(best_scores, keep, axis=1)
+				best_indexes = np.take_along_axis(best_indexes, keep, axis=1)
+
+		order = np.argsort(-best_scores, axis=1, kind='stable')
+		return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_indexes, order, axis=1)
+
+	def classify(self, queries: np.ndarray, k: int = 5, min_similarity: float = 0.85,
+				 min_margin: float = 0.05) -> List[Tuple[Optional[str], float]]:
+		"""
+		Assign a label to each query when the gallery is confident about it.
+
+		A query gets the label of its nearest neighbour when that neighbour is at
+		least min_similarity close and no neighbour of another label among the top
+		k is within min_margin of it. Other queries get None, they are ambiguous.
+
+		Returns:
+			List[Tuple[Optional[str], float]]: The label (or None) and the best similarity of each query.
+		"""
+		if len(self) == 0:
+			return [(None, 0.0) for _ in range(np.atleast_2d(queries).shape[0])]
+
+		scores, indexes = self.search(queries, k)
+		results = []
+		for row_scores, row_indexes in zip(scores, indexes):
+			labels = self.labels[row_indexes]
+			best_label, best_score = labels[0], float(row_scores[0])
+			others = row_scores[labels != best_label]
+			runner_up = float(others[0]) if len(others) else -1.0
+			if best_score >= min_similarity and best_score - runner_up >= min_margin:
+				results.append((best_label, best_score))
+			else:
+				results.append((None, best_score))
+		return results
@@ -1,21 +1,47 @@
 import json
-import boto3
 import os
 import logging
-from typing import Dict, List, Optional
+import random
+import time
+from typing import Dict, List, Optional, TYPE_CHECKING
 import traceback
 from datetime import datetime
+from botocore.exceptions import ClientError
 from aws_lambda_powertools import Logger
-from aws_lambda_powertools.utilities.validation import validator
-from aws_lambda_powertools.utilities.validation.exceptions import SchemaValidationError
-from aws_lambda_powertools.utilities.typing import LambdaContext
+from aws_clients import lazy_client
+import artifacts
+import case_progress
+import claim_check
+import job_status
+from instrumentation import emit_metric, handler_span, now_ms, set_trace, span, timed
+from consistency import extract_normalized_fields, run_cross_document_checks
+
+# boto3 is imported with the first client and jsonschema with the first schema check. The powertools
+# validation utilities are not used, they import fastjsonschema and jmespath on load
+if TYPE_CHECKING:
+    from aws_lambda_powertools.utilities.typing import LambdaContext
+
+
+class SchemaValidationError(Exception):
+    """Raised when a document does not match its JSON schema."""
+
 
 # Set up logging
 logger = Logger(service="DocValidationService")
 
 # Initialize AWS clients
-s3 = boto3.client('s3')
-sqs = boto3.client('sqs')
+s3 = lazy_client('s3')
+dynamodb = lazy_client('dynamodb')
+
+CASE_VALIDATION_TABLE_NAME = os.environ.get('CASE_VALIDATION_TABLE_NAME')
+VALIDATION_RESULTS_SUFFIX = '.validation_results.json'
+MAX_SUMMARY_UPDATE_ATTEMPTS = 5
+# Full jitter backoff between conflicting summary writes, seconds
+SUMMARY_UPDATE_BACKOFF_BASE = 0.05
+SUMMARY_UPDATE_BACKOFF_MAX = 1.0
+
+# Ordered from best to worst, the case status is the worst status of its documents
+STATUS_SEVERITY = ['PASSED', 'FAILED', 'ERROR']
 
 # Schema definitions
 DRIVERS_LICENSE_SCHEMA = {
@@ -116,6 +142,7 @@ def validate_schema(schema: Dict, data: Dict) -> None:
         raise SchemaValidationError(f"Schema validation failed: {str(e)}")
 
 # If the incomming message doesn't tell us about a json file but instead tells us about the txt file we can use this code to find it
+@timed('S3.ListObjects')
 def find_corresponding_json(bucket: str, txt_key: str) -> Optional[str]:
     """
     Find the corresponding JSON file in the same folder as the text file.
@@ -164,13 +191,13 @@ def find_corresponding_json(bucket: str, txt_key: str) -> Optional[str]:
         })
         return None
 
+@timed('S3.GetObject')
 def read_s3_json(bucket: str, key: str) -> Optional[Dict]:
     """
     Read and parse JSON file from S3, handling potential text before/after JSON content.
     """
     try:
-        response = s3.get_object(Bucket=bucket, Key=key)
-        content = response['Body'].read().decode('utf-8')
+        content = artifacts.get_text(bucket, key)
         
         try:
             return json.loads(content)
@@ -207,14 +234,28 @@ def determine_document_type(file_path: str, content: Dict) -> str:
 
 
 
+def get_validation_results_key(document_key: str) -> str:
+    """
+    Build the S3 key of the validation results for a document.
+
+    The key is derived from the document's own file name so that several
+    documents in the same directory do not overwrite each other's results.
+    """
+    directory = os.path.dirname(document_key)
+    file_prefix = os.path.basename(document_key).split('.')[0]
+    return os.path.join(directory, f"{file_prefix}{VALIDATION_RESULTS_SUFFIX}")
+
+@timed('S3.PutObject')
 def save_validation_results(results: Dict, case_id: str, document_type: str, 
-                          s3_location: Dict) -> None:
+                          s3_location: Dict) -> str:
     """
     Save validation results to S3.
+
+    Returns:
+        str: Key of the saved validation results
     """
     try:
-        directory = os.path.dirname(s3_location['key'])
-        validation_key = os.path.join(directory, 'validation_results.json')
+        validation_key = get_validation_results_key(s3_location['key'])
         
         results.update({
             'case_id': case_id,
@@ -232,6 +273,7 @@ def save_validation_results(results: Dict, case_id: str, document_type: str,
         logger.info("Validation results saved", extra={
             "results_location": f"s3://{s3_location['bucket']}/{validation_key}"
         })
+        return validation_key
         
     except Exception as e:
         # Log the full traceback at debug level for troubleshooting
@@ -247,6 +289,135 @@ def save_validation_results(results: Dict, case_id: str, document_type: str,
         })
         raise
 
+@timed('DynamoDB.GetItem')
+def get_case_validation_summary(case_id: str) -> Optional[Dict]:
+    """
+    Read the aggregated validation summary of a case with a single key lookup.
+
+    Args:
+        case_id: The case ID
+
+    Returns:
+        Optional[Dict]: The case summary, None if no document of the case was validated yet
+    """
+    response = dynamodb.get_item(
+        TableName=CASE_VALIDATION_TABLE_NAME,
+        Key={'case_id': {'S': case_id}},
+        ConsistentRead=True
+    )
+    item = response.get('Item')
+    if not item:
+        return None
+    from boto3.dynamodb.types import TypeDeserializer
+    deserializer = TypeDeserializer()
+    return {k: deserializer.deserialize(v) for k, v in item.items()}
+
+def summarize_case(documents: Dict[str, Dict], cross_document_checks: Dict[str, Dict]) -> Dict:
+    """
+    Derive the overall case status from the per-document validation entries
+    and the cross-document consistency checks.
+    """
+    statuses = [doc['validation_status'] for doc in documents.values()]
+    cross_document_passed = all(pair['passed'] for pair in cross_document_checks.values())
+    if not cross_document_passed:
+        statuses.append('FAILED')
+    case_status = max(statuses, key=lambda status: STATUS_SEVERITY.index(status)
+                      if status in STATUS_SEVERITY else len(STATUS_SEVERITY))
+    return {
+        'case_status': case_status,
+        'cross_document_status': 'PASSED' if cross_document_passed else 'FAILED',
+        'needs_manual_review': not cross_document_passed
+            or any(doc['needs_manual_review'] for doc in documents.values()),
+        'document_count': len(documents)
+    }
+
+def update_case_validation_summary(case_id: str, results: Dict, document_key: str,
+                                   results_key: str, normalized_fields: Optional[Dict] = None) -> Dict:
+    """
+    Merge the validation results of one document into the case summary.
+
+    The summary item is versioned and written with a conditional put, so
+    concurrent validations of documents of the same case never lose an update.
+    A conflicting write is retried on top of the freshly read summary, after a
+    jittered exponential backoff that spreads the writers of a busy case.
+
+    The summary also holds the case field index, the normalized applicant
+    fields of every validated document. The cross-document rules for the new
+    document run against this index instead of re-reading the case from S3.
+
+    Args:
+        case_id: The case ID
+        results: Validation results of the document
+        document_key: S3 key of the validated document
+        results_key: S3 key of the saved validation results
+        normalized_fields: Normalized fields of the document for the case field index
+
+    Returns:
+        Dict: The updated case summary
+    """
+    from boto3.dynamodb.types import TypeSerializer
+    serializer = TypeSerializer()
+    document_entry = {
+        'document_type': results['document_type'],
+        'validation_status': results['validation_status'],
+        'needs_manual_review': results['needs_manual_review'],
+        'results_key': results_key,
+        'timestamp': results['timestamp']
+    }
+
+    for attempt in range(1, MAX_SUMMARY_UPDATE_ATTEMPTS + 1):
+        summary = get_case_validation_summary(case_id)
+        version = int(summary['version']) if summary else 0
+        documents = dict(summary['documents']) if summary else {}
+        documents[document_key] = document_entry
+
+        field_index = dict(summary.get('field_index', {})) if summary else {}
+        cross_document_checks = dict(summary.get('cross_document_checks', {})) if summary else {}
+        if normalized_fields:
+            field_index[document_key] = normalized_fields
+            cross_document_checks.update(run_cross_document_checks(field_index, document_key))
+
+        updated_at = datetime.utcnow().isoformat()
+        updated_summary = {
+            'case_id': case_id,
+            'documents': documents,
+            'field_index': field_index,
+            'cross_document_checks': cross_document_checks,
+            'version': version + 1,
+            'updated_at': updated_at,
+            # key of the updated_hour index read by the compaction
+            'updated_hour': updated_at[:13],
+            **summarize_case(documents, cross_document_checks)
+        }
+
+        try:
+            with span('DynamoDB.PutItem', attempt=attempt):
+                dynamodb.put_item(
+                    TableName=CASE_VALIDATION_TABLE_NAME,
+                    Item={k: serializer.serialize(v) for k, v in updated_summary.items()},
+                    ConditionExpression='attribute_not_exists(case_id) OR version = :expected_version',
+                    ExpressionAttributeValues={':expected_version': {'N': str(version)}}
+                )
+            logger.info("Case validation summary updated", extra={
+                "case_id": case_id,
+                "case_status": updated_summary['case_status'],
+                "version": updated_summary['version']
+            })
+            return updated_summary
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            logger.info("Concurrent case summary update, retrying", extra={
+                "case_id": case_id,
+                "attempt": attempt
+            })
+            if attempt < MAX_SUMMARY_UPDATE_ATTEMPTS:
+                time.sleep(random.uniform(0, min(SUMMARY_UPDATE_BACKOFF_MAX,
+                                                 SUMMARY_UPDATE_BACKOFF_BASE * 2 ** (attempt - 1))))
+
+    raise Exception(f"Could not update validation summary for case {case_id} "
+                    f"after {MAX_SUMMARY_UPDATE_ATTEMPTS} attempts")
+
 def validate_document(document_type: str, doc_data: Dict) -> Dict:
     """
     Validate document data against schema and reference data.
@@ -354,8 +525,36 @@ def validate_document(document_type: str, doc_data: Dict) -> Dict:
 
     return validation_results
 
+@timed('Validation.Finish')
+def finish_validation(message_body: Optional[Dict], validation_status: Optional[str]) -> None:
+    """
+    Finish the unit of pending case work of a validation message, whether the document
+    was validated or not, so the case completes once every document was handled, and
+    record the validation status of the document in the item of its Textract job.
+    """
+    if not message_body or not message_body.get('case_id'):
+        return
+    json_key = message_body.get('s3_location', {}).get('key')
+    try:
+        with span('CaseProgress.Advance'):
+            case_progress.advance(message_body['case_id'], f"validate:{json_key}", -1,
+                                  **({'validated': 1} if validation_status else {'failed': 1}))
+        with span('DynamoDB.UpdateItem'):
+            job_status.record_document(message_body.get('job_id'), json_key or '',
+                                       validation=validation_status or 'NOT_VALIDATED',
+                                       validated_at=job_status.now_ms())
+    except case_progress.CaseProgressError:
+        # the CaseCompleted event is sent again when the message is redelivered
+        raise
+    except Exception:
+        logger.exception("Error recording case progress", extra={
+            "case_id": message_body['case_id'],
+            "json_key": json_key
+        })
+
+@handler_span('Validation')
 @logger.inject_lambda_context
-def lambda_handler(event: Dict, context: LambdaContext) -> Dict:
+def lambda_handler(event: Dict, context: 'LambdaContext') -> Dict:
     """
     Process SQS messages containing document data for validation.
     """
@@ -363,11 +562,16 @@ def lambda_handler(event: Dict, context: LambdaContext) -> Dict:
         logger.info("Starting validation process", extra={
             "num_records": len(event.get('Records', []))
         })
+        claim_check.clear_cache()
         
         processed_documents = 0
         for record in event.get('Records', []):
+            message_body = None
+            validation_status = None
             try:
-                message_body = json.loads(record['body'])
+                # processed_data may be a claim check, claim_check.resolve() reads it when needed
+                message_body = claim_check.loads(record['body'])
+                set_trace(case_id=message_body.get('case_id'), job_id=message_body.get('job_id'))
                 s3_location = message_body.get('s3_location', {})
                 
                 if not s3_location:
@@ -385,6 +589,13 @@ def lambda_handler(event: Dict, context: LambdaContext) -> Dict:
                     })
                     continue
                 
+                # Results written by this function are not documents to validate
+                if txt_key.endswith(VALIDATION_RESULTS_SUFFIX):
+                    logger.info("Skipping validation results file", extra={
+                        "key": txt_key
+                    })
+                    continue
+                
                 # Find corresponding JSON file
                 json_key = find_corresponding_json(bucket, txt_key)
                 if not json_key:
@@ -409,15 +620,29 @@ def lambda_handler(event: Dict, context: LambdaContext) -> Dict:
                 })
 
                 validation_results = validate_document(document_type, json_content)
+                case_id = message_body.get('case_id', 'unknown')
                 
-                save_validation_results(
+                results_key = save_validation_results(
                     validation_results,
-                    message_body.get('case_id', 'unknown'),
+                    case_id,
                     document_type,
                     {'bucket': bucket, 'key': json_key}
                 )
                 
+                update_case_validation_summary(
+                    case_id,
+                    validation_results,
+                    json_key,
+                    results_key,
+                    extract_normalized_fields(document_type, json_content)
+                )
+
+                # the analysis stage passes the Textract job start along with the files of the job
+                if message_body.get('job_started_at'):
+                    emit_metric('EndToEndLatency', now_ms() - int(message_body['job_started_at']))
+                
                 processed_documents += 1
+                validation_status = validation_results['validation_status']
                 
             except json.JSONDecodeError as e:
                 logger.error("Invalid JSON in SQS message", extra={
@@ -431,6 +656,8 @@ def lambda_handler(event: Dict, context: LambdaContext) -> Dict:
                     "record": record
                 })
                 continue
+            finally:
+                finish_validation(message_body, validation_status)
         
         return {
             'statusCode': 200,
@@ -440,6 +667,8 @@ def lambda_handler(event: Dict, context: LambdaContext) -> Dict:
             })
         }
         
+    except case_progress.CaseProgressError:
+        raise
     except Exception as e:
         logger.exception("Validation process failed", extra={
             "error_type": str(type(e).__name__)
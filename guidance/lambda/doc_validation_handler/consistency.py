@@ -0,0 +1,185 @@
+import re
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# Document types whose applicant details are compared with each other
+IDENTITY_DOCUMENT_TYPE = "DRIVERS_LICENSE"
+APPLICATION_DOCUMENT_TYPE = "URLA"
+
+CROSS_DOCUMENT_FIELDS = ["name", "date_of_birth", "address"]
+
+DATE_FORMATS = ["%m/%d/%Y", "%Y-%m-%d", "%m-%d-%Y", "%m/%d/%y"]
+
+STREET_ABBREVIATIONS = {
+    "STREET": "ST",
+    "AVENUE": "AVE",
+    "ROAD": "RD",
+    "DRIVE": "DR",
+    "BOULEVARD": "BLVD",
+    "LANE": "LN",
+    "COURT": "CT",
+    "PLACE": "PL",
+    "APARTMENT": "APT",
+    "SUITE": "STE",
+    "NORTH": "N",
+    "SOUTH": "S",
+    "EAST": "E",
+    "WEST": "W"
+}
+
+def normalize_text(value) -> Optional[str]:
+    """Upper-case a value, drop punctuation and collapse whitespace."""
+    if value is None:
+        return None
+    text = re.sub(r"[^A-Z0-9 ]", " ", str(value).upper())
+    text = " ".join(text.split())
+    return text or None
+
+def normalize_name(*parts) -> Optional[str]:
+    """
+    Normalize a person name into its sorted name tokens so that
+    "Doe, John" and "John Doe" produce the same value.
+    """
+    tokens = []
+    for part in parts:
+        text = normalize_text(part)
+        if text:
+            tokens.extend(text.split())
+    return " ".join(sorted(tokens)) if tokens else None
+
+def normalize_date(value) -> Optional[str]:
+    """Normalize a date into ISO format, None if it can't be parsed."""
+    text = str(value).strip() if value is not None else ""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+def normalize_address(street, city, state, zip_code) -> Optional[str]:
+    """Normalize an address into a single comparable string."""
+    street_text = normalize_text(street)
+    if street_text:
+        street_text = " ".join(STREET_ABBREVIATIONS.get(token, token) for token in street_text.split())
+    zip_text = re.sub(r"\D", "", str(zip_code))[:5] if zip_code is not None else None
+    parts = [street_text, normalize_text(city), normalize_text(state), zip_text]
+    if not all(parts):
+        return None
+    return "|".join(parts)
+
+def nested_fields(value) -> Dict:
+    """The keys of a nested object, none when the extraction returned text or a list instead."""
+    return value if isinstance(value, dict) else {}
+
+def extract_normalized_fields(document_type: str, doc_data: Dict) -> Optional[Dict]:
+    """
+    Extract the applicant fields used by the cross-document rules.
+
+    Args:
+        document_type: The document type
+        doc_data: The extracted document data
+
+    Returns:
+        Optional[Dict]: The normalized fields, None for document types without cross-document rules
+    """
+    if not doc_data or not isinstance(doc_data, dict):
+        return None
+
+    if document_type == IDENTITY_DOCUMENT_TYPE:
+        address = nested_fields(doc_data.get("address"))
+        fields = {
+            "name": normalize_name(doc_data.get("first_name"), doc_data.get("last_name")),
+            "date_of_birth": normalize_date(doc_data.get("date_of_birth")),
+            "address": normalize_address(address.get("street"), address.get("city"),
+                                         address.get("state"), address.get("zip_code"))
+        }
+    elif document_type == APPLICATION_DOCUMENT_TYPE:
+        applicant = nested_fields(doc_data.get("applicant"))
+        address = nested_fields(applicant.get("currentAddress"))
+        fields = {
+            "name": normalize_name(applicant.get("fullName")),
+            "date_of_birth": normalize_date(applicant.get("dateOfBirth")),
+            "address": normalize_address(address.get("street"), address.get("city"),
+                                         address.get("state"), address.get("zip"))
+        }
+    else:
+        return None
+
+    fields["document_type"] = document_type
+    return fields
+
+def names_match(first: str, second: str) -> bool:
+    """Names match when the tokens of one are contained in the other, e.g. a missing middle name."""
+    first_tokens, second_tokens = set(first.split()), set(second.split())
+    return first_tokens <= second_tokens or second_tokens <= first_tokens
+
+def compare_fields(identity_fields: Dict, application_fields: Dict) -> List[Dict]:
+    """
+    Compare the normalized fields of an identity document with an application.
+
+    Returns:
+        List[Dict]: One check per field present in both documents
+    """
+    checks = []
+    for field in CROSS_DOCUMENT_FIELDS:
+        identity_value = identity_fields.get(field)
+        application_value = application_fields.get(field)
+        if not identity_value or not application_value:
+            continue
+        if field == "name":
+            passed = names_match(identity_value, application_value)
+        else:
+            passed = identity_value == application_value
+        checks.append({
+            "check": f"{field}_match",
+            "passed": passed,
+            "message": f"{field} {'matches' if passed else 'does not match'} between the driver's license and the URLA applicant"
+        })
+    return checks
+
+def pair_key(identity_key: str, application_key: str) -> str:
+    """Key of the cross-document result of a driver's license and URLA pair."""
+    return f"{identity_key}|{application_key}"
+
+def run_cross_document_checks(field_index: Dict[str, Dict], document_key: str) -> Dict[str, Dict]:
+    """
+    Run the cross-document rules between a newly indexed document and the
+    documents already in the case field index.
+
+    Only the pairs involving the new document are evaluated, the index already
+    holds the normalized fields of every other document of the case.
+
+    Args:
+        field_index: Normalized fields of the case keyed by document S3 key
+        document_key: S3 key of the new document
+
+    Returns:
+        Dict[str, Dict]: Results of the evaluated pairs keyed by pair_key
+    """
+    new_fields = field_index.get(document_key)
+    if not new_fields:
+        return {}
+
+    results = {}
+    for other_key, other_fields in field_index.items():
+        if other_key == document_key:
+            continue
+        document_types = (new_fields["document_type"], other_fields["document_type"])
+        if document_types == (IDENTITY_DOCUMENT_TYPE, APPLICATION_DOCUMENT_TYPE):
+            identity_key, identity_fields = document_key, new_fields
+            application_key, application_fields = other_key, other_fields
+        elif document_types == (APPLICATION_DOCUMENT_TYPE, IDENTITY_DOCUMENT_TYPE):
+            identity_key, identity_fields = other_key, other_fields
+            application_key, application_fields = document_key, new_fields
+        else:
+            continue
+
+        checks = compare_fields(identity_fields, application_fields)
+        results[pair_key(identity_key, application_key)] = {
+            "identity_document": identity_key,
+            "application_document": application_key,
+            "passed": all(check["passed"] for check in checks),
+            "checks": checks
+        }
+    return results
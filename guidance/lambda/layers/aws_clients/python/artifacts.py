@@ -0,0 +1,118 @@
+"""
+Compressed text artifacts in S3 for the guidance Lambda functions, part of the AWSClientsLayer.
+
+Text is written with the ARTIFACT_ENCODING of the function, gzip by default, and the
+S3 object gets the matching ContentEncoding. The key is not changed, so a browser or
+the S3 console opens the text as before, and get_text() decodes any object by its
+ContentEncoding:
+
+    artifacts.put_text(bucket, 'case/job/input_doc.txt', text)
+    text = artifacts.get_text(bucket, 'case/job/input_doc.txt')
+
+zstd needs the compression.zstd module of Python 3.14 or the zstandard package in the
+function or a layer. Without them the functions write gzip. Text smaller than
+MIN_COMPRESS_BYTES is written as is. The AWS CLI does not decode objects, read the
+synchronized files with `gzip -dc < input_doc.txt` or `zstd -dc < input_doc.txt`.
+
+Run `python benchmark_artifacts.py` in the guidance directory to compare the encodings
+on page text.
+"""
+import functools
+import gzip
+import logging
+import os
+from typing import Dict, Optional
+
+from aws_clients import lazy_client
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_ENCODING = os.environ.get('ARTIFACT_ENCODING', 'gzip')
+ENCODINGS = ('gzip', 'zstd', 'identity')
+# levels chosen with benchmark_artifacts.py, higher levels save little on page text for much more CPU
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+MIN_COMPRESS_BYTES = 512
+TEXT_CONTENT_TYPE = 'text/plain; charset=utf-8'
+
+s3 = lazy_client('s3')
+
+
+@functools.lru_cache(maxsize=None)
+def _zstd():
+    """The zstd module with compress() and decompress(), None when neither is installed."""
+    try:
+        from compression import zstd
+        return zstd
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        return None
+
+    class Zstandard:
+        @staticmethod
+        def compress(data: bytes, level: int = ZSTD_LEVEL) -> bytes:
+            return zstandard.ZstdCompressor(level=level).compress(data)
+
+        @staticmethod
+        def decompress(data: bytes) -> bytes:
+            decompressor = zstandard.ZstdDecompressor()
+            try:
+                return decompressor.decompress(data)
+            except zstandard.ZstdError:
+                # frames written by streaming tools do not carry their size
+                return decompressor.decompressobj().decompress(data)
+
+    return Zstandard
+
+
+def resolve_encoding(encoding: Optional[str] = None) -> str:
+    """The encoding to write with, gzip in place of zstd when no zstd module is installed."""
+    encoding = encoding or ARTIFACT_ENCODING
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unsupported artifact encoding '{encoding}', expected one of {', '.join(ENCODINGS)}")
+    if encoding == 'zstd' and _zstd() is None:
+        logger.warning("No zstd module installed, writing gzip artifacts")
+        return 'gzip'
+    return encoding
+
+
+def encode(data: bytes, encoding: str) -> bytes:
+    if encoding == 'gzip':
+        # mtime=0 keeps the output of the same text identical
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding == 'zstd':
+        return _zstd().compress(data, level=ZSTD_LEVEL)
+    return data
+
+
+def decode(data: bytes, encoding: Optional[str]) -> bytes:
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'zstd':
+        zstd = _zstd()
+        if zstd is None:
+            raise RuntimeError("Reading a zstd artifact needs compression.zstd or the zstandard package")
+        return zstd.decompress(data)
+    if encoding in (None, '', 'identity'):
+        return data
+    raise ValueError(f"Unsupported content encoding '{encoding}'")
+
+
+def put_text(bucket: str, key: str, text: str, encoding: Optional[str] = None,
+             content_type: str = TEXT_CONTENT_TYPE) -> Dict:
+    """Write the text with the given or the configured encoding and return the put_object response."""
+    data = text.encode('utf-8')
+    encoding = resolve_encoding(encoding) if len(data) >= MIN_COMPRESS_BYTES else 'identity'
+    arguments = {'Bucket': bucket, 'Key': key, 'Body': encode(data, encoding), 'ContentType': content_type}
+    if encoding != 'identity':
+        arguments['ContentEncoding'] = encoding
+    return s3.put_object(**arguments)
+
+
+def get_text(bucket: str, key: str) -> str:
+    """Read a text object written by put_text() or any other writer."""
+    response = s3.get_object(Bucket=bucket, Key=key)
+    return decode(response['Body'].read(), response.get('ContentEncoding')).decode('utf-8')
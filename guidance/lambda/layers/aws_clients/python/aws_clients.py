@@ -0,0 +1,160 @@
+"""
+Shared boto3 clients for the guidance Lambda functions, deployed as the AWSClientsLayer.
+
+Clients are created on first use instead of at import time, so a function only
+pays for the clients it calls, and boto3 itself is only imported then. Every
+client gets a connection pool sized for the threads of the handlers, TCP
+keepalive, adaptive retries and timeouts chosen for its service.
+
+    from aws_clients import lazy_client
+    s3 = lazy_client('s3')   # nothing is created yet
+    s3.put_object(...)       # the client is built here and reused afterwards
+
+Client creation and API call durations are recorded, see get_stats(). Run
+`python aws_clients.py` to measure the import and client creation cost locally.
+"""
+import logging
+import threading
+import time
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+MAX_POOL_CONNECTIONS = 50
+
+# connect/read timeouts in seconds and retry attempts per service. A call with all its
+# attempts, (connect_timeout + read_timeout) * max_attempts, must end before the timeout
+# of every function using the service, see max_call_seconds():
+#   ProcessS3FilesFunction 30s       textract, dynamodb, events
+#   CaseStatusFunction 20s           dynamodb
+#   DocValidationHandlerFunction 60s s3, dynamodb, events
+#   DocClassification and DocAnalysis 180s, for the prompt flows of bedrock-agent-runtime
+SERVICE_SETTINGS = {
+    'bedrock-agent-runtime': {'connect_timeout': 2, 'read_timeout': 55, 'max_attempts': 2},
+    'bedrock-runtime': {'connect_timeout': 2, 'read_timeout': 10, 'max_attempts': 4},
+    'textract': {'connect_timeout': 2, 'read_timeout': 5, 'max_attempts': 4},
+    's3': {'connect_timeout': 2, 'read_timeout': 15, 'max_attempts': 3},
+    'sqs': {'connect_timeout': 2, 'read_timeout': 5, 'max_attempts': 5},
+    'dynamodb': {'connect_timeout': 1, 'read_timeout': 3, 'max_attempts': 4},
+    'events': {'connect_timeout': 2, 'read_timeout': 5, 'max_attempts': 4},
+}
+DEFAULT_SETTINGS = {'connect_timeout': 2, 'read_timeout': 10, 'max_attempts': 4}
+
+_clients: Dict[str, Any] = {}
+_lock = threading.Lock()
+_stats = {'boto3_import_seconds': None, 'client_init_seconds': {}, 'calls': {}}
+
+
+def get_client_config(service_name: str):
+    """Build the botocore Config used for a service."""
+    from botocore.config import Config
+    settings = SERVICE_SETTINGS.get(service_name, DEFAULT_SETTINGS)
+    return Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=settings['connect_timeout'],
+        read_timeout=settings['read_timeout'],
+        retries={'mode': 'adaptive', 'max_attempts': settings['max_attempts']}
+    )
+
+
+def max_call_seconds(service_name: str) -> int:
+    """Longest a call to the service can take with all its attempts timing out."""
+    settings = SERVICE_SETTINGS.get(service_name, DEFAULT_SETTINGS)
+    return (settings['connect_timeout'] + settings['read_timeout']) * settings['max_attempts']
+
+
+def get_client(service_name: str):
+    """Return the client of a service, creating it on the first call."""
+    client = _clients.get(service_name)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(service_name)
+        if client is None:
+            start = time.perf_counter()
+            import boto3
+            if _stats['boto3_import_seconds'] is None:
+                _stats['boto3_import_seconds'] = time.perf_counter() - start
+            start = time.perf_counter()
+            client = boto3.client(service_name, config=get_client_config(service_name))
+            _register_call_timing(client, service_name)
+            _stats['client_init_seconds'][service_name] = time.perf_counter() - start
+            _clients[service_name] = client
+            logger.debug(f"Created {service_name} client in {_stats['client_init_seconds'][service_name]:.3f}s")
+    return client
+
+
+class LazyClient:
+    """Stands in for a boto3 client and creates the real one on first attribute access."""
+    __slots__ = ('_service_name',)
+
+    def __init__(self, service_name: str):
+        self._service_name = service_name
+
+    def __getattr__(self, name: str):
+        return getattr(get_client(self._service_name), name)
+
+    def __repr__(self):
+        return f"LazyClient({self._service_name!r})"
+
+
+def lazy_client(service_name: str) -> LazyClient:
+    return LazyClient(service_name)
+
+
+def _register_call_timing(client, service_name: str) -> None:
+    # before-parameter-build and after-call surround a single API call including its retries
+    started = threading.local()
+
+    def before_parameter_build(model, **kwargs):
+        started.value = time.perf_counter()
+
+    def after_call(model, **kwargs):
+        start = getattr(started, 'value', None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        key = f"{service_name}.{model.name}"
+        with _lock:
+            entry = _stats['calls'].setdefault(key, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            entry['count'] += 1
+            entry['total_seconds'] += elapsed
+            entry['max_seconds'] = max(entry['max_seconds'], elapsed)
+
+    client.meta.events.register('before-parameter-build', before_parameter_build)
+    client.meta.events.register('after-call', after_call)
+
+
+def get_stats() -> Dict[str, Any]:
+    """Import and creation time of the clients and per-operation call counts and durations."""
+    with _lock:
+        return {
+            'boto3_import_seconds': _stats['boto3_import_seconds'],
+            'client_init_seconds': dict(_stats['client_init_seconds']),
+            'calls': {key: dict(entry) for key, entry in _stats['calls'].items()},
+        }
+
+
+def reset_clients() -> None:
+    """Drop the created clients and statistics, e.g. between tests."""
+    with _lock:
+        _clients.clear()
+        _stats['boto3_import_seconds'] = None
+        _stats['client_init_seconds'].clear()
+        _stats['calls'].clear()
+
+
+if __name__ == '__main__':
+    import json
+    import os
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    for service in SERVICE_SETTINGS:
+        get_client(service)
+    start = time.perf_counter()
+    for _ in range(10000):
+        get_client('s3')
+    cached_micros = (time.perf_counter() - start) * 100
+    print(json.dumps({**get_stats(), 'cached_get_client_microseconds': cached_micros,
+                      'max_call_seconds': {service: max_call_seconds(service) for service in SERVICE_SETTINGS}},
+                     indent=2))
@@ -0,0 +1,183 @@
+"""
+Per-case completion counter of the guidance pipeline, part of the AWSClientsLayer.
+
+Every case has an item in the CASE_PROGRESS_TABLE_NAME table with the number of units of
+work still pending. Each stage finishes its own unit and registers the units it hands to
+the next stage in the same atomic update:
+
+    s3_event_handler         +1 for the Textract job, -1 when Textract rejects the document
+    classification           documents - 1
+    analysis                 validation messages - 1, per document
+    validation               -1, per document
+
+Each update carries a token naming the unit, e.g. analyze:<text key>. The update is written
+in one transaction with a marker item keyed <case_id>#<token>, which fails when the marker
+exists, so SQS redeliveries and retries are counted once. The markers expire after
+TOKEN_RETENTION_DAYS, longer than a message can stay in the queues, and the item of the
+case keeps a fixed size.
+
+The stage that finds pending at zero sends a single CaseCompleted event to EventBridge:
+
+    {"source": "idp.guidance", "detail-type": "CaseCompleted",
+     "detail": {"case_id": "...", "completion": 1, "documents": 2, "validated": 2, "failed": 0, ...}}
+
+Every update increments the revision of the case. The completion records the revision it
+completed and the event records the revision it was sent for, so a stage that stopped
+between the last update and the event completes the case when its message is redelivered.
+A failed event raises CaseProgressError for the message to be retried; the event is sent at
+least once and carries the completion number for consumers to drop duplicates.
+
+A job uploaded to a case after its completion adds a unit again and the case completes a
+second time, with completion 2. Without CASE_PROGRESS_TABLE_NAME progress is not tracked.
+"""
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from aws_clients import lazy_client
+
+logger = logging.getLogger(__name__)
+
+CASE_PROGRESS_TABLE_NAME = os.environ.get('CASE_PROGRESS_TABLE_NAME')
+CASE_EVENT_BUS_NAME = os.environ.get('CASE_EVENT_BUS_NAME', 'default')
+# longer than the retention of the queues and their dead letter queues
+TOKEN_RETENTION_DAYS = int(os.environ.get('CASE_PROGRESS_TOKEN_RETENTION_DAYS', '14'))
+EVENT_SOURCE = 'idp.guidance'
+CASE_COMPLETED = 'CaseCompleted'
+# counters that may be added with advance(), reported in the CaseCompleted event
+COUNTERS = ('jobs', 'documents', 'validated', 'failed')
+TOKEN_SEPARATOR = '#'
+
+dynamodb = lazy_client('dynamodb')
+events = lazy_client('events')
+
+
+class CaseProgressError(Exception):
+    """The CaseCompleted event was not sent, the message must be retried."""
+
+
+def advance(case_id: str, token: str, delta: int, **counters: int) -> Optional[int]:
+    """
+    Add delta to the pending units of the case, once per token.
+
+    Args:
+        case_id: The case ID
+        token: Unique name of the finished unit
+        delta: Units handed to the next stage minus the finished one
+        counters: Amounts added to the jobs, documents, validated or failed counters
+
+    Returns:
+        Optional[int]: The pending units after the update, None when the token was seen
+        before or progress is not tracked
+
+    Raises:
+        CaseProgressError: The case completed and its CaseCompleted event was not sent
+    """
+    if not CASE_PROGRESS_TABLE_NAME:
+        return None
+    unknown = set(counters) - set(COUNTERS)
+    if unknown:
+        raise ValueError(f"Unknown case progress counters: {', '.join(sorted(unknown))}")
+
+    additions = ''.join(f", {name} :{name}" for name in counters)
+    values = {f":{name}": {'N': str(amount)} for name, amount in counters.items()}
+    duplicate = False
+    try:
+        dynamodb.transact_write_items(TransactItems=[
+            {'Put': {
+                'TableName': CASE_PROGRESS_TABLE_NAME,
+                'Item': {
+                    'case_id': {'S': f"{case_id}{TOKEN_SEPARATOR}{token}"},
+                    'expires_at': {'N': str(int(time.time()) + TOKEN_RETENTION_DAYS * 86400)}
+                },
+                'ConditionExpression': 'attribute_not_exists(case_id)'
+            }},
+            {'Update': {
+                'TableName': CASE_PROGRESS_TABLE_NAME,
+                'Key': {'case_id': {'S': case_id}},
+                'UpdateExpression': f"ADD pending :delta, revision :one{additions} SET updated_at = :now",
+                'ExpressionAttributeValues': {
+                    ':delta': {'N': str(delta)},
+                    ':one': {'N': '1'},
+                    ':now': {'S': datetime.utcnow().isoformat()},
+                    **values
+                }
+            }}
+        ])
+    except dynamodb.exceptions.TransactionCanceledException as e:
+        reasons = e.response.get('CancellationReasons', [])
+        if not reasons or reasons[0].get('Code') != 'ConditionalCheckFailed':
+            raise
+        logger.info(f"Case progress of {token} was already recorded for case {case_id}")
+        duplicate = True
+
+    # a redelivered message finishes the completion its first delivery did not
+    item = dynamodb.get_item(TableName=CASE_PROGRESS_TABLE_NAME, Key={'case_id': {'S': case_id}},
+                             ConsistentRead=True).get('Item', {})
+    pending = int(item['pending']['N']) if 'pending' in item else None
+    if pending == 0:
+        complete(case_id)
+    elif pending is not None and pending < 0:
+        logger.error(f"Case {case_id} has {pending} pending units after {token}")
+    return None if duplicate else pending
+
+
+def complete(case_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Count the completion of a case with no pending units and send its CaseCompleted event,
+    once per revision of the case.
+    """
+    now = datetime.utcnow().isoformat()
+    try:
+        response = dynamodb.update_item(
+            TableName=CASE_PROGRESS_TABLE_NAME,
+            Key={'case_id': {'S': case_id}},
+            UpdateExpression='SET completed_at = :now, completed_revision = revision ADD completions :one',
+            # a unit added since the update that reached zero keeps the case open
+            ConditionExpression='pending = :zero AND (attribute_not_exists(completed_revision) '
+                                'OR completed_revision <> revision)',
+            ExpressionAttributeValues={':now': {'S': now}, ':one': {'N': '1'}, ':zero': {'N': '0'}},
+            ReturnValues='ALL_NEW',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+        item = response['Attributes']
+    except dynamodb.exceptions.ConditionalCheckFailedException as e:
+        item = e.response.get('Item', {})
+        # completed at this revision, but the event may not have been sent
+        if not (item.get('pending', {}).get('N') == '0'
+                and 'completed_revision' in item
+                and item['completed_revision'] == item.get('revision')
+                and item.get('notified_revision') != item['revision']):
+            return None
+
+    detail = {
+        'case_id': case_id,
+        'completion': int(item['completions']['N']),
+        'completed_at': item['completed_at']['S'],
+        **{name: int(item[name]['N']) if name in item else 0 for name in COUNTERS}
+    }
+    result = events.put_events(Entries=[{
+        'Source': EVENT_SOURCE,
+        'DetailType': CASE_COMPLETED,
+        'Detail': json.dumps(detail),
+        'EventBusName': CASE_EVENT_BUS_NAME
+    }])
+    if result.get('FailedEntryCount'):
+        raise CaseProgressError(f"CaseCompleted event of case {case_id} was not sent: {result['Entries']}")
+
+    try:
+        dynamodb.update_item(
+            TableName=CASE_PROGRESS_TABLE_NAME,
+            Key={'case_id': {'S': case_id}},
+            UpdateExpression='SET notified_revision = :revision',
+            ConditionExpression='revision = :revision',
+            ExpressionAttributeValues={':revision': item['completed_revision']}
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        # the case was reopened meanwhile, its next completion sends the next event
+        pass
+    logger.info(f"Case {case_id} completed", extra=detail)
+    return detail
@@ -0,0 +1,89 @@
+"""
+Claim checks for the SQS messages between the guidance Lambda functions, part of the AWSClientsLayer.
+
+A payload larger than CLAIM_CHECK_THRESHOLD_BYTES is written to S3 under a key derived
+from its SHA-256, compressed like the other artifacts, and the message carries a small
+pointer instead. The same payload is written once per invocation, however many messages
+refer to it, and a consumer only reads it from S3 when it resolves the pointer.
+
+    body = claim_check.dumps(message, bucket)          # the message, or a pointer to it
+    message = claim_check.loads(record['body'])        # reads the message back when needed
+
+    message['report'] = claim_check.offload(report, bucket)
+    report = claim_check.resolve(message['report'])    # cached for the invocation
+
+Handlers call clear_cache() at the start of an invocation. The objects are kept under
+CLAIM_CHECK_PREFIX, which the bucket expires after the retention of the queues.
+"""
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, Optional, Union
+
+import artifacts
+
+CLAIM_CHECK_THRESHOLD_BYTES = int(os.environ.get('CLAIM_CHECK_THRESHOLD_BYTES', str(32 * 1024)))
+CLAIM_CHECK_PREFIX = 'claim-checks/'
+POINTER_KEY = '_claim_check'
+
+_lock = threading.Lock()
+# payloads of the current invocation by (bucket, key), written or read
+_cache: Dict[tuple, str] = {}
+
+
+def clear_cache() -> None:
+    """Forget the payloads of the previous invocation."""
+    with _lock:
+        _cache.clear()
+
+
+def is_claim_check(value: Any) -> bool:
+    return isinstance(value, dict) and POINTER_KEY in value
+
+
+def offload(text: str, bucket: str, threshold: Optional[int] = None) -> Union[str, Dict]:
+    """Return the text, or a pointer to it when its UTF-8 encoding is larger than the threshold."""
+    data = text.encode('utf-8')
+    if len(data) <= (CLAIM_CHECK_THRESHOLD_BYTES if threshold is None else threshold):
+        return text
+    digest = hashlib.sha256(data).hexdigest()
+    key = f"{CLAIM_CHECK_PREFIX}{digest}"
+    with _lock:
+        stored = (bucket, key) in _cache
+    # the key is the hash of the content, writing it again would store the same object
+    if not stored:
+        artifacts.put_text(bucket, key, text)
+        with _lock:
+            _cache[(bucket, key)] = text
+    return {POINTER_KEY: {'bucket': bucket, 'key': key, 'bytes': len(data), 'sha256': digest}}
+
+
+def resolve(value: Union[str, Dict, Any]) -> Any:
+    """Return the text a pointer refers to, any other value unchanged."""
+    if not is_claim_check(value):
+        return value
+    pointer = value[POINTER_KEY]
+    cache_key = (pointer['bucket'], pointer['key'])
+    with _lock:
+        text = _cache.get(cache_key)
+    if text is None:
+        text = artifacts.get_text(pointer['bucket'], pointer['key'])
+        with _lock:
+            _cache[cache_key] = text
+    return text
+
+
+def dumps(payload: Any, bucket: str, threshold: Optional[int] = None) -> str:
+    """Serialize a message body, replaced by a pointer when it is larger than the threshold."""
+    body = json.dumps(payload)
+    offloaded = offload(body, bucket, threshold)
+    return body if offloaded is body else json.dumps(offloaded)
+
+
+def loads(body: str) -> Any:
+    """Parse a message body written by dumps()."""
+    payload = json.loads(body)
+    if is_claim_check(payload):
+        return json.loads(resolve(payload))
+    return payload
@@ -0,0 +1,178 @@
+"""
+Stage status of the Textract jobs of the guidance pipeline, part of the AWSClientsLayer.
+
+The IDP_TEXTRACT_JOBS_TABLE_NAME table has one item per job, written by s3_event_handler
+and updated by the later stages with the epoch milliseconds at which they finished:
+
+    s3_event_handler    job_status TEXTRACT, started_at
+    classification      job_status CLASSIFIED, textract_completed_at, classified_at, page_count,
+                        document_count and a documents map with an entry per classified document
+    analysis            documents.<name>.analysis ANALYZED, NO_JSON or FAILED and analyzed_at
+    validation          documents.<name>.validation PASSED, FAILED, ERROR or NOT_VALIDATED and validated_at
+
+The update that finishes the last document of a job sets job_status COMPLETED and
+completed_at. Every update sets a fixed attribute, so a redelivered message writes the
+same status again instead of counting twice. The case_number-started_at-index lists the
+jobs of a case, see case_status_handler. Without IDP_TEXTRACT_JOBS_TABLE_NAME the stages
+are not recorded.
+"""
+import logging
+import os
+import time
+from decimal import Decimal
+from typing import Any, Dict, Iterable, Optional
+
+from aws_clients import lazy_client
+
+logger = logging.getLogger(__name__)
+
+JOBS_TABLE_NAME = os.environ.get('IDP_TEXTRACT_JOBS_TABLE_NAME')
+CASE_INDEX_NAME = 'case_number-started_at-index'
+
+# job_status of the item
+TEXTRACT = 'TEXTRACT'
+CLASSIFIED = 'CLASSIFIED'
+COMPLETED = 'COMPLETED'
+# analysis of a document without a validation to wait for
+UNVALIDATED_ANALYSIS = ('NO_JSON', 'FAILED')
+
+dynamodb = lazy_client('dynamodb')
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def document_name(key: str) -> str:
+    """The name of a document in its job, <class>/pages_<indexes> of <case>/<job>/<class>/pages_<indexes>.<ext>."""
+    name = '/'.join(key.split('/')[2:]) or key
+    return os.path.splitext(name)[0]
+
+
+def from_dynamo(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a DynamoDB item to Python values, numbers become int or float."""
+    from boto3.dynamodb.types import TypeDeserializer
+    deserializer = TypeDeserializer()
+
+    def plain(value: Any) -> Any:
+        if isinstance(value, dict):
+            return {k: plain(v) for k, v in value.items()}
+        if isinstance(value, (list, set)):
+            return [plain(v) for v in value]
+        if isinstance(value, Decimal):
+            return int(value) if value == value.to_integral_value() else float(value)
+        return value
+
+    return {k: plain(deserializer.deserialize(v)) for k, v in item.items()}
+
+
+def is_finished(document: Dict[str, Any]) -> bool:
+    """Whether a document of the documents map needs no further stage."""
+    return 'validated_at' in document or document.get('analysis') in UNVALIDATED_ANALYSIS
+
+
+def record_classification(job_id: str, textract_completed_at: Optional[int], page_count: int,
+                          document_keys: Iterable[str]) -> None:
+    """
+    Record the classification of a job and the documents it was split into.
+
+    Args:
+        job_id: The Textract job ID
+        textract_completed_at: Epoch milliseconds of the Textract completion notification
+        page_count: Pages of the job
+        document_keys: The doc_text_s3key of each classified document
+    """
+    if not JOBS_TABLE_NAME:
+        return
+    documents = {document_name(key): {'M': {}} for key in document_keys}
+    now = now_ms()
+    # a job without documents has nothing left to wait for
+    status = CLASSIFIED if documents else COMPLETED
+    values = {
+        ':status': {'S': status},
+        ':textract': {'S': TEXTRACT},
+        ':now': {'N': str(now)},
+        ':pages': {'N': str(page_count)},
+        ':count': {'N': str(len(documents))},
+        ':documents': {'M': documents}
+    }
+    expression = ('SET job_status = :status, classified_at = :now, page_count = :pages, '
+                  'document_count = :count, documents = :documents')
+    if textract_completed_at:
+        expression += ', textract_completed_at = :textract_completed_at'
+        values[':textract_completed_at'] = {'N': str(textract_completed_at)}
+    if not documents:
+        expression += ', completed_at = :now'
+    try:
+        dynamodb.update_item(
+            TableName=JOBS_TABLE_NAME,
+            Key={'job_id': {'S': job_id}},
+            UpdateExpression=expression,
+            # a redelivered notification must not reset the documents of a job in progress
+            ConditionExpression='job_status = :textract',
+            ExpressionAttributeValues=values
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        logger.info(f"Classification of job {job_id} was already recorded")
+
+
+def record_document(job_id: str, key: str, **fields: Any) -> Optional[Dict[str, Any]]:
+    """
+    Set fields of a document in the documents map of its job, and complete the job
+    when every document is finished.
+
+    Args:
+        job_id: The Textract job ID
+        key: The S3 key of the document text or JSON
+        fields: Values of the document entry, e.g. analysis='ANALYZED', analyzed_at=<epoch ms>
+
+    Returns:
+        Optional[Dict]: The job item after the update, None when the job or document is not tracked
+    """
+    if not JOBS_TABLE_NAME or not job_id:
+        return None
+    from boto3.dynamodb.types import TypeSerializer
+    serializer = TypeSerializer()
+    names = {'#document': document_name(key)}
+    values = {}
+    assignments = []
+    for index, (field, value) in enumerate(fields.items()):
+        names[f"#f{index}"] = field
+        values[f":v{index}"] = serializer.serialize(value)
+        assignments.append(f"documents.#document.#f{index} = :v{index}")
+    try:
+        response = dynamodb.update_item(
+            TableName=JOBS_TABLE_NAME,
+            Key={'job_id': {'S': job_id}},
+            UpdateExpression=f"SET {', '.join(assignments)}",
+            ConditionExpression='attribute_exists(documents.#document)',
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues='ALL_NEW'
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        logger.warning(f"Document {names['#document']} is not part of job {job_id}")
+        return None
+
+    item = from_dynamo(response['Attributes'])
+    if item.get('job_status') == CLASSIFIED and all(is_finished(d) for d in item.get('documents', {}).values()):
+        complete(job_id)
+    return item
+
+
+def complete(job_id: str) -> None:
+    """Mark a classified job COMPLETED, once."""
+    try:
+        dynamodb.update_item(
+            TableName=JOBS_TABLE_NAME,
+            Key={'job_id': {'S': job_id}},
+            UpdateExpression='SET job_status = :completed, completed_at = :now',
+            ConditionExpression='job_status = :classified',
+            ExpressionAttributeValues={
+                ':completed': {'S': COMPLETED},
+                ':classified': {'S': CLASSIFIED},
+                ':now': {'N': str(now_ms())}
+            }
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        pass
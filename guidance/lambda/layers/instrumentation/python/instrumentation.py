@@ -0,0 +1,128 @@
+"""
+Timing spans for the guidance Lambda functions, deployed as the InstrumentationLayer.
+
+A span times a block or a function and writes one CloudWatch embedded metric format
+(EMF) line to stdout when it ends. CloudWatch Logs turns the line into a Duration
+metric with the Service and Operation dimensions. The case_id and job_id of the
+invocation are added as properties, not dimensions, so they can be queried in Logs
+Insights without creating a metric per case:
+
+    from instrumentation import handler_span, set_trace, span, timed
+
+    @handler_span('Classification')
+    def lambda_handler(event, context):
+        set_trace(case_id=case_id, job_id=job_id)
+        with span('Textract.GetDocumentAnalysis', pages=10):
+            ...
+
+    @timed('S3.PutObject')
+    def save_to_s3(...):
+        ...
+
+The Textract job start time is passed from stage to stage with the messages, so
+the validation stage reports the EndToEndLatency of a job without extra calls:
+
+    filter Operation = 'EndToEndLatency' | stats max(EndToEndLatency) by case_id, job_id
+"""
+import contextvars
+import functools
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'IDPGuidance')
+SERVICE = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+
+_trace: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar('trace', default={})
+
+
+def write_stdout(record: Dict[str, Any]) -> None:
+    sys.stdout.write(json.dumps(record, default=str) + "\n")
+
+
+# Called with every EMF record, replace e.g. to collect the records in tests
+sinks: List[Callable[[Dict[str, Any]], None]] = [write_stdout]
+
+
+def set_trace(**fields: Any) -> None:
+    """Add case_id, job_id or other properties to every record of the current invocation, None removes one."""
+    trace = {**_trace.get(), **fields}
+    _trace.set({key: value for key, value in trace.items() if value is not None})
+
+
+def get_trace() -> Dict[str, Any]:
+    return dict(_trace.get())
+
+
+def now_ms() -> int:
+    """Epoch milliseconds, the format of the timestamps passed between the stages."""
+    return int(time.time() * 1000)
+
+
+def emit_metric(name: str, value: float, unit: str = 'Milliseconds', operation: Optional[str] = None,
+                **properties: Any) -> Dict[str, Any]:
+    """Write a single EMF metric with the trace of the current invocation."""
+    record = {
+        '_aws': {
+            'Timestamp': now_ms(),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['Service', 'Operation']],
+                'Metrics': [{'Name': name, 'Unit': unit}]
+            }]
+        },
+        'Service': SERVICE,
+        'Operation': operation or name,
+        name: value,
+        **get_trace(),
+        **properties
+    }
+    for sink in sinks:
+        sink(record)
+    return record
+
+
+@contextmanager
+def span(operation: str, **properties: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Time the block and emit its Duration. Properties added to the yielded dict
+    while the block runs are written with the record.
+    """
+    extra: Dict[str, Any] = dict(properties)
+    start = time.perf_counter()
+    status = 'Success'
+    try:
+        yield extra
+    except BaseException as e:
+        status = 'Error'
+        extra.setdefault('error_type', type(e).__name__)
+        raise
+    finally:
+        duration = round((time.perf_counter() - start) * 1000, 3)
+        emit_metric('Duration', duration, operation=operation, status=status, **extra)
+
+
+def timed(operation: str) -> Callable:
+    """Decorator running the function in a span."""
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(operation):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def handler_span(stage: str) -> Callable:
+    """Decorator for a lambda_handler, starts an empty trace and times the invocation."""
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(event, context):
+            _trace.set({'stage': stage})
+            with span(f"{stage}.Invocation"):
+                return function(event, context)
+        return wrapper
+    return decorator
@@ -1,24 +1,30 @@
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import urllib.parse
 import os
-import boto3
-from boto3.dynamodb.types import TypeSerializer
+import re
 from datetime import datetime
 import logging
 import traceback
+from aws_clients import lazy_client
+import case_progress
+import job_status
+from instrumentation import handler_span, set_trace, now_ms, span, timed
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-s3 = boto3.client('s3')
-textract = boto3.client('textract')
-dynamodb = boto3.client('dynamodb')
+textract = lazy_client('textract')
+dynamodb = lazy_client('dynamodb')
 
 TEXTRACT_NOTIFICATION_TOPIC_ARN = os.environ['TEXTRACT_NOTIFICATION_TOPIC_ARN']
 TEXTRACT_NOTIFICATION_ROLE_ARN = os.environ['TEXTRACT_NOTIFICATION_ROLE_ARN']
 IDP_TEXTRACT_JOBS_TABLE_NAME = os.environ['IDP_TEXTRACT_JOBS_TABLE_NAME']
+# Textract rejects these documents on every attempt, retrying the event cannot start the job
+NON_RETRYABLE_TEXTRACT_ERRORS = ('InvalidS3ObjectException', 'UnsupportedDocumentException', 'BadDocumentException',
+	'DocumentTooLargeException', 'InvalidParameterException')
 
+@handler_span('S3Event')
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 	"""
 	AWS Lambda handler function to process S3 events and initiate Textract analysis.
@@ -36,9 +42,28 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 		object_key = urllib.parse.unquote_plus(event['detail']['object']['key'], encoding='utf-8')
 
 		case_number = object_key.split('/')[0]  # expecting case_id/files path structure
-
-		textract_response = start_textract_analysis(bucket_name, object_key)
-		dynamo_result = save_job_to_dynamodb(textract_response['JobId'], case_number, object_key, bucket_name)
+		set_trace(case_id=case_number)
+
+		# the job is pending work of the case until it is classified, registered before Textract can finish it.
+		# the id of the EventBridge event is the same when the invocation is retried
+		event_id = event.get('id')
+		progress_token = f"start:{event_id or object_key}"
+		with span('CaseProgress.Advance'):
+			case_progress.advance(case_number, progress_token, 1, jobs=1)
+
+		# the start time travels with the job to the validation stage, which reports the end-to-end latency
+		started_at = now_ms()
+		try:
+			textract_response = start_textract_analysis(bucket_name, object_key, event_id)
+		except Exception as e:
+			code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+			if code in NON_RETRYABLE_TEXTRACT_ERRORS:
+				# the job will never run, its unit of case work is finished here so the case can complete
+				with span('CaseProgress.Advance'):
+					case_progress.advance(case_number, f"rejected:{event_id or object_key}", -1, failed=1)
+			raise
+		set_trace(job_id=textract_response['JobId'])
+		dynamo_result = save_job_to_dynamodb(textract_response['JobId'], case_number, object_key, bucket_name, started_at)
 
 		return dynamo_result
 	except Exception as e:
@@ -56,48 +81,71 @@ def python_to_dynamo(python_object: Dict[str, Any]) -> Dict[str, Any]:
 	Returns:
 		Dict[str, Any]: The DynamoDB-compatible dictionary.
 	"""
+	# boto3 is imported with the first client, not with the handler module
+	from boto3.dynamodb.types import TypeSerializer
 	serializer = TypeSerializer()
 	return {k: serializer.serialize(v) for k, v in python_object.items()}
 
-def start_textract_analysis(bucket_name: str, object_key: str) -> Dict[str, Any]:
+@timed('Textract.StartDocumentAnalysis')
+def start_textract_analysis(bucket_name: str, object_key: str, event_id: Optional[str] = None) -> Dict[str, Any]:
 	"""
 	Start a Textract document analysis job for a given S3 object.
 
 	Args:
 		bucket_name (str): The name of the S3 bucket containing the document.
 		object_key (str): The key of the S3 object to analyze.
+		event_id (Optional[str]): The id of the EventBridge event, the same when the invocation is retried.
 
 	Returns:
 		Dict[str, Any]: The response from the Textract start_document_analysis API call.
 	"""
+	arguments = {}
+	if event_id:
+		# a retried event gets the JobId of the job it already started instead of a second job
+		arguments['ClientRequestToken'] = re.sub(r'[^a-zA-Z0-9_-]', '-', event_id)[:64]
 	return textract.start_document_analysis(
 		DocumentLocation={'S3Object': {'Bucket': bucket_name, 'Name': object_key}},
 		FeatureTypes=['LAYOUT'],
 		NotificationChannel={
 			'SNSTopicArn': TEXTRACT_NOTIFICATION_TOPIC_ARN,
 			'RoleArn': TEXTRACT_NOTIFICATION_ROLE_ARN
-		}
+		},
+		**arguments
 	)
 
-def save_job_to_dynamodb(job_id: str, case_number: str, object_key: str, bucket_name: str) -> Dict[str, Any]:
+@timed('DynamoDB.PutItem')
+def save_job_to_dynamodb(job_id: str, case_number: str, object_key: str, bucket_name: str, started_at: int) -> Optional[Dict[str, Any]]:
 	"""
-	Save Textract job information to DynamoDB.
+	Save Textract job information to DynamoDB, once per job. A retried event gets the JobId
+	of the job it already started, whose item may have moved on to a later stage.
 
 	Args:
 		job_id (str): The Textract job ID.
 		case_number (str): The case number associated with the document.
 		object_key (str): The S3 object key of the document.
 		bucket_name (str): The name of the S3 bucket containing the document.
+		started_at (int): Epoch milliseconds at which the Textract job was started.
 
 	Returns:
-		Dict[str, Any]: The response from the DynamoDB put_item operation.
+		Optional[Dict[str, Any]]: The response from the DynamoDB put_item operation, None when the job was already recorded.
 	"""
 	item = {
 		'job_id': job_id,
 		'case_number': case_number,
 		'object_key': object_key,
 		'bucket_name': bucket_name,
-		'processed_date': datetime.now().isoformat()
+		'processed_date': datetime.now().isoformat(),
+		'started_at': started_at,
+		# the later stages record their status and timestamps in the same item, see job_status.py
+		'job_status': job_status.TEXTRACT
 	}
 	dynamo_item = python_to_dynamo(item)
-	return dynamodb.put_item(TableName=IDP_TEXTRACT_JOBS_TABLE_NAME, Item=dynamo_item)
+	try:
+		return dynamodb.put_item(
+			TableName=IDP_TEXTRACT_JOBS_TABLE_NAME,
+			Item=dynamo_item,
+			ConditionExpression='attribute_not_exists(job_id)'
+		)
+	except dynamodb.exceptions.ConditionalCheckFailedException:
+		logger.info(f"Job {job_id} was already recorded")
+		return None
@@ -0,0 +1,757 @@
+"""
+Runs the guidance pipeline locally, with the four Lambda handlers in one process.
+
+S3, SQS and DynamoDB are provided by moto. Textract and the Bedrock prompt flows are
+replaced by stubs that sleep for a configurable latency:
+- The Textract job notifies the classify queue once its job time has passed.
+- The classification flow returns the classes of the pages from the corpus.
+- The analysis flows write the extracted JSON next to the document text, like the
+  Storage node of the deployed flows.
+- The CaseCompleted events of the case progress counter are recorded instead of
+  being sent to EventBridge.
+
+Every document of the corpus is uploaded and passed to s3_event_handler. The
+classification, analysis and validation handlers are invoked by worker threads that
+poll their queues, one message per invocation like the SQS event sources of the
+template.
+
+The report lists the latency of each stage and the time its messages waited in the
+queue. Overhead is the stage latency minus the time spent in the stubs. It also
+lists the end-to-end latency of the documents, the documents per second and the
+durations of the instrumentation spans of the handlers. --check fails unless every case
+completed exactly once and the case status API reports it and all of its jobs COMPLETED.
+
+    pip install "moto[s3,sqs,dynamodb]"  # plus the handler requirements, textractor and aws-lambda-powertools
+    python local_pipeline.py --cases 20 --concurrency 4
+    python local_pipeline.py --corpus corpus.json --textract-latency 5 --flow-latency 2
+    python local_pipeline.py --check        # exit 1 on errors or when a stage overhead exceeds its budget
+    python local_pipeline.py --claim-check-threshold 0   # send every payload through S3 claim checks
+    python local_pipeline.py --compact      # compact the validated documents into Parquet at the end
+
+A corpus file is a list of cases:
+
+    [{"case_id": "case0001",
+      "fields": {"DRIVERS_LICENSE": {...extracted JSON...}, "URLA_1003": {...}},
+      "documents": [{"name": "application.pdf", "pages": [{"class": "URLA_1003", "text": "..."}]}]}]
+"""
+import argparse
+import importlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+GUIDANCE_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(GUIDANCE_DIR, 'lambda')
+LAYER_DIRS = [os.path.join(LAMBDA_DIR, 'layers', layer, 'python') for layer in ('aws_clients', 'instrumentation')]
+REGION = 'us-east-1'
+
+SOURCE_BUCKET = 'local-idp-source'
+DESTINATION_BUCKET = 'local-idp-destination'
+JOBS_TABLE = 'local-IDP_TEXTRACT_JOBS'
+CLASSES_TABLE = 'local-IDP_CLASS_LIST'
+CASE_VALIDATION_TABLE = 'local-IDP_CASE_VALIDATION'
+CASE_PROGRESS_TABLE = 'local-IDP_CASE_PROGRESS'
+QUEUES = ['classify_queue', 'analyze_queue', 'validation_queue']
+SUPPORTED_CLASSES = ['BANK_STATEMENT', 'DRIVERS_LICENSE', 'URLA_1003', 'FOR_REVIEW']
+
+# stage name, handler directory and the queue it polls, in pipeline order
+STAGES = [
+    ('s3_event', 's3_event_handler', None),
+    ('classification', 'doc_classification_flow_handler', 'classify_queue'),
+    ('analysis', 'doc_analysis_flow_handler', 'analyze_queue'),
+    ('validation', 'doc_validation_handler', 'validation_queue'),
+]
+
+# p95 of the stage latency minus the time spent in the stubs, in milliseconds. Measured with the
+# defaults on a developer machine, most of the overhead is moto serving the calls in-process.
+OVERHEAD_P95_BUDGETS_MS = {
+    's3_event': 150,
+    'classification': 500,
+    'analysis': 1000,
+    'validation': 600,
+}
+
+POLL_INTERVAL_SECONDS = 0.05
+
+_stub_time = threading.local()
+
+
+def simulate_latency(seconds: float) -> None:
+    """Sleep in place of a stubbed service and account the time to the calling handler."""
+    if seconds > 0:
+        time.sleep(seconds)
+    _stub_time.seconds = getattr(_stub_time, 'seconds', 0.0) + seconds
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile, None for no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def generate_corpus(cases: int, seed: int = 7) -> List[Dict]:
+    """Build cases with an application (URLA pages followed by a drivers license) and a bank statement."""
+    rng = random.Random(seed)
+    first_names = ['John', 'Maria', 'Wei', 'Aisha', 'Carlos', 'Emma', 'Noah', 'Priya']
+    last_names = ['Doe', 'Garcia', 'Chen', 'Khan', 'Silva', 'Miller', 'Brown', 'Patel']
+    streets = ['Main Street', 'Oak Avenue', 'Pine Road', 'Maple Drive', 'Cedar Lane']
+    filler = ('amount balance income employer address borrower lender property loan account '
+              'statement payment deposit withdrawal license issued expires class restrictions').split()
+
+    corpus = []
+    for number in range(1, cases + 1):
+        case_id = f"case{number:04d}"
+        first, last = rng.choice(first_names), rng.choice(last_names)
+        birth = f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/{rng.randint(1950, 2000)}"
+        street = f"{rng.randint(1, 9999)} {rng.choice(streets)}"
+        zip_code = f"{rng.randint(10000, 99999)}"
+
+        def page(class_name: str, document: str, index: int) -> Dict:
+            words = " ".join(rng.choice(filler) for _ in range(250))
+            return {'class': class_name, 'text': f"{class_name} {document} page {index} of {case_id}\n{words}\n"}
+
+        corpus.append({
+            'case_id': case_id,
+            'fields': {
+                'DRIVERS_LICENSE': {
+                    'document_type': 'DRIVER LICENSE',
+                    'expiration_date': '01/31/2031',
+                    'license_number': f"D{rng.randint(1000000, 9999999)}",
+                    'first_name': first,
+                    'last_name': last,
+                    'address': {'street': street, 'city': 'Springfield', 'state': 'IL', 'zip_code': zip_code},
+                    'date_of_birth': birth
+                },
+                'URLA_1003': {
+                    'applicant': {
+                        'fullName': f"{first} {last}",
+                        'ssn': '000-00-0000',
+                        'dateOfBirth': birth,
+                        'currentAddress': {'street': street, 'city': 'Springfield', 'state': 'IL', 'zip': zip_code}
+                    },
+                    'employmentInfo': [{'employerName': 'Example Corp', 'monthlyIncome': rng.randint(3000, 15000)}]
+                },
+                'BANK_STATEMENT': {'account_holder': f"{first} {last}", 'closing_balance': rng.randint(100, 50000)}
+            },
+            'documents': [
+                {'name': 'application.pdf',
+                 'pages': [page('URLA_1003', 'application', index) for index in range(3)]
+                 + [page('DRIVERS_LICENSE', 'application', 3)]},
+                {'name': 'bank-statement.pdf',
+                 'pages': [page('BANK_STATEMENT', 'bank-statement', index) for index in range(2)]},
+            ]
+        })
+    return corpus
+
+
+class LambdaContext:
+    """The attributes of the Lambda context object the handlers and powertools read."""
+
+    def __init__(self, function_name: str):
+        self.function_name = function_name
+        self.function_version = '$LATEST'
+        self.memory_limit_in_mb = 128
+        self.invoked_function_arn = f"arn:aws:lambda:{REGION}:123456789012:function:{function_name}"
+        self.aws_request_id = str(uuid.uuid4())
+
+    def get_remaining_time_in_millis(self) -> int:
+        return 60000
+
+
+class StubPage:
+    def __init__(self, page_num: int, text: str):
+        self.page_num = page_num
+        self.text = text
+
+    def get_text(self) -> str:
+        return self.text
+
+
+class StubDocument:
+    """Stands in for the textractor LazyDocument of a completed job."""
+
+    def __init__(self, pages: List[StubPage]):
+        self.pages = pages
+
+
+class AtomicUpdates:
+    """
+    A DynamoDB client whose update_item and transact_write_items calls run one at a time.
+    DynamoDB applies each update atomically, moto reads and writes the item without a lock
+    and loses concurrent updates.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+
+    def update_item(self, **kwargs) -> Dict:
+        with self.lock:
+            return self.client.update_item(**kwargs)
+
+    def transact_write_items(self, **kwargs) -> Dict:
+        with self.lock:
+            return self.client.transact_write_items(**kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.client, name)
+
+
+def flow_response(document: str) -> Dict:
+    return {'responseStream': [
+        {'flowOutputEvent': {'content': {'document': document}}},
+        {'flowCompletionEvent': {'completionReason': 'SUCCESS'}}
+    ]}
+
+
+class StubServices:
+    """Textract and the prompt flows, backed by the corpus."""
+
+    def __init__(self, harness: 'LocalPipeline', textract_latency: float, textract_page_latency: float,
+                 api_latency: float, flow_latency: float):
+        self.harness = harness
+        self.textract_latency = textract_latency
+        self.textract_page_latency = textract_page_latency
+        self.api_latency = api_latency
+        self.flow_latency = flow_latency
+        self.jobs: Dict[str, Dict] = {}
+        self.page_classes: Dict[str, str] = {}
+        self.request_tokens: Dict[str, str] = {}
+        self.timers: List[threading.Timer] = []
+        self.lock = threading.Lock()
+
+    # Textract, called by s3_event_handler and doc_classification_flow_handler
+    def start_document_analysis(self, DocumentLocation: Dict, NotificationChannel: Dict, **kwargs) -> Dict:
+        simulate_latency(self.api_latency)
+        bucket = DocumentLocation['S3Object']['Bucket']
+        key = DocumentLocation['S3Object']['Name']
+        document = self.harness.documents[key]
+        # like Textract, a retried request with the same ClientRequestToken returns the job it started
+        token = kwargs.get('ClientRequestToken')
+        with self.lock:
+            if token and token in self.request_tokens:
+                return {'JobId': self.request_tokens[token]}
+            job_id = uuid.uuid4().hex
+            if token:
+                self.request_tokens[token] = job_id
+            self.jobs[job_id] = document
+        document['job_id'] = job_id
+        job_seconds = self.textract_latency + self.textract_page_latency * len(document['pages'])
+        timer = threading.Timer(job_seconds, self.harness.notify_job_completed, (job_id, bucket, key))
+        timer.daemon = True
+        with self.lock:
+            self.timers.append(timer)
+        timer.start()
+        return {'JobId': job_id}
+
+    def load_textract_job(self, job_id: str) -> StubDocument:
+        simulate_latency(self.api_latency)
+        pages = self.jobs[job_id]['pages']
+        return StubDocument([StubPage(index + 1, page['text']) for index, page in enumerate(pages)])
+
+    # bedrock-agent-runtime, the classification flow and the per class analysis flows
+    def invoke_flow(self, flowIdentifier: str, flowAliasIdentifier: str, inputs: List[Dict]) -> Dict:
+        simulate_latency(self.flow_latency)
+        document = inputs[0]['content']['document']
+        if flowIdentifier == 'local-classify':
+            return self.classify(document['doc_text'])
+        return self.analyze(flowIdentifier[len('local-'):], document)
+
+    def classify(self, doc_text: str) -> Dict:
+        manifest = []
+        for index, text in re.findall(r'<page-index>(\d+)</page-index>\n<page-content>\n(.*?)</page-content>',
+                                      doc_text, re.DOTALL):
+            class_name = self.page_classes.get(text, 'FOR_REVIEW')
+            if manifest and manifest[-1]['class'] == class_name and manifest[-1]['page-indexes'][-1] + 1 == int(index):
+                manifest[-1]['page-indexes'].append(int(index))
+            else:
+                manifest.append({'class': class_name, 'page-indexes': [int(index)]})
+        return flow_response(f"<json>\n{json.dumps(manifest)}</json>")
+
+    def analyze(self, class_name: str, document: Dict) -> Dict:
+        s3 = self.harness.s3
+        s3.get_object(Bucket=DESTINATION_BUCKET, Key=document['doc_text_s3key'])['Body'].read()
+        fields = self.harness.case_fields.get(document['case_id'], {}).get(class_name)
+        if fields is not None:
+            s3.put_object(Bucket=DESTINATION_BUCKET, Key=document['JSON_s3key'],
+                          Body=json.dumps(fields).encode('utf-8'))
+        return flow_response(f"{class_name} analysis of {document['doc_text_s3key']}: no issues found")
+
+    # EventBridge, called by case_progress when a case completes
+    def put_events(self, Entries: List[Dict]) -> Dict:
+        with self.lock:
+            self.harness.case_events.extend(json.loads(entry['Detail']) for entry in Entries)
+        return {'FailedEntryCount': 0, 'Entries': [{'EventId': uuid.uuid4().hex} for _ in Entries]}
+
+
+class LocalPipeline:
+    """Creates the resources of the template in moto, loads the handlers and runs a corpus through them."""
+
+    def __init__(self, stubs_config: Dict[str, float], concurrency: int):
+        import boto3
+        self.concurrency = concurrency
+        self.s3 = boto3.client('s3', region_name=REGION)
+        self.sqs = boto3.client('sqs', region_name=REGION)
+        self.dynamodb = boto3.client('dynamodb', region_name=REGION)
+        self.stubs = StubServices(self, **stubs_config)
+        self.documents: Dict[str, Dict] = {}
+        self.case_fields: Dict[str, Dict] = {}
+        self.queue_urls: Dict[str, str] = {}
+        self.samples: Dict[str, List[Dict]] = {stage: [] for stage, _, _ in STAGES}
+        self.completed_at: Dict[str, float] = {}
+        self.case_events: List[Dict] = []
+        self.metrics: Dict[str, List[float]] = {}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.stop = threading.Event()
+        self.handlers = {}
+
+    def create_resources(self) -> None:
+        for bucket in (SOURCE_BUCKET, DESTINATION_BUCKET):
+            self.s3.create_bucket(Bucket=bucket)
+        for queue in QUEUES:
+            self.queue_urls[queue] = self.sqs.create_queue(
+                QueueName=queue, Attributes={'VisibilityTimeout': '600'})['QueueUrl']
+        # the jobs table with the case index of the template
+        self.dynamodb.create_table(
+            TableName=JOBS_TABLE,
+            KeySchema=[{'AttributeName': 'job_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'job_id', 'AttributeType': 'S'},
+                                  {'AttributeName': 'case_number', 'AttributeType': 'S'},
+                                  {'AttributeName': 'started_at', 'AttributeType': 'N'}],
+            GlobalSecondaryIndexes=[{
+                'IndexName': 'case_number-started_at-index',
+                'KeySchema': [{'AttributeName': 'case_number', 'KeyType': 'HASH'},
+                              {'AttributeName': 'started_at', 'KeyType': 'RANGE'}],
+                'Projection': {'ProjectionType': 'ALL'}}],
+            BillingMode='PAY_PER_REQUEST')
+        # the case validation table with the updated_hour index of the template
+        self.dynamodb.create_table(
+            TableName=CASE_VALIDATION_TABLE,
+            KeySchema=[{'AttributeName': 'case_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'case_id', 'AttributeType': 'S'},
+                                  {'AttributeName': 'updated_hour', 'AttributeType': 'S'},
+                                  {'AttributeName': 'updated_at', 'AttributeType': 'S'}],
+            GlobalSecondaryIndexes=[{
+                'IndexName': 'updated_hour-updated_at-index',
+                'KeySchema': [{'AttributeName': 'updated_hour', 'KeyType': 'HASH'},
+                              {'AttributeName': 'updated_at', 'KeyType': 'RANGE'}],
+                'Projection': {'ProjectionType': 'INCLUDE',
+                               'NonKeyAttributes': ['documents', 'case_status', 'cross_document_status']}}],
+            BillingMode='PAY_PER_REQUEST')
+        for table, key in ((CLASSES_TABLE, 'class_name'), (CASE_PROGRESS_TABLE, 'case_id')):
+            self.dynamodb.create_table(
+                TableName=table,
+                KeySchema=[{'AttributeName': key, 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'}],
+                BillingMode='PAY_PER_REQUEST')
+        # the rows PopulateIDPClasses writes for the deployed flows
+        for class_name in SUPPORTED_CLASSES:
+            self.dynamodb.put_item(TableName=CLASSES_TABLE, Item={
+                'class_name': {'S': class_name},
+                'flow_name': {'S': f"local-{class_name}"},
+                'expected_inputs': {'S': f"Pages of a {class_name.replace('_', ' ').lower()}"},
+                'flow_id': {'S': f"local-{class_name}"},
+                'flow_alias_id': {'S': 'latest'}
+            })
+
+    def load_handlers(self) -> None:
+        """Import the handler modules with the environment of the template and wire the stubs into them."""
+        os.environ.update({
+            'TEXTRACT_NOTIFICATION_TOPIC_ARN': f"arn:aws:sns:{REGION}:123456789012:local-NotificationTopic",
+            'TEXTRACT_NOTIFICATION_ROLE_ARN': 'arn:aws:iam::123456789012:role/local-NotificationTopicRole',
+            'IDP_TEXTRACT_JOBS_TABLE_NAME': JOBS_TABLE,
+            'IDP_FLOW_CLASS_TABLE_NAME': CLASSES_TABLE,
+            'CASE_VALIDATION_TABLE_NAME': CASE_VALIDATION_TABLE,
+            'CASE_PROGRESS_TABLE_NAME': CASE_PROGRESS_TABLE,
+            'OUTPUT_BUCKET_NAME': DESTINATION_BUCKET,
+            'FLOW_IDENTIFIER': 'local-classify',
+            'FLOW_ALIAS_IDENTIFIER': 'latest',
+            'IN_QUEUE_URL': self.queue_urls['classify_queue'],
+            'OUT_QUEUE_URL': self.queue_urls['analyze_queue'],
+            'QUEUE_URL': self.queue_urls['analyze_queue'],
+            'VALIDATION_QUEUE_URL': self.queue_urls['validation_queue'],
+        })
+        sys.path[:0] = [LAMBDA_DIR] + LAYER_DIRS + [os.path.join(LAMBDA_DIR, directory) for _, directory, _ in STAGES]
+        for stage, directory, _ in STAGES:
+            self.handlers[stage] = importlib.import_module(f"{directory}.app")
+
+        self.handlers['s3_event'].textract = self.stubs
+        self.handlers['classification'].load_textract_job = self.stubs.load_textract_job
+        self.handlers['classification'].bedrock_agent_runtime = self.stubs
+        self.handlers['analysis'].bedrock_agent = self.stubs
+        atomic_dynamodb = AtomicUpdates(self.dynamodb)
+        case_progress = importlib.import_module('case_progress')
+        case_progress.dynamodb = atomic_dynamodb
+        case_progress.events = self.stubs
+        importlib.import_module('job_status').dynamodb = atomic_dynamodb
+        # the embedded metric lines of the handlers are collected instead of printed
+        importlib.import_module('instrumentation').sinks[:] = [self.record_metric]
+
+    def record_metric(self, record: Dict) -> None:
+        name = record['_aws']['CloudWatchMetrics'][0]['Metrics'][0]['Name']
+        with self.lock:
+            self.metrics.setdefault(record['Operation'], []).append(record[name] / 1000)
+
+    def invoke(self, stage: str, event: Dict) -> Any:
+        """Invoke a handler and record its latency and the part of it spent in the stubs."""
+        _stub_time.seconds = 0.0
+        start = time.perf_counter()
+        error = None
+        try:
+            result = self.handlers[stage].lambda_handler(event, LambdaContext(stage))
+        except Exception as e:
+            result, error = None, f"{type(e).__name__}: {e}"
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.samples[stage].append({
+                'seconds': elapsed,
+                'overhead_seconds': elapsed - _stub_time.seconds,
+                'wait_seconds': event.get('_wait_seconds'),
+                'error': error
+            })
+        return result
+
+    def notify_job_completed(self, job_id: str, bucket: str, key: str) -> None:
+        """Publish the Textract completion notification, as SNS delivers it to the classify queue."""
+        message = {'JobId': job_id, 'Status': 'SUCCEEDED', 'API': 'StartDocumentAnalysis',
+                   'Timestamp': int(time.time() * 1000),
+                   'DocumentLocation': {'S3ObjectName': key, 'S3Bucket': bucket}}
+        self.sqs.send_message(QueueUrl=self.queue_urls['classify_queue'],
+                              MessageBody=json.dumps({'Type': 'Notification', 'Message': json.dumps(message)}))
+        with self.lock:
+            self.stubs.timers = [timer for timer in self.stubs.timers if timer.is_alive()
+                                 and timer is not threading.current_thread()]
+
+    def poll(self, stage: str, queue: str) -> None:
+        """Invoke the handler of a stage with one message at a time until the run stops."""
+        queue_url = self.queue_urls[queue]
+        while not self.stop.is_set():
+            # a received message counts as not visible in its queue until it is deleted
+            messages = self.sqs.receive_message(
+                QueueUrl=queue_url, MaxNumberOfMessages=1, AttributeNames=['SentTimestamp']).get('Messages', [])
+            if not messages:
+                time.sleep(POLL_INTERVAL_SECONDS)
+                continue
+            message = messages[0]
+            event = {
+                'Records': [{
+                    'messageId': message['MessageId'],
+                    'receiptHandle': message['ReceiptHandle'],
+                    'body': message['Body'],
+                    'eventSource': 'aws:sqs'
+                }],
+                '_wait_seconds': time.time() - int(message['Attributes']['SentTimestamp']) / 1000
+            }
+            with self.lock:
+                self.in_flight += 1
+            try:
+                self.invoke(stage, event)
+                if stage == 'validation':
+                    self.record_validation(message['Body'])
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+            # the event source mapping deletes the message once the handler returned
+            try:
+                self.sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+            except Exception:
+                pass
+
+    def record_validation(self, body: str) -> None:
+        """A document is complete when the last JSON file of its Textract job was validated."""
+        key = json.loads(body).get('s3_location', {}).get('key', '')
+        parts = key.split('/')
+        if len(parts) > 1:
+            with self.lock:
+                self.completed_at[parts[1]] = time.time()
+
+    def queues_empty(self) -> bool:
+        for queue_url in self.queue_urls.values():
+            attributes = self.sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['All'])['Attributes']
+            if any(int(attributes.get(name, 0)) for name in (
+                    'ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible',
+                    'ApproximateNumberOfMessagesDelayed')):
+                return False
+        return True
+
+    def idle(self) -> bool:
+        with self.lock:
+            pending_jobs = any(timer.is_alive() for timer in self.stubs.timers)
+            in_flight = self.in_flight
+        return not pending_jobs and not in_flight and self.queues_empty()
+
+    def run(self, corpus: List[Dict], rate: float, timeout: float) -> Dict:
+        uploads = []
+        for case in corpus:
+            self.case_fields[case['case_id']] = case.get('fields', {})
+            for document in case['documents']:
+                key = f"{case['case_id']}/{document['name']}"
+                self.documents[key] = {'key': key, 'pages': document['pages']}
+                for page in document['pages']:
+                    self.stubs.page_classes[page['text']] = page['class']
+                uploads.append(key)
+
+        workers = [threading.Thread(target=self.poll, args=(stage, queue), daemon=True)
+                   for stage, _, queue in STAGES if queue for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for index, key in enumerate(uploads):
+                if rate > 0:
+                    time.sleep(max(0.0, started + index / rate - time.time()))
+                executor.submit(self.upload, key)
+
+        deadline = started + timeout
+        while time.time() < deadline:
+            time.sleep(0.5)
+            if self.idle():
+                break
+        self.stop.set()
+        for worker in workers:
+            worker.join()
+        return self.report(started, timed_out=time.time() >= deadline)
+
+    def compact(self) -> Dict:
+        """Run the compaction over every validated document and count the rows of the Parquet files."""
+        import io
+        import pyarrow.parquet as pq
+        os.environ['COMPACTION_SETTLE_SECONDS'] = '0'
+        handler = importlib.import_module('case_compaction_handler.app')
+        # a previous run two hours ago, the compaction queries the updated_hour index instead of the first scan
+        watermark = (datetime.now(timezone.utc) - timedelta(hours=2)).replace(tzinfo=None).isoformat()
+        self.s3.put_object(Bucket=DESTINATION_BUCKET, Key=handler.STATE_KEY,
+                           Body=json.dumps({'watermark': watermark}).encode('utf-8'))
+        start = time.perf_counter()
+        result = handler.lambda_handler({}, LambdaContext('local-CaseCompactionFunction'))
+        seconds = time.perf_counter() - start
+        parquet_rows = 0
+        for key in result['files']:
+            body = self.s3.get_object(Bucket=DESTINATION_BUCKET, Key=key)['Body'].read()
+            parquet_rows += pq.read_table(io.BytesIO(body)).num_rows
+        return {'documents': result['documents'], 'rows': result['rows'], 'files': len(result['files']),
+                'parquet_rows': parquet_rows, 'seconds': round(seconds, 3)}
+
+    def case_statuses(self) -> Dict:
+        """Ask the case status API for every case and summarize the stage latencies it reports."""
+        handler = importlib.import_module('case_status_handler.app')
+        cases = {}
+        for case_id in sorted({key.split('/')[0] for key in self.documents}):
+            response = handler.lambda_handler({'pathParameters': {'case_id': case_id}},
+                                              LambdaContext('local-CaseStatusFunction'))
+            status = json.loads(response['body'])
+            jobs = status.get('jobs', [])
+            cases[case_id] = {
+                'status': status.get('status', response['statusCode']),
+                'jobs': len(jobs),
+                'jobs_completed': sum(1 for job in jobs if job['stage'] == 'COMPLETED'),
+                'pages': status.get('pages'),
+                'documents': status.get('documents'),
+                'latency_ms': status.get('latency_ms', {})
+            }
+        stages = [stage for stage, _, _ in handler.LATENCY_STAGES
+                  if any(stage in case['latency_ms'] for case in cases.values())]
+        return {
+            'cases': cases,
+            'latency_p50_ms': {stage: percentile([case['latency_ms'][stage] for case in cases.values()
+                                                  if stage in case['latency_ms']], 50) for stage in stages}
+        }
+
+    def upload(self, key: str) -> None:
+        document = self.documents[key]
+        document['uploaded_at'] = time.time()
+        self.s3.put_object(Bucket=SOURCE_BUCKET, Key=key, Body=json.dumps(document['pages']).encode('utf-8'))
+        # the EventBridge "Object Created" event of the source bucket
+        self.invoke('s3_event', {'id': uuid.uuid4().hex,
+                                 'detail': {'bucket': {'name': SOURCE_BUCKET}, 'object': {'key': key}}})
+
+    def report(self, started: float, timed_out: bool) -> Dict:
+        def summary(values: List[float]) -> Dict:
+            return {f"p{q}_ms": round(percentile(values, q) * 1000, 1) if values else None for q in (50, 90, 95, 99)} \
+                | {'max_ms': round(max(values) * 1000, 1) if values else None}
+
+        stages = {}
+        for stage, samples in self.samples.items():
+            stages[stage] = {
+                'invocations': len(samples),
+                'errors': sum(1 for sample in samples if sample['error']),
+                'latency': summary([sample['seconds'] for sample in samples]),
+                'overhead': summary([sample['overhead_seconds'] for sample in samples]),
+                'queue_wait': summary([sample['wait_seconds'] for sample in samples
+                                       if sample['wait_seconds'] is not None]),
+                'first_errors': [sample['error'] for sample in samples if sample['error']][:3]
+            }
+
+        end_to_end = []
+        for document in self.documents.values():
+            completed_at = self.completed_at.get(document.get('job_id'))
+            if completed_at and 'uploaded_at' in document:
+                end_to_end.append(completed_at - document['uploaded_at'])
+        finished = max(self.completed_at.values(), default=time.time())
+        elapsed = max(finished - started, 1e-9)
+        pages = sum(len(document['pages']) for document in self.documents.values())
+        cases = {key.split('/')[0] for key in self.documents}
+        completions: Dict[str, int] = {}
+        for event in self.case_events:
+            completions[event['case_id']] = completions.get(event['case_id'], 0) + 1
+        return {
+            'documents': len(self.documents),
+            'documents_completed': len(end_to_end),
+            'pages': pages,
+            'timed_out': timed_out,
+            'elapsed_seconds': round(elapsed, 2),
+            'documents_per_second': round(len(end_to_end) / elapsed, 3),
+            'pages_per_second': round(pages / elapsed, 3) if len(end_to_end) == len(self.documents) else None,
+            'cases': len(cases),
+            'cases_completed': sum(1 for case in cases if completions.get(case)),
+            'case_completions': {case: completions.get(case, 0) for case in sorted(cases)},
+            'end_to_end': summary(end_to_end),
+            'stages': stages,
+            'operations': {operation: {'count': len(values), **summary(values)}
+                           for operation, values in sorted(self.metrics.items())}
+        }
+
+
+def print_report(report: Dict) -> None:
+    print(f"{report['documents_completed']}/{report['documents']} documents ({report['pages']} pages) "
+          f"in {report['elapsed_seconds']} s, {report['documents_per_second']} documents/s"
+          + (" (timed out)" if report['timed_out'] else ""))
+    print(f"{report['cases_completed']}/{report['cases']} cases completed")
+    columns = ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms')
+    print(f"{'stage':<16}{'calls':>7}{'errors':>7}" + "".join(f"{name:>10}" for name in columns)
+          + f"{'ovh p95':>10}{'wait p50':>10}{'wait p95':>10}")
+
+    def cell(value) -> str:
+        return f"{value:>10.1f}" if value is not None else f"{'-':>10}"
+
+    for stage, stats in report['stages'].items():
+        print(f"{stage:<16}{stats['invocations']:>7}{stats['errors']:>7}"
+              + "".join(cell(stats['latency'][name]) for name in columns)
+              + cell(stats['overhead']['p95_ms']) + cell(stats['queue_wait']['p50_ms'])
+              + cell(stats['queue_wait']['p95_ms']))
+        for error in stats['first_errors']:
+            print(f"    {error}")
+    print(f"{'end_to_end':<16}{report['documents_completed']:>7}{'':>7}"
+          + "".join(cell(report['end_to_end'][name]) for name in columns))
+
+    print(f"\n{'operation':<36}{'count':>7}" + "".join(f"{name:>10}" for name in columns))
+    for operation, stats in report['operations'].items():
+        print(f"{operation:<36}{stats['count']:>7}" + "".join(cell(stats[name]) for name in columns))
+
+    statuses = report['case_status']['cases']
+    print(f"\ncase status API: {sum(1 for case in statuses.values() if case['status'] == 'COMPLETED')}/{len(statuses)} "
+          f"cases COMPLETED, p50 of the slowest job per stage: "
+          + ", ".join(f"{stage} {milliseconds:.0f} ms"
+                      for stage, milliseconds in report['case_status']['latency_p50_ms'].items()))
+
+    if 'compaction' in report:
+        compaction = report['compaction']
+        print(f"\ncompaction: {compaction['rows']}/{compaction['documents']} documents in {compaction['files']} "
+              f"Parquet files with {compaction['parquet_rows']} rows, {compaction['seconds']} s")
+
+
+def check_report(report: Dict, budget_factor: float, min_documents_per_second: float) -> List[str]:
+    """Return the reasons the run fails as a performance regression test."""
+    failures = []
+    if report['timed_out'] or report['documents_completed'] < report['documents']:
+        failures.append(f"only {report['documents_completed']} of {report['documents']} documents completed")
+    for stage, stats in report['stages'].items():
+        if stats['errors']:
+            failures.append(f"{stage}: {stats['errors']} failed invocations")
+        budget = OVERHEAD_P95_BUDGETS_MS[stage] * budget_factor
+        overhead = stats['overhead']['p95_ms']
+        if overhead is not None and overhead > budget:
+            failures.append(f"{stage}: p95 overhead {overhead:.1f} ms exceeds {budget:.0f} ms")
+    repeated = [case for case, count in report['case_completions'].items() if count > 1]
+    if report['cases_completed'] < report['cases'] or repeated:
+        failures.append(f"{report['cases_completed']} of {report['cases']} cases completed"
+                        + (f", {', '.join(repeated)} more than once" if repeated else ""))
+    unfinished = [case_id for case_id, case in report['case_status']['cases'].items()
+                  if case['status'] != 'COMPLETED' or case['jobs_completed'] < case['jobs']]
+    if unfinished:
+        failures.append(f"case status API: {', '.join(unfinished)} not COMPLETED")
+    compaction = report.get('compaction')
+    if compaction and not compaction['documents'] == compaction['rows'] == compaction['parquet_rows']:
+        failures.append(f"compaction: {compaction['parquet_rows']} Parquet rows for {compaction['documents']} documents")
+    if report['documents_per_second'] < min_documents_per_second:
+        failures.append(f"{report['documents_per_second']} documents/s is below {min_documents_per_second}")
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Run the guidance pipeline locally against moto and stubbed AI services')
+    parser.add_argument('--corpus', help='JSON corpus file, a synthetic corpus is generated without it')
+    parser.add_argument('--cases', type=int, default=10, help='cases of the synthetic corpus, two documents each')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent invocations per stage')
+    parser.add_argument('--rate', type=float, default=0, help='uploads per second, 0 uploads the corpus at once')
+    parser.add_argument('--textract-latency', type=float, default=1.0, help='seconds per Textract job')
+    parser.add_argument('--textract-page-latency', type=float, default=0.1, help='additional job seconds per page')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='seconds per Textract API call')
+    parser.add_argument('--flow-latency', type=float, default=0.5, help='seconds per prompt flow invocation')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for the corpus to complete')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--check', action='store_true', help='exit with 1 on errors or overhead budget violations')
+    parser.add_argument('--budget-factor', type=float, default=1.0, help='multiplier applied to the overhead budgets')
+    parser.add_argument('--min-documents-per-second', type=float, default=0, help='throughput required by --check')
+    parser.add_argument('--compact', action='store_true',
+                        help='compact the validated documents into Parquet after the run, needs pyarrow')
+    parser.add_argument('--claim-check-threshold', type=int,
+                        help='message payload bytes above which the handlers offload the payload to S3')
+    args = parser.parse_args()
+
+    # fake credentials keep every client inside moto, the handlers log warnings only
+    os.environ.update({'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing',
+                       'AWS_SESSION_TOKEN': 'testing', 'AWS_DEFAULT_REGION': REGION,
+                       'POWERTOOLS_LOG_LEVEL': 'WARNING', 'POWERTOOLS_LOGGER_LOG_EVENT': 'false'})
+    os.environ.pop('AWS_PROFILE', None)
+    if args.claim_check_threshold is not None:
+        os.environ['CLAIM_CHECK_THRESHOLD_BYTES'] = str(args.claim_check_threshold)
+
+    if args.corpus:
+        with open(args.corpus, encoding='utf-8') as f:
+            corpus = json.load(f)
+    else:
+        corpus = generate_corpus(args.cases)
+
+    from moto import mock_aws
+    with mock_aws():
+        pipeline = LocalPipeline({
+            'textract_latency': args.textract_latency,
+            'textract_page_latency': args.textract_page_latency,
+            'api_latency': args.api_latency,
+            'flow_latency': args.flow_latency
+        }, args.concurrency)
+        pipeline.create_resources()
+        pipeline.load_handlers()
+        report = pipeline.run(corpus, args.rate, args.timeout)
+        report['case_status'] = pipeline.case_statuses()
+        if args.compact:
+            report['compaction'] = pipeline.compact()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if args.check:
+        failures = check_report(report, args.budget_factor, args.min_documents_per_second)
+        for failure in failures:
+            print(f"FAILED {failure}")
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
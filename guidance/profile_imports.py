@@ -0,0 +1,133 @@
+"""
+Measures the cold start import cost of the guidance Lambda handlers.
+
+Every handler module is imported in a fresh interpreter with `python -X importtime`, with its
+CodeUri directory and the shared layers on sys.path like in the Lambda runtime. The script
+reports the cumulative import time of each handler and of its most expensive direct imports.
+Install the requirements of the handlers, textractor and aws-lambda-powertools first.
+
+    python profile_imports.py                             # report all handlers
+    python profile_imports.py doc_validation_handler --top 20
+    python profile_imports.py --runs 7 --check            # exit 1 when a handler exceeds its budget
+
+With --check the median import time of each handler is compared with IMPORT_BUDGETS_MS. The
+budgets were measured on a developer machine; a Lambda function with 128 MB gets a fraction
+of a vCPU and takes several times longer. Use --budget-factor for slower or faster machines.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+GUIDANCE_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(GUIDANCE_DIR, 'lambda')
+LAYER_DIRS = [os.path.join(LAMBDA_DIR, 'layers', layer, 'python') for layer in ('aws_clients', 'instrumentation')]
+
+HANDLER_MODULE = 'app'
+
+# Median import time of the handler module in milliseconds
+IMPORT_BUDGETS_MS = {
+    's3_event_handler': 100,
+    'doc_classification_flow_handler': 120,
+    'doc_analysis_flow_handler': 100,
+    'doc_validation_handler': 200,
+    'case_compaction_handler': 100,
+    'case_status_handler': 100,
+}
+
+# The handlers read these at import time, the values are never used for a call
+PLACEHOLDER_ENV = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'TEXTRACT_NOTIFICATION_TOPIC_ARN': 'arn:aws:sns:us-east-1:123456789012:placeholder',
+    'TEXTRACT_NOTIFICATION_ROLE_ARN': 'arn:aws:iam::123456789012:role/placeholder',
+    'IDP_TEXTRACT_JOBS_TABLE_NAME': 'placeholder',
+    'IDP_FLOW_CLASS_TABLE_NAME': 'placeholder',
+    'CASE_VALIDATION_TABLE_NAME': 'placeholder',
+    'OUTPUT_BUCKET_NAME': 'placeholder',
+    'FLOW_IDENTIFIER': 'placeholder',
+    'FLOW_ALIAS_IDENTIFIER': 'placeholder',
+    'QUEUE_URL': 'https://sqs.us-east-1.amazonaws.com/123456789012/placeholder',
+    'IN_QUEUE_URL': 'https://sqs.us-east-1.amazonaws.com/123456789012/placeholder',
+    'OUT_QUEUE_URL': 'https://sqs.us-east-1.amazonaws.com/123456789012/placeholder',
+    'VALIDATION_QUEUE_URL': 'https://sqs.us-east-1.amazonaws.com/123456789012/placeholder',
+}
+
+
+def parse_import_times(stderr: str) -> List[Tuple[int, int, str]]:
+    """Return (depth, cumulative microseconds, module) of each line of the -X importtime output."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|', 2)
+        stripped = name.lstrip()
+        depth = (len(name) - len(stripped) - 1) // 2
+        entries.append((depth, int(cumulative), stripped))
+    return entries
+
+
+def import_handler(handler: str) -> List[Tuple[int, int, str]]:
+    """Import the handler module once in a new interpreter and return its import times."""
+    env = {**os.environ, **PLACEHOLDER_ENV}
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(LAMBDA_DIR, handler)] + LAYER_DIRS)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {HANDLER_MODULE}'],
+        cwd=os.path.join(LAMBDA_DIR, handler),
+        env=env,
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {handler} failed:\n{result.stderr.splitlines()[-1]}")
+    return parse_import_times(result.stderr)
+
+
+def profile_handler(handler: str, runs: int) -> Dict:
+    """Import a handler runs times after a warm-up import that writes the bytecode caches."""
+    import_handler(handler)
+    totals = []
+    direct_imports: Dict[str, List[int]] = {}
+    for _ in range(runs):
+        entries = import_handler(handler)
+        totals += [cumulative for depth, cumulative, name in entries if depth == 0 and name == HANDLER_MODULE]
+        # direct imports of the handler module are listed before it, one level deeper
+        for depth, cumulative, name in entries:
+            if depth == 1:
+                direct_imports.setdefault(name, []).append(cumulative)
+    return {
+        'median_ms': statistics.median(totals) / 1000,
+        'max_ms': max(totals) / 1000,
+        'imports_ms': {name: statistics.median(values) / 1000 for name, values in direct_imports.items()}
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Measure the import time of the guidance Lambda handlers')
+    parser.add_argument('handlers', nargs='*', default=list(IMPORT_BUDGETS_MS), help='handler directories under lambda/')
+    parser.add_argument('--runs', type=int, default=5, help='imports per handler, the median is reported')
+    parser.add_argument('--top', type=int, default=10, help='number of direct imports listed per handler')
+    parser.add_argument('--check', action='store_true', help='exit with 1 when a handler exceeds its import budget')
+    parser.add_argument('--budget-factor', type=float, default=1.0, help='multiplier applied to the budgets')
+    args = parser.parse_args()
+
+    over_budget = []
+    for handler in args.handlers:
+        profile = profile_handler(handler, args.runs)
+        budget = IMPORT_BUDGETS_MS.get(handler, 0) * args.budget_factor
+        print(f"{handler}: median {profile['median_ms']:.1f} ms, max {profile['max_ms']:.1f} ms, budget {budget:.0f} ms")
+        ranked = sorted(profile['imports_ms'].items(), key=lambda item: item[1], reverse=True)
+        for name, milliseconds in ranked[:args.top]:
+            print(f"    {milliseconds:8.1f} ms  {name}")
+        if budget and profile['median_ms'] > budget:
+            over_budget.append(handler)
+
+    if args.check and over_budget:
+        print(f"Import time budget exceeded: {', '.join(over_budget)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Evaluates Condition rules over many pages at once.
+
+The pages are given as a columnar table with one row per page and field:
+
+    page_id | field_name | value | confidence
+
+A missing field (a None page entry in Condition) is a row with a missing
+value. The confidence column is optional. Values are compared as str(value),
+like Condition does, so keep the value column of object dtype: a float
+column turns 1234 into "1234.0". A backlog such as a2i-bi-sample-data.csv can be loaded with:
+
+    table = pd.read_csv("a2idata/a2i-bi-sample-data.csv", dtype={"doc_id": str, "field_value": str}) \\
+              .rename(columns={"doc_id": "page_id", "field_value": "value"})
+
+Required, ConfidenceThreshold and ValueRegex rules are applied as vectorized
+operations over all rows instead of a Python loop per page and field.
+"""
+import numpy as np
+import pandas as pd
+
+from a2idata.condition import Condition
+
+
+def broken_condition_key(result):
+    return (result["field_name"], result["condition_type"], result["condition_category"], result["condition_setting"])
+
+
+def broken_condition_set(broken_conditions):
+    # Turns the broken conditions returned by Condition.check_all into the set form used by BatchCondition
+    return {broken_condition_key(r) for r in broken_conditions}
+
+
+def pages_to_frame(pages):
+    # Builds the columnar table from {page_id: {field_name: {"value", "confidence"} or None}}
+    rows = []
+    for page_id, page in pages.items():
+        for field_name, obj in page.items():
+            if obj is None:
+                rows.append((page_id, field_name, None, None))
+            else:
+                rows.append((page_id, field_name, obj.get("value"), obj.get("confidence")))
+    # object columns keep the value types, a number next to a None would become float64
+    return pd.DataFrame(rows, columns=["page_id", "field_name", "value", "confidence"], dtype=object)
+
+
+class BatchCondition:
+
+    def __init__(self, conditions):
+        # Reuses the compiled field index and value regexes of Condition
+        self._condition = Condition(None, conditions)
+        self._conditions = conditions
+
+    def _field_rules(self, field_names):
+        pairs = [(f, pos) for f in field_names for pos in self._condition._matching_conditions(f)]
+        return pd.DataFrame(pairs, columns=["field_name", "condition_pos"]).astype({"condition_pos": np.int64})
+
+    def broken(self, table):
+        """
+        Return one row per broken condition with the page_id, field_name,
+        value, confidence and the position of the condition in the rule list.
+        """
+        if "confidence" not in table.columns:
+            table = table.assign(confidence=np.nan)
+        rules = self._field_rules(table["field_name"].unique())
+        merged = table.merge(rules, on="field_name", how="inner")
+        if merged.empty:
+            return merged
+
+        pos = merged["condition_pos"].to_numpy()
+        condition_types = np.array([c["condition_type"] for c in self._conditions], dtype=object)[pos]
+        thresholds = np.array([self._condition._thresholds.get(i, np.nan)
+                               for i in range(len(self._conditions))], dtype=float)[pos]
+
+        has_value = merged["value"].notna().to_numpy()
+        # str() of each value like Condition, astype(str) would format the column dtype instead
+        value_str = merged["value"].astype(object).map(str).where(has_value, "")
+        confidence = pd.to_numeric(merged["confidence"], errors="coerce").to_numpy(dtype=float)
+
+        broken = (condition_types == "Required") & (~has_value | (value_str.str.len().to_numpy() == 0))
+        with np.errstate(invalid="ignore"):
+            broken |= (condition_types == "ConfidenceThreshold") & (confidence < thresholds)
+
+        # one vectorized regex pass per distinct pattern
+        patterns = {}
+        for i, compiled in self._condition._value_patterns.items():
+            patterns.setdefault((compiled.pattern, compiled.flags), []).append(i)
+        for (pattern, flags), positions in patterns.items():
+            rows = np.isin(pos, positions) & has_value
+            if rows.any():
+                matched = value_str[rows].str.contains(pattern, flags=flags, regex=True).to_numpy(dtype=bool)
+                broken[np.flatnonzero(rows)[~matched]] = True
+
+        return merged[broken]
+
+    def check_all(self, table):
+        """
+        Return {page_id: set of broken conditions} for every page of the table,
+        in the form produced by broken_condition_set for Condition.check_all.
+        """
+        result = {page_id: set() for page_id in table["page_id"].unique()}
+        broken = self.broken(table)
+        for page_id, field_name, i in zip(broken["page_id"], broken["field_name"], broken["condition_pos"]):
+            c = self._conditions[i]
+            result[page_id].add((field_name, str(c["condition_type"]), c["condition_category"], c.get("condition_setting")))
+        return result
@@ -0,0 +1,148 @@
+"""
+Benchmarks Condition.check_all with hundreds of rules against the
+previous loop-over-all-conditions implementation and checks both
+return the same broken and satisfied conditions.
+
+    python -m a2idata.benchmark_condition
+"""
+import random
+import re
+import time
+
+from a2idata.batch_condition import BatchCondition, broken_condition_set, pages_to_frame
+from a2idata.condition import Condition
+
+
+def reference_check_all(data, conditions):
+    # The previous implementation: every field is compared to every condition
+    # and the regexes are compiled (or looked up in the re cache) on each call.
+    broken_conditions, satisfied_conditions = [], []
+    for field_name, obj in data.items():
+        for c in conditions:
+            condition_setting = c.get("condition_setting")
+            if c["field_name"] == field_name \
+                    or (c.get("field_name") is None and c.get("field_name_regex") is not None and re.search(c.get("field_name_regex"), field_name)):
+                field_value, block = None, None
+                if obj is not None:
+                    field_value = obj.get("value")
+                    block = obj.get("block")
+                    confidence = obj.get("confidence")
+                result = {
+                    "field_name": field_name,
+                    "field_value": field_value,
+                    "condition_type": str(c["condition_type"]),
+                    "condition_setting": condition_setting,
+                    "condition_category": c["condition_category"],
+                    "block": block
+                }
+                if c["condition_type"] == "Required" \
+                        and (obj is None or field_value is None or len(str(field_value)) == 0):
+                    broken_conditions.append({"message": f"The required field [{field_name}] is missing.", **result})
+                elif c["condition_type"] == "ConfidenceThreshold" \
+                        and c["condition_setting"] is not None and float(confidence) < float(c["condition_setting"]):
+                    broken_conditions.append({"message": f"The field [{field_name}] confidence score {confidence} is lower than the threshold {c['condition_setting']}", **result})
+                elif field_value is not None and c["condition_type"] == "ValueRegex" and condition_setting is not None \
+                        and re.search(condition_setting, str(field_value)) is None:
+                    broken_conditions.append({"message": f"{c['description']}", **result})
+                satisfied_conditions.append({"message": f"{c['description']}", **result})
+
+    for idx, r in enumerate(broken_conditions, start=1):
+        r["index"] = idx
+    return broken_conditions, satisfied_conditions
+
+
+def generate_rules(num_fields, num_pattern_rules, rng):
+    rules = []
+    for i in range(num_fields):
+        field_name = f"part{i % 12}.field_{i}"
+        rules.append({"description": f"{field_name} is required", "field_name": field_name,
+                      "condition_category": "Required", "condition_type": "Required", "condition_setting": None})
+        rules.append({"description": f"{field_name} confidence score should be greater than 90", "field_name": field_name,
+                      "condition_category": "Confidence", "condition_type": "ConfidenceThreshold", "condition_setting": "90"})
+        rules.append({"description": f"{field_name} should be {i % 9 + 4} digits", "field_name": field_name,
+                      "condition_category": "LengthCheck", "condition_type": "ValueRegex",
+                      "condition_setting": f"^[0-9]{{{i % 9 + 4}}}$"})
+    for i in range(num_pattern_rules):
+        rules.append({"description": f"part{i} fields should be numeric", "field_name": None,
+                      "field_name_regex": f"^part{i}\\.field_{rng.randint(0, 9)}", "condition_category": "Numeric",
+                      "condition_type": "ValueRegex", "condition_setting": "^[0-9]+$"})
+    rng.shuffle(rules)
+    return rules
+
+
+def generate_page(num_fields, rng):
+    page = {}
+    for i in range(num_fields):
+        field_name = f"part{i % 12}.field_{i}"
+        missing = rng.random() < 0.05
+        page[field_name] = {
+            "value": "" if missing else "".join(rng.choice("0123456789AB") for _ in range(rng.randint(3, 12))),
+            "confidence": round(rng.uniform(70, 100), 2),
+            "block": {"Id": f"block-{i}"}
+        }
+    return page
+
+
+def check_group_references():
+    # Backreferences are numbered per pattern, the combined pre-filter would shift them
+    rules = [{"description": f"{name} is required", "field_name": None, "field_name_regex": regex,
+              "condition_category": "Required", "condition_type": "Required", "condition_setting": None}
+             for name, regex in (("aa", r"(a)\1"), ("bb", r"(b)\1"), ("cc", r"(?P<c>c)(?P=c)"))]
+    page = {"bb": {"value": "", "confidence": 99.0, "block": None},
+            "cc": {"value": "1", "confidence": 99.0, "block": None}}
+    expected = reference_check_all(page, rules)
+    assert expected[0] and Condition(page, rules).check_all() == expected, \
+        "group references in field name regexes are not matched like the reference implementation"
+
+
+def check_batch_mixed_values():
+    # BatchCondition compares str(value) of each cell like Condition, whatever the column dtype
+    rules = [{"description": "dln has 4 digits", "field_name": "dln", "field_name_regex": None,
+              "condition_category": "Invalid", "condition_type": "ValueRegex", "condition_setting": "^[0-9]{4}$"},
+             {"description": "dln is required", "field_name": "dln", "field_name_regex": None,
+              "condition_category": "Required", "condition_type": "Required", "condition_setting": None},
+             {"description": "flag is required", "field_name": "flag", "field_name_regex": None,
+              "condition_category": "Required", "condition_type": "Required", "condition_setting": None},
+             {"description": "amount has 2 decimals", "field_name": "amount", "field_name_regex": None,
+              "condition_category": "Invalid", "condition_type": "ValueRegex", "condition_setting": r"^\d+\.\d{2}$"}]
+    pages = {
+        "a": {"dln": {"value": 1234, "confidence": 99.0}, "flag": {"value": False, "confidence": 99.0},
+              "amount": {"value": 12.5, "confidence": 99.0}},
+        "b": {"dln": None, "flag": {"value": "", "confidence": 99.0}, "amount": {"value": "12.50", "confidence": 99.0}},
+        "c": {"dln": {"value": "12345", "confidence": 99.0}, "flag": {"value": None, "confidence": 99.0},
+              "amount": None},
+    }
+    # only numbers and None, a float64 value column
+    numeric_pages = {"a": {"dln": {"value": 1234, "confidence": 99.0}}, "b": {"dln": None}}
+    for pages in (pages, numeric_pages):
+        expected = {page_id: broken_condition_set(Condition(page, rules).check_all()[0])
+                    for page_id, page in pages.items()}
+        actual = BatchCondition(rules).check_all(pages_to_frame(pages))
+        assert actual == expected, \
+            f"BatchCondition differs from Condition on mixed and missing values: {actual} != {expected}"
+
+
+def run(num_fields=200, num_pattern_rules=50, num_pages=20, seed=42):
+    rng = random.Random(seed)
+    rules = generate_rules(num_fields, num_pattern_rules, rng)
+    pages = [generate_page(num_fields, rng) for _ in range(num_pages)]
+    print(f"{len(rules)} rules, {num_fields} fields per page, {num_pages} pages")
+
+    start = time.perf_counter()
+    expected = [reference_check_all(page, rules) for page in pages]
+    reference_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [Condition(page, rules).check_all() for page in pages]
+    indexed_seconds = time.perf_counter() - start
+
+    assert actual == expected, "indexed results differ from the reference implementation"
+    check_group_references()
+    check_batch_mixed_values()
+    print(f"reference: {reference_seconds * 1000 / num_pages:.2f} ms/page")
+    print(f"indexed:   {indexed_seconds * 1000 / num_pages:.2f} ms/page "
+          f"({reference_seconds / indexed_seconds:.1f}x)")
+
+
+if __name__ == "__main__":
+    run()
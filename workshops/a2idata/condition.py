@@ -1,100 +1,161 @@
 from enum import Enum
 import re
 
+# Numbered and named backreferences and conditional group references
+_GROUP_REFERENCE = re.compile(r"\\\d|\(\?P=|\(\?\(")
+
+
+def _refers_to_groups(pattern):
+    return pattern.groups > 0 and _GROUP_REFERENCE.search(pattern.pattern) is not None
+
+
 class Condition:
     _data = None
     _conditions = None
     _result = None
-    
+
     def __init__(self, data, conditions):
         self._data = data
         self._conditions = conditions
-    
+        self._compile()
+
+    def _compile(self):
+        # Exact field names are looked up in a hash index, field name regexes are
+        # precompiled and pre-filtered by a single combined pattern. The matching
+        # conditions of a field name are cached as positions in self._conditions,
+        # so the result order is the same as looping over all conditions.
+        self._exact_index = {}
+        self._name_patterns = []
+        self._value_patterns = {}
+        self._thresholds = {}
+        self._field_cache = {}
+        self._name_matcher = None
+        if self._conditions is None:
+            return
+
+        for pos, c in enumerate(self._conditions):
+            self._exact_index.setdefault(c.get("field_name"), []).append(pos)
+            if c.get("field_name") is None and c.get("field_name_regex") is not None:
+                self._name_patterns.append((pos, re.compile(c["field_name_regex"])))
+            if c["condition_type"] == "ValueRegex" and c.get("condition_setting") is not None:
+                self._value_patterns[pos] = re.compile(c["condition_setting"])
+            elif c["condition_type"] == "ConfidenceThreshold" and c.get("condition_setting") is not None:
+                self._thresholds[pos] = float(c["condition_setting"])
+
+        if self._name_patterns and not any(_refers_to_groups(p) for _, p in self._name_patterns):
+            # A field name that the combined alternation doesn't match can't match any of the patterns.
+            # Group references would point at the groups of other patterns once combined, and patterns
+            # that can't be combined at all (e.g. global inline flags) disable the pre-filter.
+            try:
+                self._name_matcher = re.compile("|".join(f"(?:{p.pattern})" for _, p in self._name_patterns))
+            except re.error:
+                self._name_matcher = None
+
+    def _matching_conditions(self, field_name):
+        positions = self._field_cache.get(field_name)
+        if positions is None:
+            matched = set(self._exact_index.get(field_name, []))
+            if self._name_patterns and isinstance(field_name, str) \
+                    and (self._name_matcher is None or self._name_matcher.search(field_name)):
+                matched.update(pos for pos, p in self._name_patterns if p.search(field_name))
+            positions = sorted(matched)
+            self._field_cache[field_name] = positions
+        return positions
+
+    def _evaluate(self, field_name, obj, broken_only=False):
+        field_value, block, confidence = None, None, None
+        if obj is not None:
+            field_value = obj.get("value")
+            block = obj.get("block")
+            confidence = obj.get("confidence")
+
+        for pos in self._matching_conditions(field_name):
+            c = self._conditions[pos]
+            condition_type = c["condition_type"]
+
+            if condition_type == "Required":
+                broken = obj is None or field_value is None or len(str(field_value)) == 0
+            elif pos in self._thresholds:
+                broken = float(confidence) < self._thresholds[pos]
+            elif field_value is not None and pos in self._value_patterns:
+                broken = self._value_patterns[pos].search(str(field_value)) is None
+            else:
+                broken = False
+
+            if broken or not broken_only:
+                yield ConditionResult(field_name, field_value, confidence, block, c, broken)
+
+    def iter_results(self, broken_only=False):
+        """
+        Lazily yield a ConditionResult per field and matching condition, in the
+        order of check_all. Stop iterating as soon as the answer is known, e.g.
+        at the first broken condition to decide whether to route to A2I.
+        """
+        if self._data is None or self._conditions is None:
+            return
+        for key, obj in self._data.items():
+            yield from self._evaluate(key, obj, broken_only)
+
+    def first_broken(self):
+        return next(self.iter_results(broken_only=True), None)
+
     def check(self, field_name, obj):
         r,s = [],[]
-        for c in self._conditions:
-            # Matching field_name or field_name_regex
-            condition_setting = c.get("condition_setting")
-            if c["field_name"] == field_name \
-                    or (c.get("field_name") is None and c.get("field_name_regex") is not None and re.search(c.get("field_name_regex"), field_name)):
-                field_value, block = None, None
-                if obj is not None:
-                    field_value = obj.get("value")
-                    block = obj.get("block")
-                    confidence = obj.get("confidence")
-                
-                if c["condition_type"] == "Required" \
-                        and (obj is None or field_value is None or len(str(field_value)) == 0):
-                    r.append({
-                                "message": f"The required field [{field_name}] is missing.",
-                                "field_name": field_name,
-                                "field_value": field_value,
-                                "condition_type": str(c["condition_type"]),
-                                "condition_setting": condition_setting,
-                                "condition_category":c["condition_category"],
-                                "block": block
-                            })
-                elif c["condition_type"] == "ConfidenceThreshold" \
-                    and c["condition_setting"] is not None and float(confidence) < float(c["condition_setting"]):
-                    r.append({
-                                "message": f"The field [{field_name}] confidence score {confidence} is lower than the threshold {c['condition_setting']}",
-                                "field_name": field_name,
-                                "field_value": field_value,
-                                "condition_type": str(c["condition_type"]),
-                                "condition_setting": condition_setting,
-                                "condition_category":c["condition_category"],
-                                "block": block
-                            })
-                elif field_value is not None and c["condition_type"] == "ValueRegex" and condition_setting is not None \
-                        and re.search(condition_setting, str(field_value)) is None:
-                    r.append({
-                                "message": f"{c['description']}",
-                                "field_name": field_name,
-                                "field_value": field_value,
-                                "condition_type": str(c["condition_type"]),
-                                "condition_setting": condition_setting,
-                                "condition_category":c["condition_category"],
-                                "block": block
-                            })
-                
-                # field has condition defined and sastified
-                s.append(
-                    {
-                        "message": f"{c['description']}",
-                        "field_name": field_name,
-                        "field_value": field_value,
-                        "condition_type": str(c["condition_type"]),
-                        "condition_setting": condition_setting,
-                        "condition_category":c["condition_category"],
-                        "block": block
-                    })
-                
+        for result in self._evaluate(field_name, obj):
+            if result.broken:
+                r.append(result.to_dict())
+            # field has condition defined and sastified
+            s.append(result.to_dict(satisfied=True))
         return r, s
-        
+
     def check_all(self):
         if self._data is None or self._conditions is None:
             return None
-        
+
         broken_conditions = []
         satisfied_conditions = []
-        for key, obj in self._data.items():
-            value = None
-            if obj is not None:
-                value = obj.get("value")
-
-            if value is not None and type(value)==str:
-                value = value.replace(' ','')
-            
-            r, s = self.check(key, obj)
-            if r and len(r) > 0:
-                broken_conditions += r
-            if s and len(s) > 0:
-                satisfied_conditions += s
-
-
-        # apply index
-        idx = 0
-        for r in broken_conditions:
-            idx += 1
-            r["index"] = idx
-        return broken_conditions, satisfied_conditions
\ No newline at end of file
+        for result in self.iter_results():
+            if result.broken:
+                broken = result.to_dict()
+                broken["index"] = len(broken_conditions) + 1
+                broken_conditions.append(broken)
+            satisfied_conditions.append(result.to_dict(satisfied=True))
+        return broken_conditions, satisfied_conditions
+
+
+class ConditionResult:
+    # A compact record of one condition evaluated on one field, the message is only formatted when read
+    __slots__ = ("field_name", "field_value", "confidence", "block", "condition", "broken")
+
+    def __init__(self, field_name, field_value, confidence, block, condition, broken):
+        self.field_name = field_name
+        self.field_value = field_value
+        self.confidence = confidence
+        self.block = block
+        self.condition = condition
+        self.broken = broken
+
+    @property
+    def message(self):
+        c = self.condition
+        if self.broken and c["condition_type"] == "Required":
+            return f"The required field [{self.field_name}] is missing."
+        if self.broken and c["condition_type"] == "ConfidenceThreshold":
+            return f"The field [{self.field_name}] confidence score {self.confidence} is lower than the threshold {c['condition_setting']}"
+        return f"{c['description']}"
+
+    def to_dict(self, satisfied=False):
+        # satisfied=True gives the entry of the satisfied list, which always carries the rule description
+        c = self.condition
+        return {
+            "message": f"{c['description']}" if satisfied else self.message,
+            "field_name": self.field_name,
+            "field_value": self.field_value,
+            "condition_type": str(c["condition_type"]),
+            "condition_setting": c.get("condition_setting"),
+            "condition_category": c["condition_category"],
+            "block": self.block
+        }
+
+    def __repr__(self):
+        return f"ConditionResult(field_name={self.field_name!r}, condition_type={self.condition['condition_type']!r}, broken={self.broken})"
@@ -1,24 +1,134 @@
+import hashlib
 import json
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from botocore.exceptions import ClientError
 bedrock = boto3.client(service_name="bedrock-runtime")
 
-# Create a global function to call Bedrock. 
-def get_response_from_claude(prompt):
+DEFAULT_MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+DEFAULT_MAX_TOKENS = 2048
+DEFAULT_TEMPERATURE = 0.5
+
+# Claude 3 models accept 200k input tokens and generate at most 4096 tokens
+CONTEXT_WINDOW_TOKENS = 200000
+MAX_OUTPUT_TOKENS = 4096
+
+THROTTLING_ERROR_CODES = ("ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException")
+
+# Opt-in persistent response cache, see enable_response_cache
+response_cache = None
+
+
+class ResponseCache:
 	"""
-	Invokes Anthropic Claude 3 Haiku to run a text inference using the input
-	provided in the request body.
+	SQLite-backed cache of model responses keyed by a hash of the model id and request body.
 
-	:param prompt:            The prompt that you want Claude 3 to use.
-	:return: Inference response from the model.
+	Entries are evicted least recently used first once the stored responses
+	exceed max_bytes. Hits and the input/output tokens they saved are counted
+	in stats.
 	"""
 
-	# Invoke the model with the prompt and the encoded image
-	model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
-	request_body = {
+	def __init__(self, path="bedrock_response_cache.sqlite", max_bytes=256 * 1024 * 1024):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.stats = {"hits": 0, "misses": 0, "saved_input_tokens": 0, "saved_output_tokens": 0}
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(path, check_same_thread=False)
+		self._db.execute(
+			"CREATE TABLE IF NOT EXISTS responses ("
+			"key TEXT PRIMARY KEY, text TEXT, input_tokens INTEGER, output_tokens INTEGER, "
+			"size INTEGER, last_access REAL)"
+		)
+		self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+		self._db.commit()
+		self._total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+	@staticmethod
+	def key(model_id, request_body):
+		payload = json.dumps({"model_id": model_id, "body": request_body}, sort_keys=True)
+		return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+	def get(self, key):
+		with self._lock:
+			row = self._db.execute(
+				"SELECT text, input_tokens, output_tokens FROM responses WHERE key = ?", (key,)
+			).fetchone()
+			if row is None:
+				self.stats["misses"] += 1
+				return None
+			self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+			self._db.commit()
+			self.stats["hits"] += 1
+			self.stats["saved_input_tokens"] += row[1]
+			self.stats["saved_output_tokens"] += row[2]
+			return row[0], row[1], row[2]
+
+	def put(self, key, response):
+		text_response, input_tokens, output_tokens = response
+		size = len(text_response.encode("utf-8"))
+		with self._lock:
+			previous = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+			self._db.execute(
+				"INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+				(key, text_response, input_tokens, output_tokens, size, time.time())
+			)
+			self._total_bytes += size - (previous[0] if previous else 0)
+			while self._total_bytes > self.max_bytes:
+				oldest = self._db.execute(
+					"SELECT key, size FROM responses ORDER BY last_access LIMIT 1"
+				).fetchone()
+				if oldest is None:
+					break
+				self._db.execute("DELETE FROM responses WHERE key = ?", (oldest[0],))
+				self._total_bytes -= oldest[1]
+			self._db.commit()
+
+	def clear(self):
+		with self._lock:
+			self._db.execute("DELETE FROM responses")
+			self._db.commit()
+			self._total_bytes = 0
+
+
+def enable_response_cache(path="bedrock_response_cache.sqlite", max_bytes=256 * 1024 * 1024):
+	"""
+	Turns on the persistent response cache for get_response_from_claude and get_responses_from_claude.
+
+	Only calls with temperature 0 are served from the cache, pass force_cache=True
+	to also cache calls with a higher temperature.
+
+	:return: The ResponseCache, its stats attribute reports hits and saved tokens.
+	"""
+	global response_cache
+	response_cache = ResponseCache(path, max_bytes)
+	return response_cache
+
+
+def disable_response_cache():
+	global response_cache
+	response_cache = None
+
+
+def _cache_key(model_id, request_body, force_cache):
+	# responses sampled with a temperature above zero are not reproducible, only cache them when forced
+	if response_cache is None or (request_body["temperature"] > 0 and not force_cache):
+		return None
+	return ResponseCache.key(model_id, request_body)
+
+
+def build_request_body(prompt, max_tokens=DEFAULT_MAX_TOKENS, temperature=DEFAULT_TEMPERATURE):
+	"""
+	Builds the Anthropic Claude Messages API request body for a text prompt.
+	"""
+	return {
 		"anthropic_version": "bedrock-2023-05-31",
-		"max_tokens": 2048,
-        "temperature":0.5,
+		"max_tokens": max_tokens,
+		"temperature": temperature,
 		"messages": [
 			{
 				"role": "user",
@@ -32,6 +142,37 @@ def get_response_from_claude(prompt):
 		],
 	}
 
+
+# Create a global function to call Bedrock.
+def get_response_from_claude(prompt, model_id=DEFAULT_MODEL_ID, max_tokens=DEFAULT_MAX_TOKENS, temperature=DEFAULT_TEMPERATURE,
+							 force_cache=False):
+	"""
+	Invokes Anthropic Claude 3 Haiku to run a text inference using the input
+	provided in the request body.
+
+	:param prompt:            The prompt that you want Claude 3 to use.
+	:param model_id:          The Bedrock model id to invoke.
+	:param max_tokens:        The maximum number of tokens to generate.
+	:param temperature:       The sampling temperature.
+	:param force_cache:       Use the response cache even when temperature is above zero.
+	:return: Inference response from the model.
+	"""
+
+	# Invoke the model with the prompt and the encoded image
+	request_body = build_request_body(prompt, max_tokens, temperature)
+	cache_key = _cache_key(model_id, request_body, force_cache)
+	if cache_key is not None:
+		cached = response_cache.get(cache_key)
+		if cached is not None:
+			return cached
+
+	response = _invoke_model(model_id, request_body)
+	if cache_key is not None:
+		response_cache.put(cache_key, response)
+	return response
+
+
+def _invoke_model(model_id, request_body):
 	try:
 		response = bedrock.invoke_model(
 			modelId=model_id,
@@ -45,10 +186,299 @@ def get_response_from_claude(prompt):
 		# the current Bedrock Claude Messagees API only supports text content in responses
 		text_response = result["content"][0]["text"]
 
-        # return a tuple with 3 values
+		# return a tuple with 3 values
 		return text_response, input_tokens, output_tokens
 	except ClientError as err:
 		print(
 			F"Couldn't invoke Claude 3 Sonnet. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}"
 		)
-		raise
\ No newline at end of file
+		raise
+
+
+class ClaudeStream:
+	"""
+	Streams the text deltas of a Claude response as they arrive and records latency metrics.
+
+	Iterate over the stream to get the text deltas. Once the stream is consumed,
+	text holds the full response and the metrics are set:
+
+	- time_to_first_token: seconds from the request to the first text delta
+	- total_latency:       seconds from the request to the end of the stream
+	- tokens_per_second:   output tokens per second after the first token
+	- input_tokens, output_tokens as returned by get_response_from_claude
+	"""
+
+	def __init__(self, event_stream, start_time):
+		self._event_stream = event_stream
+		self.start_time = start_time
+		self.text = ""
+		self.input_tokens = None
+		self.output_tokens = None
+		self.time_to_first_token = None
+		self.total_latency = None
+		self.tokens_per_second = None
+		self.stop_reason = None
+
+	def __iter__(self):
+		for event in self._event_stream:
+			if "chunk" not in event:
+				# modelStreamErrorException, throttlingException, ...
+				error_name, error = next(iter(event.items()))
+				raise Exception(f"{error_name}: {error.get('message', error)}")
+
+			chunk = json.loads(event["chunk"]["bytes"])
+			if chunk["type"] == "message_start":
+				self.input_tokens = chunk["message"]["usage"]["input_tokens"]
+			elif chunk["type"] == "content_block_delta" and chunk["delta"].get("type") == "text_delta":
+				if self.time_to_first_token is None:
+					self.time_to_first_token = time.perf_counter() - self.start_time
+				self.text += chunk["delta"]["text"]
+				yield chunk["delta"]["text"]
+			elif chunk["type"] == "message_delta":
+				self.output_tokens = chunk["usage"]["output_tokens"]
+				self.stop_reason = chunk["delta"].get("stop_reason")
+			elif chunk["type"] == "message_stop":
+				# Bedrock adds the token counts of the whole call to the last chunk
+				invocation_metrics = chunk.get("amazon-bedrock-invocationMetrics")
+				if invocation_metrics:
+					self.input_tokens = invocation_metrics["inputTokenCount"]
+					self.output_tokens = invocation_metrics["outputTokenCount"]
+
+		self.total_latency = time.perf_counter() - self.start_time
+		if self.output_tokens and self.time_to_first_token is not None:
+			generation_time = self.total_latency - self.time_to_first_token
+			self.tokens_per_second = self.output_tokens / generation_time if generation_time > 0 else None
+
+	def metrics(self):
+		return {
+			"input_tokens": self.input_tokens,
+			"output_tokens": self.output_tokens,
+			"time_to_first_token": self.time_to_first_token,
+			"tokens_per_second": self.tokens_per_second,
+			"total_latency": self.total_latency,
+		}
+
+
+def stream_response_from_claude(prompt, model_id=DEFAULT_MODEL_ID, max_tokens=DEFAULT_MAX_TOKENS, temperature=DEFAULT_TEMPERATURE):
+	"""
+	Invokes Anthropic Claude 3 with the response stream API so the output can be shown as it is generated.
+
+	:param prompt:            The prompt that you want Claude 3 to use.
+	:param model_id:          The Bedrock model id to invoke.
+	:param max_tokens:        The maximum number of tokens to generate.
+	:param temperature:       The sampling temperature.
+	:return: A ClaudeStream yielding the text deltas, its metrics are set once it is consumed.
+	"""
+	request_body = build_request_body(prompt, max_tokens, temperature)
+	start_time = time.perf_counter()
+	try:
+		response = bedrock.invoke_model_with_response_stream(
+			modelId=model_id,
+			body=json.dumps(request_body),
+		)
+	except ClientError as err:
+		print(
+			F"Couldn't invoke Claude 3 Sonnet. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}"
+		)
+		raise
+	return ClaudeStream(response.get("body"), start_time)
+
+
+def estimate_tokens(text):
+	"""
+	Rough token estimate for rate limiting, about 4 characters per token for English text.
+	"""
+	return max(1, len(text) // 4)
+
+
+def recommend_max_tokens(input_tokens, output_ratio=0.5, minimum=256, maximum=MAX_OUTPUT_TOKENS):
+	"""
+	Recommends a max_tokens value for a call from the size of its input.
+
+	:param input_tokens:  Estimated input tokens of the prompt.
+	:param output_ratio:  Expected output size relative to the input, e.g. 0.1 for a summary
+	                      or 1.0 for a JSON extraction that repeats most of the input.
+	:return: The recommended max_tokens, between minimum and maximum.
+	"""
+	return int(min(maximum, max(minimum, input_tokens * output_ratio)))
+
+
+def split_into_sections(text, separator="\n\n"):
+	"""
+	Splits a document text into sections at blank lines, keeping the separators.
+	"""
+	parts = text.split(separator)
+	return [part + separator for part in parts[:-1]] + [parts[-1]]
+
+
+def _split_oversized_section(section, max_tokens):
+	# a single page or section above the budget is split at blank lines, then lines, then characters
+	if estimate_tokens(section) <= max_tokens:
+		return [section]
+	for separator in ("\n\n", "\n"):
+		parts = split_into_sections(section, separator)
+		if len(parts) > 1:
+			return [piece for part in parts for piece in _split_oversized_section(part, max_tokens)]
+	max_chars = max_tokens * 4
+	return [section[i:i + max_chars] for i in range(0, len(section), max_chars)]
+
+
+def plan_prompts(sections, format_prompt, max_input_tokens=CONTEXT_WINDOW_TOKENS - MAX_OUTPUT_TOKENS,
+				 output_ratio=0.5):
+	"""
+	Plans the model calls for a document before invoking the model.
+
+	The sections (e.g. the text of each page) are packed in order into as few
+	prompts as possible that each fit max_input_tokens, so no call overflows the
+	context window. A recommended max_tokens is given for each prompt.
+
+	:param sections:          The document split at page or section boundaries.
+	:param format_prompt:     A function building the prompt from the text of a chunk.
+	:param max_input_tokens:  The input token budget of a single call.
+	:param output_ratio:      Expected output size relative to the input, see recommend_max_tokens.
+	:return: A list of (prompt, max_tokens) tuples, in document order.
+	"""
+	overhead = estimate_tokens(format_prompt(""))
+	budget = max_input_tokens - overhead
+	if budget <= 0:
+		raise ValueError(f"The prompt template alone uses {overhead} of the {max_input_tokens} input tokens")
+
+	chunks, current, current_tokens = [], [], 0
+	for section in sections:
+		for piece in _split_oversized_section(section, budget):
+			piece_tokens = estimate_tokens(piece)
+			if current and current_tokens + piece_tokens > budget:
+				chunks.append("".join(current))
+				current, current_tokens = [], 0
+			current.append(piece)
+			current_tokens += piece_tokens
+	if current:
+		chunks.append("".join(current))
+
+	plan = []
+	for chunk in chunks:
+		prompt = format_prompt(chunk)
+		plan.append((prompt, recommend_max_tokens(estimate_tokens(prompt), output_ratio)))
+	return plan
+
+
+class RateLimiter:
+	"""
+	Thread-safe token-bucket limiter for requests per minute and tokens per minute.
+
+	The allowed rate adapts to throttling: every throttled call halves it
+	(down to min_fraction of the configured limits) and every successful call
+	recovers a small step towards the configured limits.
+	"""
+
+	def __init__(self, requests_per_minute=None, tokens_per_minute=None, min_fraction=0.1, recovery_step=0.05):
+		self.requests_per_minute = requests_per_minute
+		self.tokens_per_minute = tokens_per_minute
+		self.min_fraction = min_fraction
+		self.recovery_step = recovery_step
+		self.fraction = 1.0
+		self._lock = threading.Lock()
+		self._request_allowance = float(requests_per_minute or 0)
+		self._token_allowance = float(tokens_per_minute or 0)
+		self._last_refill = time.monotonic()
+
+	def _refill(self):
+		now = time.monotonic()
+		elapsed_minutes = (now - self._last_refill) / 60
+		self._last_refill = now
+		if self.requests_per_minute:
+			limit = self.requests_per_minute * self.fraction
+			self._request_allowance = min(limit, self._request_allowance + elapsed_minutes * limit)
+		if self.tokens_per_minute:
+			limit = self.tokens_per_minute * self.fraction
+			self._token_allowance = min(limit, self._token_allowance + elapsed_minutes * limit)
+
+	def acquire(self, tokens):
+		"""
+		Blocks until one request using the given number of tokens is allowed.
+		"""
+		while True:
+			with self._lock:
+				self._refill()
+				wait_seconds = 0
+				if self.requests_per_minute and self._request_allowance < 1:
+					wait_seconds = (1 - self._request_allowance) * 60 / (self.requests_per_minute * self.fraction)
+				# a single call larger than the whole budget only waits for a full bucket
+				needed_tokens = min(tokens, self.tokens_per_minute * self.fraction) if self.tokens_per_minute else 0
+				if self.tokens_per_minute and self._token_allowance < needed_tokens:
+					wait_seconds = max(wait_seconds, (needed_tokens - self._token_allowance) * 60 / (self.tokens_per_minute * self.fraction))
+				if wait_seconds == 0:
+					self._request_allowance -= 1
+					self._token_allowance -= tokens
+					return
+			time.sleep(wait_seconds)
+
+	def record_usage(self, estimated_tokens, actual_tokens):
+		"""
+		Corrects the token allowance once the real token usage of a call is known.
+		"""
+		with self._lock:
+			self._token_allowance -= actual_tokens - estimated_tokens
+
+	def throttled(self):
+		with self._lock:
+			self.fraction = max(self.min_fraction, self.fraction / 2)
+
+	def succeeded(self):
+		with self._lock:
+			self.fraction = min(1.0, self.fraction + self.recovery_step)
+
+
+def _invoke_with_backoff(prompt, limiter, max_retries, base_delay, model_id=DEFAULT_MODEL_ID,
+						 max_tokens=DEFAULT_MAX_TOKENS, temperature=DEFAULT_TEMPERATURE, force_cache=False):
+	# cached responses don't use any of the rate limit budget
+	request_body = build_request_body(prompt, max_tokens, temperature)
+	cache_key = _cache_key(model_id, request_body, force_cache)
+	if cache_key is not None:
+		cached = response_cache.get(cache_key)
+		if cached is not None:
+			return cached
+
+	estimated_tokens = estimate_tokens(prompt) + max_tokens
+	for attempt in range(max_retries + 1):
+		limiter.acquire(estimated_tokens)
+		try:
+			response = _invoke_model(model_id, request_body)
+		except ClientError as err:
+			if err.response["Error"]["Code"] not in THROTTLING_ERROR_CODES or attempt == max_retries:
+				raise
+			limiter.throttled()
+			# exponential backoff with full jitter
+			time.sleep(random.uniform(0, base_delay * 2 ** attempt))
+			continue
+		limiter.succeeded()
+		limiter.record_usage(estimated_tokens, response[1] + response[2])
+		if cache_key is not None:
+			response_cache.put(cache_key, response)
+		return response
+
+
+def get_responses_from_claude(prompts, max_workers=4, requests_per_minute=None, tokens_per_minute=None,
+							  max_retries=6, base_delay=1.0, **invoke_kwargs):
+	"""
+	Runs many prompts concurrently and yields the responses in input order.
+
+	:param prompts:             An iterable of prompts, it is consumed lazily.
+	:param max_workers:         Number of concurrent invoke_model calls.
+	:param requests_per_minute: Optional limit of invoke_model calls per minute.
+	:param tokens_per_minute:   Optional limit of input and output tokens per minute.
+	:param max_retries:         Retries of a throttled call before the error is raised.
+	:param base_delay:          Base delay in seconds of the exponential backoff.
+	:param invoke_kwargs:       model_id, max_tokens, temperature and force_cache for get_response_from_claude.
+	:return: A generator of (text_response, input_tokens, output_tokens) tuples, in the order of the prompts.
+	"""
+	limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		pending = deque()
+		for prompt in prompts:
+			pending.append(executor.submit(_invoke_with_backoff, prompt, limiter, max_retries, base_delay, **invoke_kwargs))
+			# keep a bounded window of submitted prompts so large iterables are not loaded at once
+			if len(pending) >= max_workers * 2:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
@@ -0,0 +1,71 @@
+"""
+Checks ClaudeStream against a stub event stream of invoke_model_with_response_stream,
+without calling Bedrock.
+
+	python check_stream.py
+"""
+import json
+import os
+import time
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from bedrockhelper import ClaudeStream
+
+
+def chunk(payload):
+	return {"chunk": {"bytes": json.dumps(payload).encode("utf-8")}}
+
+
+def stub_event_stream(deltas, input_tokens, output_tokens, delay=0.01):
+	"""
+	One content_block_delta event per text delta, then the message_stop event with the
+	invocation metrics Bedrock adds to the last chunk.
+	"""
+	for delta in deltas:
+		time.sleep(delay)
+		yield chunk({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": delta}})
+	yield chunk({
+		"type": "message_stop",
+		"amazon-bedrock-invocationMetrics": {
+			"inputTokenCount": input_tokens,
+			"outputTokenCount": output_tokens,
+			"invocationLatency": 40,
+			"firstByteLatency": 10,
+		},
+	})
+
+
+def check_stream():
+	deltas = ["The document ", "is a ", "W-2 form."]
+	stream = ClaudeStream(stub_event_stream(deltas, input_tokens=42, output_tokens=9), time.perf_counter())
+	assert stream.time_to_first_token is None
+
+	assert list(stream) == deltas
+	assert stream.text == "The document is a W-2 form."
+	assert stream.input_tokens == 42
+	assert stream.output_tokens == 9
+	assert 0 < stream.time_to_first_token <= stream.total_latency
+	assert stream.tokens_per_second > 0
+	assert stream.metrics()["output_tokens"] == 9
+
+
+def check_stream_error():
+	events = [chunk({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "The"}}),
+	          {"throttlingException": {"message": "Too many requests"}}]
+	stream = ClaudeStream(iter(events), time.perf_counter())
+	deltas = []
+	try:
+		for delta in stream:
+			deltas.append(delta)
+	except Exception as e:
+		assert str(e) == "throttlingException: Too many requests"
+	else:
+		raise AssertionError("the error event did not raise")
+	assert deltas == ["The"]
+
+
+if __name__ == "__main__":
+	check_stream()
+	check_stream_error()
+	print("ClaudeStream checks passed")
@@ -0,0 +1,83 @@
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from PIL import Image, ImageOps
+
+# Titan Multimodal Embeddings and Claude 3 accept images up to 2048 pixels on a side without downscaling them again
+DEFAULT_MAX_DIMENSION = 2048
+MIN_JPEG_QUALITY = 30
+MAX_JPEG_QUALITY = 90
+
+
+def _encode(image, image_format, quality):
+	if image_format == "auto":
+		# flat scanned pages often compress better lossless, photos better as JPEG
+		return min(_encode(image, "PNG", quality), _encode(image, "JPEG", quality), key=len)
+	with BytesIO() as output:
+		if image_format == "JPEG":
+			image.save(output, "JPEG", quality=quality, optimize=True)
+		else:
+			image.save(output, image_format, optimize=True)
+		return output.getvalue()
+
+
+def preprocess_image(image_file, max_dimension=DEFAULT_MAX_DIMENSION, grayscale=False, target_bytes=None, image_format="auto"):
+	"""
+	Downsamples, optionally converts to grayscale, and compresses an image before it is sent to Bedrock or Textract.
+
+	The image is scaled down to fit max_dimension on its longest side, keeping the
+	aspect ratio. With a target_bytes budget, the JPEG quality is lowered (and the
+	image scaled down further if needed) until the encoded image fits the budget.
+
+	:param image_file:     A path, a file object or the image bytes.
+	:param max_dimension:  Maximum width and height in pixels.
+	:param grayscale:      Convert to 8-bit grayscale, enough for OCR of most documents.
+	:param target_bytes:   Optional maximum size of the encoded image.
+	:param image_format:   "JPEG", "PNG" or "auto" for the smaller of both. PNG is lossless,
+	                       so only downscaling reduces its size.
+	:return: The encoded image bytes.
+	"""
+	if isinstance(image_file, (bytes, bytearray)):
+		image_file = BytesIO(image_file)
+	with Image.open(image_file) as opened:
+		# apply the EXIF orientation of photos before dropping the metadata
+		image = ImageOps.exif_transpose(opened)
+		image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+	if grayscale:
+		image = image.convert("L")
+	elif image_format != "PNG" and image.mode not in ("RGB", "L"):
+		image = image.convert("RGB")
+
+	quality = MAX_JPEG_QUALITY
+	data = _encode(image, image_format, quality)
+	if target_bytes is None:
+		return data
+
+	while len(data) > target_bytes:
+		if image_format != "PNG" and quality > MIN_JPEG_QUALITY:
+			# size roughly follows quality, step down faster when far above the budget
+			quality = max(MIN_JPEG_QUALITY, quality - (20 if len(data) > 2 * target_bytes else 10))
+		else:
+			width, height = image.size
+			if width <= 64 or height <= 64:
+				raise ValueError(f"Can't compress the image below {target_bytes} bytes")
+			image = image.resize((int(width * 0.75), int(height * 0.75)), Image.LANCZOS)
+		data = _encode(image, image_format, quality)
+	return data
+
+
+def _preprocess_path(args):
+	image_file, kwargs = args
+	return preprocess_image(image_file, **kwargs)
+
+
+def preprocess_images(image_files, max_workers=None, **kwargs):
+	"""
+	Preprocesses many images in parallel with a process pool, see preprocess_image for the options.
+
+	:param image_files:  Paths (or image bytes) of the images.
+	:param max_workers:  Number of worker processes, defaults to the number of CPUs.
+	:return: The encoded images, in the order of image_files.
+	"""
+	with ProcessPoolExecutor(max_workers=max_workers) as executor:
+		return list(executor.map(_preprocess_path, [(image_file, kwargs) for image_file in image_files], chunksize=4))
@@ -2,10 +2,15 @@
 import aws_cdk as cdk
 from workflows.demo_with_queries_stack import DemoQueries
 from workflows.simple_async_workflow import SimpleAsyncWorkflow
+from workflows.chunked_queries_workflow import ChunkedQueriesWorkflow, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_CONCURRENCY
 
 app = cdk.App()
 
 DemoQueries(app, "DemoQueries")
 SimpleAsyncWorkflow(app, "SimpleAsyncWorkflow")
+ChunkedQueriesWorkflow(app,
+                       "ChunkedQueries",
+                       chunk_size=int(app.node.try_get_context("chunk_size") or DEFAULT_CHUNK_SIZE),
+                       max_concurrency=int(app.node.try_get_context("max_concurrency") or DEFAULT_MAX_CONCURRENCY))
 
 app.synth()
@@ -0,0 +1,71 @@
+"""
+merges the CSV outputs of the page chunks of a document
+"""
+import csv
+import io
+import json
+import logging
+import os
+
+import boto3
+
+logger = logging.getLogger(__name__)
+
+s3_client = boto3.client(service_name='s3')
+
+# TextractGenerateCSV writes timestamp, classification, filename, page, ...
+# with the page counted from 1 inside each chunk
+PAGE_COLUMN = 3
+
+
+def split_s3_path_to_bucket_and_key(s3_path):
+    s3_bucket, _, s3_key = s3_path[len("s3://"):].partition("/")
+    return s3_bucket, s3_key
+
+
+def offset_pages(chunk_csv, start_page):
+    """returns the rows of a chunk CSV with the pages counted from the start page
+    of the chunk in the document"""
+    output = io.StringIO()
+    csv_writer = csv.writer(output,
+                            delimiter=",",
+                            quotechar='"',
+                            quoting=csv.QUOTE_MINIMAL)
+    for row in csv.reader(io.StringIO(chunk_csv)):
+        if len(row) > PAGE_COLUMN and row[PAGE_COLUMN].isdigit():
+            row[PAGE_COLUMN] = str(int(row[PAGE_COLUMN]) + start_page - 1)
+        csv_writer.writerow(row)
+    # the writer terminates every row, so no chunk runs into the next one
+    return output.getvalue()
+
+
+def lambda_handler(event, _):
+    log_level = os.environ.get('LOG_LEVEL', 'INFO')
+    logger.setLevel(log_level)
+    logger.info(f"LOG_LEVEL: {log_level}")
+    logger.info(json.dumps(event))
+
+    csv_s3_output_bucket = os.environ.get('CSV_S3_OUTPUT_BUCKET', None)
+    csv_s3_output_prefix = os.environ.get('CSV_S3_OUTPUT_PREFIX', None)
+    if not csv_s3_output_bucket or not csv_s3_output_prefix:
+        raise Exception("no CSV_S3_OUTPUT_BUCKET or CSV_S3_OUTPUT_PREFIX set")
+
+    # the Map state returns the chunks in page order
+    merged = []
+    for chunk in event['chunks']:
+        s3_bucket, s3_key = split_s3_path_to_bucket_and_key(chunk['csv'])
+        chunk_csv = s3_client.get_object(
+            Bucket=s3_bucket, Key=s3_key)['Body'].read().decode('utf-8')
+        merged.append(offset_pages(chunk_csv, int(chunk['startPage'])))
+
+    s3_filename, _ = os.path.splitext(os.path.basename(event['s3Path']))
+    s3_output_key = f"{csv_s3_output_prefix}/{s3_filename}/{event['executionName']}.csv"
+    s3_client.put_object(Bucket=csv_s3_output_bucket,
+                         Key=s3_output_key,
+                         Body="".join(merged).encode('utf-8'))
+    logger.info(
+        f"merged {len(event['chunks'])} chunks into s3://{csv_s3_output_bucket}/{s3_output_key}")
+    return {
+        "TextractOutputCSVPath":
+        f"s3://{csv_s3_output_bucket}/{s3_output_key}"
+    }
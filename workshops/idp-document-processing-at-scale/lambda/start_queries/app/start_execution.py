@@ -1,12 +1,16 @@
 """
 kicks off Step Function executions with Queries
 """
+import hashlib
 import json
 import logging
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote_plus
 import textractmanifest as tm
-from datetime import datetime
 import re
 
 import boto3
@@ -14,7 +18,72 @@ import boto3
 logger = logging.getLogger(__name__)
 
 step_functions_client = boto3.client(service_name='stepfunctions')
+dynamodb_client = boto3.client(service_name='dynamodb')
 TRIGGER_TYPES = []
+# Step Functions execution names are limited to 80 characters
+MAX_EXECUTION_NAME_LENGTH = 80
+EXECUTION_NAME_HASH_LENGTH = 32
+
+# Admission gate, disabled when IN_FLIGHT_TABLE_NAME is not set
+IN_FLIGHT_TABLE_NAME = os.environ.get('IN_FLIGHT_TABLE_NAME', None)
+MAX_IN_FLIGHT_EXECUTIONS = int(os.environ.get('MAX_IN_FLIGHT_EXECUTIONS', '100'))
+IN_FLIGHT_COUNTER_ID = "in_flight"
+EXECUTION_ID_PREFIX = "execution#"
+# set on the slot by the textract router when it sends the execution to the sync task
+SYNC_ROUTE = "SYNC"
+TRANSACTION_ATTEMPTS = 5
+
+# Queries by document type, loaded on the first record and kept for the lifetime of the container
+QUERIES_CONFIG_FILE = "queries_config.json"
+# Textract accepts up to 30 queries per page for asynchronous requests
+MAX_QUERIES_PER_DOCUMENT = 30
+MANIFEST_SCHEMA = tm.IDPManifestSchema()
+_queries_config = None
+
+STARTED = "STARTED"
+DUPLICATE = "DUPLICATE"
+GATE_FULL = "GATE_FULL"
+FAILED = "FAILED"
+
+
+def get_object_locations(record):
+    """
+    returns (bucket, key, version) of the objects of a record. S3 notifications
+    delivered through the SQS buffer carry their own list of S3 records.
+    """
+    event_source = record.get("eventSource")
+    if event_source == "aws:s3":
+        s3_object = record['s3']['object']
+        return [(record['s3']['bucket']['name'], unquote_plus(s3_object['key']),
+                 s3_object.get('versionId') or s3_object.get('eTag')
+                 or s3_object.get('sequencer', ""))]
+    elif event_source == "aws:sqs":
+        message = json.loads(record["body"])
+        if "Records" in message:
+            return [
+                location for s3_record in message["Records"]
+                for location in get_object_locations(s3_record)
+            ]
+        if message.get("Event") == "s3:TestEvent":
+            return []
+        return [(message['bucket'], message['key'],
+                 message.get('version_id') or message.get('etag', ""))]
+    raise ValueError('unsupported event_source: {}'.format(event_source))
+
+
+def get_execution_name(s3_bucket, s3_key, object_version):
+    """
+    Deterministic execution name for one version of an S3 object.
+    Starting the same object twice yields the same name, so Step Functions
+    rejects or returns the duplicate instead of running the workflow again.
+    """
+    digest = hashlib.sha256(
+        f"{s3_bucket}/{s3_key}/{object_version}".encode('utf-8')).hexdigest(
+        )[:EXECUTION_NAME_HASH_LENGTH]
+    prefix = re.sub(r'[^A-Za-z0-9-_]', '', os.path.basename(s3_key))
+    prefix = prefix[:MAX_EXECUTION_NAME_LENGTH - EXECUTION_NAME_HASH_LENGTH -
+                    1]
+    return f"{prefix}-{digest}" if prefix else digest
 
 
 def lambda_handler(event, _):
@@ -23,55 +92,310 @@ def lambda_handler(event, _):
     logger.info(f"LOG_LEVEL: {log_level}")
     logger.info(json.dumps(event))
 
+    # EventBridge notification of a finished execution, frees its slot
+    if event.get("detail-type") == "Step Functions Execution Status Change":
+        if IN_FLIGHT_TABLE_NAME:
+            release_execution_slot(event["detail"]["name"])
+        return
+
     state_machine_arn = os.environ.get('STATE_MACHINE_ARN', None)
     if not state_machine_arn:
         raise Exception("no STATE_MACHINE_ARN set")
     logger.info(f"STATE_MACHINE_ARN: {state_machine_arn}")
 
-    s3_bucket = ""
-    s3_key = ""
+    # load the query sets once, before the starts run in parallel
+    get_queries_config()
 
+    # collect the executions to start, duplicates of the same object within the batch are started once
+    executions = {}
+    failures = []
     for record in event['Records']:
-        event_source = record["eventSource"]
-        if event_source == "aws:s3":
-            s3_bucket = record['s3']['bucket']['name']
-            s3_key = unquote_plus(record['s3']['object']['key'])
-        elif event_source == "aws:sqs":
-            message = json.loads(record["body"])
-            s3_bucket = message['bucket']
-            s3_key = message['key']
-        else:
-            logger.error('unsupported event_source: {}'.format(event_source))
-
-        filename = os.path.basename(s3_key) + datetime.utcnow().isoformat()
-
-        filename = re.sub(r'[^A-Za-z0-9-_]', '', filename)
-        filename = filename[:80]
-        if s3_bucket and s3_key:
-            manifest: tm.IDPManifest = tm.IDPManifest()
-            queries_config = [
-                # tm.Query(text="What is the address?", alias="ADDRESS"),
-                # tm.Query(text="What is the name?", alias="NAME")
-                tm.Query(text="What is the company address?", alias="COMPANY_ADDRESS"),
-                tm.Query(text="What is the employee address?", alias="EMPLOYEE_ADDRESS"),
-                tm.Query(text="What is the Pay Date?", alias="PAYSTUB_PERIOD_PAY_DATE"),
-                tm.Query(text="What is the Pay Period Start Date?", alias="PAYSTUB_PERIOD_START_DATE"),
-                tm.Query(text="What is the Pay Period End Date?", alias="PAYSTUB_PERIOD_END_DATE"),
-                tm.Query(text="What is the Employee Name?", alias="PAYSTUB_PERIOD_EMPLOYEE_NAME"),
-                tm.Query(text="What is the company Name?", alias="PAYSTUB_PERIOD_COMPANY_NAME"),
-                tm.Query(text="What is the Current Gross Pay?", alias="PAYSTUB_PERIOD_CURRENT_GROSS_PAY"),
-                tm.Query(text="What is the YTD Gross Pay?", alias="PAYSTUB_PERIOD_YTD_GROSS_PAY")
-            ]
-            manifest.s3_path = f"s3://{s3_bucket}/{s3_key}"
-            manifest.queries_config = queries_config
-            manifest.textract_features = ["QUERIES"]
-            logger.debug(f"manifest: {tm.IDPManifestSchema().dumps(manifest)}")
-
-            response = step_functions_client.start_execution(
-                stateMachineArn=state_machine_arn,
-                name=filename,
-                input=tm.IDPManifestSchema().dumps(manifest))
-            logger.info(response)
-        else:
+        try:
+            locations = get_object_locations(record)
+            for s3_bucket, s3_key, _ in locations:
+                if not s3_bucket or not s3_key:
+                    raise ValueError(
+                        f"no s3_bucket: {s3_bucket} and/or s3_key: {s3_key} given.")
+        except (ValueError, KeyError) as e:
+            logger.error(f"invalid record: {e}")
+            failures.append((record, str(e)))
+            continue
+        for s3_bucket, s3_key, object_version in locations:
+            name = get_execution_name(s3_bucket, s3_key, object_version)
+            executions.setdefault(name, (s3_bucket, s3_key, []))[2].append(record)
+
+    # the counter is read once per batch, executions above the free slots are not tried
+    names = list(executions)
+    free_slots = get_free_slots() if IN_FLIGHT_TABLE_NAME else len(names)
+    gate_full = threading.Event()
+    max_workers = int(os.environ.get('MAX_CONCURRENT_STARTS', '10'))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            name: executor.submit(start_execution, state_machine_arn, name,
+                                  executions[name][0], executions[name][1],
+                                  gate_full)
+            for name in names[:free_slots]
+        }
+
+    deferred = 0
+    for name, (_, _, records) in executions.items():
+        status, error = futures[name].result() if name in futures else (GATE_FULL, None)
+        if status == GATE_FULL:
+            deferred += 1
+            failures += [(record, "no free execution slot") for record in records]
+        elif status == FAILED:
+            failures += [(record, error) for record in records]
+    if deferred:
+        logger.info(f"no free slot for {deferred} executions, their records are received again "
+                    "after the visibility timeout")
+
+    return report_failures(event, failures)
+
+
+def load_queries_config():
+    """
+    reads the query sets by document type from QUERIES_CONFIG_S3_URI, or from
+    the queries_config.json bundled with the function when it isn't set
+    """
+    config_s3_uri = os.environ.get('QUERIES_CONFIG_S3_URI', None)
+    if config_s3_uri:
+        s3_bucket, _, s3_key = config_s3_uri[len("s3://"):].partition("/")
+        body = boto3.client(service_name='s3').get_object(
+            Bucket=s3_bucket, Key=s3_key)['Body'].read()
+        config = json.loads(body)
+    else:
+        with open(os.path.join(os.path.dirname(__file__),
+                               QUERIES_CONFIG_FILE)) as config_file:
+            config = json.load(config_file)
+
+    queries_by_type = {}
+    prefixes = []
+    for document_type, document_config in config["document_types"].items():
+        queries = [
+            tm.Query(text=query["text"], alias=query["alias"])
+            for query in document_config["queries"]
+        ]
+        if len(queries) > MAX_QUERIES_PER_DOCUMENT:
             raise ValueError(
-                f"no s3_bucket: {s3_bucket} and/or s3_key: {s3_key} given.")
+                f"{document_type} has {len(queries)} queries, Textract accepts at most {MAX_QUERIES_PER_DOCUMENT}")
+        queries_by_type[document_type] = queries
+        prefixes += [(prefix, document_type)
+                     for prefix in document_config.get("prefixes", [])]
+    # the longest matching prefix wins
+    prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+    return queries_by_type, prefixes, config.get("default_document_type")
+
+
+def get_queries_config():
+    global _queries_config
+    if _queries_config is None:
+        _queries_config = load_queries_config()
+    return _queries_config
+
+
+def get_document_type(s3_key):
+    _, prefixes, default_document_type = get_queries_config()
+    return next((document_type for prefix, document_type in prefixes
+                 if s3_key.startswith(prefix)), default_document_type)
+
+
+def get_manifest(s3_bucket, s3_key):
+    queries_by_type, _, _ = get_queries_config()
+    document_type = get_document_type(s3_key)
+    manifest: tm.IDPManifest = tm.IDPManifest()
+    manifest.s3_path = f"s3://{s3_bucket}/{s3_key}"
+    queries_config = queries_by_type.get(document_type)
+    if queries_config:
+        manifest.queries_config = queries_config
+        manifest.textract_features = ["QUERIES"]
+    manifest.classification = document_type
+    return manifest
+
+
+def start_execution(state_machine_arn, name, s3_bucket, s3_key, gate_full=None):
+    """
+    Starts one execution if the admission gate has a free slot. gate_full is set
+    by the first start of the batch that finds no free slot, the starts after it
+    don't try again.
+    returns the status (STARTED, DUPLICATE, GATE_FULL or FAILED) and the error message.
+    """
+    acquired = False
+    if IN_FLIGHT_TABLE_NAME:
+        if gate_full is not None and gate_full.is_set():
+            return GATE_FULL, None
+        try:
+            status = acquire_execution_slot(name)
+        except Exception as e:
+            logger.error(f"failed to acquire a slot for execution {name}: {e}")
+            return FAILED, str(e)
+        if status == GATE_FULL:
+            logger.info(f"no free slot for execution {name}")
+            if gate_full is not None:
+                gate_full.set()
+            return GATE_FULL, None
+        # a DUPLICATE slot was taken by an earlier delivery of the object, starting
+        # again is a no-op if that execution is running and recovers a failed start
+        acquired = status == STARTED
+
+    manifest_json = MANIFEST_SCHEMA.dumps(get_manifest(s3_bucket, s3_key))
+    logger.debug(f"manifest: {manifest_json}")
+    try:
+        response = step_functions_client.start_execution(
+            stateMachineArn=state_machine_arn,
+            name=name,
+            input=manifest_json)
+        logger.info(response)
+    except step_functions_client.exceptions.ExecutionAlreadyExists:
+        # a redelivered event for an object that was already started
+        logger.info(f"execution {name} already exists, skipping")
+        if acquired:
+            release_slot_after_failed_start(name)
+        return DUPLICATE, None
+    except Exception as e:
+        logger.error(f"failed to start execution {name}: {e}")
+        if acquired:
+            release_slot_after_failed_start(name)
+        return FAILED, str(e)
+    return STARTED, None
+
+
+def transact_with_retry(transact_items):
+    """
+    runs a DynamoDB transaction, retrying conflicts with concurrent updates of the counter.
+    returns None on success and the cancellation reason codes otherwise.
+    """
+    for attempt in range(TRANSACTION_ATTEMPTS):
+        try:
+            dynamodb_client.transact_write_items(TransactItems=transact_items)
+            return None
+        except dynamodb_client.exceptions.TransactionCanceledException as e:
+            codes = [
+                reason.get("Code", "None")
+                for reason in e.response.get("CancellationReasons", [])
+            ]
+            if "TransactionConflict" not in codes or attempt == TRANSACTION_ATTEMPTS - 1:
+                return codes
+            time.sleep(random.uniform(0, 0.05 * 2**attempt))
+
+
+def get_free_slots():
+    """returns the number of executions that may still start, from one consistent read of the counter"""
+    response = dynamodb_client.get_item(
+        TableName=IN_FLIGHT_TABLE_NAME,
+        Key={"id": {"S": IN_FLIGHT_COUNTER_ID}},
+        ProjectionExpression="in_flight",
+        ConsistentRead=True)
+    in_flight = int(response.get("Item", {}).get("in_flight", {}).get("N", "0"))
+    return max(0, MAX_IN_FLIGHT_EXECUTIONS - in_flight)
+
+
+def acquire_execution_slot(name):
+    """
+    Counts the execution as in flight, unless MAX_IN_FLIGHT_EXECUTIONS are
+    already running (GATE_FULL) or this execution already holds a slot (DUPLICATE).
+    The execution name is recorded with the slot, so a repeated completion event
+    only frees it once.
+    """
+    codes = transact_with_retry([{
+        "Update": {
+            "TableName": IN_FLIGHT_TABLE_NAME,
+            "Key": {"id": {"S": IN_FLIGHT_COUNTER_ID}},
+            "UpdateExpression": "SET in_flight = if_not_exists(in_flight, :zero) + :one",
+            "ConditionExpression": "attribute_not_exists(in_flight) OR in_flight < :ceiling",
+            "ExpressionAttributeValues": {
+                ":zero": {"N": "0"},
+                ":one": {"N": "1"},
+                ":ceiling": {"N": str(MAX_IN_FLIGHT_EXECUTIONS)}
+            }
+        }
+    }, {
+        "Put": {
+            "TableName": IN_FLIGHT_TABLE_NAME,
+            "Item": {"id": {"S": EXECUTION_ID_PREFIX + name}},
+            "ConditionExpression": "attribute_not_exists(id)"
+        }
+    }])
+    if codes is None:
+        return STARTED
+    if codes[1] == "ConditionalCheckFailed":
+        return DUPLICATE
+    if codes[0] == "ConditionalCheckFailed":
+        return GATE_FULL
+    raise Exception(f"in flight counter update cancelled: {codes}")
+
+
+def release_execution_slot(name):
+    """
+    Frees the slot of a finished execution, executions started without a slot are ignored.
+    An execution the textract router sent to the sync task is taken off sync_in_flight as well.
+    """
+    slot = dynamodb_client.get_item(
+        TableName=IN_FLIGHT_TABLE_NAME,
+        Key={"id": {"S": EXECUTION_ID_PREFIX + name}},
+        ConsistentRead=True).get("Item")
+    if slot is None:
+        logger.info(f"execution {name} holds no slot")
+        return
+    routed_sync = slot.get("route", {}).get("S") == SYNC_ROUTE
+    counter_update = "SET in_flight = in_flight - :one"
+    counter_condition = "in_flight > :zero"
+    if routed_sync:
+        counter_update += ", sync_in_flight = sync_in_flight - :one"
+        counter_condition += " AND sync_in_flight > :zero"
+    codes = transact_with_retry([{
+        "Delete": {
+            "TableName": IN_FLIGHT_TABLE_NAME,
+            "Key": {"id": {"S": EXECUTION_ID_PREFIX + name}},
+            "ConditionExpression": "attribute_exists(id)"
+        }
+    }, {
+        "Update": {
+            "TableName": IN_FLIGHT_TABLE_NAME,
+            "Key": {"id": {"S": IN_FLIGHT_COUNTER_ID}},
+            "UpdateExpression": counter_update,
+            "ConditionExpression": counter_condition,
+            "ExpressionAttributeValues": {
+                ":zero": {"N": "0"},
+                ":one": {"N": "1"}
+            }
+        }
+    }])
+    if codes is None:
+        logger.info(f"released the slot of execution {name}")
+    elif codes[0] == "ConditionalCheckFailed":
+        logger.info(f"execution {name} holds no slot")
+    else:
+        raise Exception(f"in flight counter update cancelled: {codes}")
+
+
+def release_slot_after_failed_start(name):
+    try:
+        release_execution_slot(name)
+    except Exception as e:
+        # the slot stays taken by this name, a retried record reuses it
+        logger.error(f"failed to release the slot of execution {name}: {e}")
+
+
+def report_failures(event, failures):
+    """
+    SQS batches report the failed messages, so only those are retried
+    (requires ReportBatchItemFailures on the event source mapping). The records
+    that found the gate full stay in the queue until the visibility timeout
+    expires, which paces the retries while executions are in flight.
+    S3 notifications are invoked asynchronously, raising lets Lambda retry
+    the event, and the records already started are skipped as duplicates.
+    """
+    failed_sqs = [
+        record['messageId'] for record, _ in failures
+        if record.get("eventSource") == "aws:sqs"
+    ]
+    failed_other = [error for record, error in failures
+                    if record.get("eventSource") != "aws:sqs"]
+    if failed_other:
+        raise Exception(
+            f"{len(failed_other)} of {len(event['Records'])} records failed: {failed_other}")
+    return {
+        "batchItemFailures": [{
+            "itemIdentifier": message_id
+        } for message_id in dict.fromkeys(failed_sqs)]
+    }
@@ -0,0 +1,157 @@
+"""
+routes a document to the sync or async Textract task
+"""
+import json
+import logging
+import os
+import time
+
+import boto3
+
+logger = logging.getLogger(__name__)
+
+dynamodb_client = boto3.client(service_name='dynamodb')
+
+SYNC = "SYNC"
+ASYNC = "ASYNC"
+
+# Textract synchronous AnalyzeDocument limits, see https://docs.aws.amazon.com/textract/latest/dg/limits-document.html
+SYNC_MAX_PAGES = 1
+SYNC_MAX_FILE_SIZE = int(os.environ.get('SYNC_MAX_FILE_SIZE', str(10 * 1024 * 1024)))
+SYNC_MAX_QUERIES = int(os.environ.get('SYNC_MAX_QUERIES', '15'))
+# number of running executions each task takes before it is considered saturated
+SYNC_MAX_IN_FLIGHT = int(os.environ.get('SYNC_MAX_IN_FLIGHT', '10'))
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get('ASYNC_MAX_IN_FLIGHT', '100'))
+# the queue depths are shared by the invocations of a warm lambda for this long
+QUEUE_DEPTH_TTL_SECONDS = int(os.environ.get('QUEUE_DEPTH_TTL_SECONDS', '10'))
+
+# The queue depths come from the counter of the admission gate, unknown when
+# IN_FLIGHT_TABLE_NAME is not set. The gate counts the running executions in
+# in_flight, the router counts the ones it sent to the sync task in sync_in_flight.
+IN_FLIGHT_TABLE_NAME = os.environ.get('IN_FLIGHT_TABLE_NAME', None)
+IN_FLIGHT_COUNTER_ID = "in_flight"
+EXECUTION_ID_PREFIX = "execution#"
+
+_queue_depths = None
+
+
+def get_queue_depths():
+    """
+    returns the number of running executions in the (sync, async) tasks, (None, None) if unknown.
+    The executions that are not in the sync task are counted as async, documents with
+    more pages or queries than the sync limits go to the async task without the router.
+    """
+    global _queue_depths
+    if not IN_FLIGHT_TABLE_NAME:
+        return None, None
+    if _queue_depths and time.time() - _queue_depths[0] < QUEUE_DEPTH_TTL_SECONDS:
+        return _queue_depths[1]
+    try:
+        item = dynamodb_client.get_item(
+            TableName=IN_FLIGHT_TABLE_NAME,
+            Key={"id": {"S": IN_FLIGHT_COUNTER_ID}},
+            ProjectionExpression="in_flight, sync_in_flight",
+            ConsistentRead=True).get("Item", {})
+    except Exception as e:
+        # routing still works on the document properties alone
+        logger.warning(f"could not get the queue depths from {IN_FLIGHT_TABLE_NAME}: {e}")
+        return None, None
+    in_flight = int(item.get("in_flight", {}).get("N", "0"))
+    sync_depth = int(item.get("sync_in_flight", {}).get("N", "0"))
+    depths = (sync_depth, max(0, in_flight - sync_depth))
+    _queue_depths = (time.time(), depths)
+    return depths
+
+
+def record_sync_route(execution_name):
+    """
+    Counts the execution in sync_in_flight and marks its slot, so the admission gate
+    takes it off the count again when it releases the slot. Executions started
+    without a slot are not counted.
+    """
+    try:
+        dynamodb_client.transact_write_items(TransactItems=[{
+            "Update": {
+                "TableName": IN_FLIGHT_TABLE_NAME,
+                "Key": {"id": {"S": EXECUTION_ID_PREFIX + execution_name}},
+                "UpdateExpression": "SET route = :sync",
+                "ConditionExpression": "attribute_exists(id) AND attribute_not_exists(route)",
+                "ExpressionAttributeValues": {":sync": {"S": SYNC}}
+            }
+        }, {
+            "Update": {
+                "TableName": IN_FLIGHT_TABLE_NAME,
+                "Key": {"id": {"S": IN_FLIGHT_COUNTER_ID}},
+                "UpdateExpression": "SET sync_in_flight = if_not_exists(sync_in_flight, :zero) + :one",
+                "ExpressionAttributeValues": {
+                    ":zero": {"N": "0"},
+                    ":one": {"N": "1"}
+                }
+            }
+        }])
+    except dynamodb_client.exceptions.TransactionCanceledException as e:
+        # no slot, or a retried Route state that already counted the execution
+        logger.info(f"execution {execution_name} is not counted as sync: {e}")
+    except Exception as e:
+        # the depths are a routing hint, a missed count must not fail the document
+        logger.warning(f"could not count execution {execution_name} as sync: {e}")
+
+
+def route(number_of_pages, file_size, number_of_queries, sync_depth,
+          async_depth):
+    """
+    returns the route and the reason for it.
+    Documents within the sync limits take the sync task, it returns without
+    polling for a job. When the sync task is saturated and the async task has
+    room, the document is spilled over to async instead of waiting.
+    """
+    if number_of_pages is None or number_of_pages > SYNC_MAX_PAGES:
+        return ASYNC, "multi_page"
+    if file_size is not None and file_size > SYNC_MAX_FILE_SIZE:
+        return ASYNC, "file_size"
+    if number_of_queries > SYNC_MAX_QUERIES:
+        return ASYNC, "number_of_queries"
+    if sync_depth is None or sync_depth < SYNC_MAX_IN_FLIGHT:
+        return SYNC, "fast_path"
+    if async_depth is not None and async_depth < ASYNC_MAX_IN_FLIGHT:
+        return ASYNC, "sync_saturated"
+    # both are saturated, take the one with more room left relative to its limit
+    if sync_depth / SYNC_MAX_IN_FLIGHT <= (async_depth or 0) / ASYNC_MAX_IN_FLIGHT:
+        return SYNC, "both_saturated"
+    return ASYNC, "both_saturated"
+
+
+def lambda_handler(event, _):
+    log_level = os.environ.get('LOG_LEVEL', 'INFO')
+    logger.setLevel(log_level)
+    logger.info(f"LOG_LEVEL: {log_level}")
+    logger.info(json.dumps(event))
+
+    document = event['document']
+    number_of_pages = document.get('numberOfPages')
+    file_size = document.get('fileSize')
+    number_of_queries = document.get('numberOfQueries', 0)
+    sync_depth, async_depth = get_queue_depths()
+
+    selected_route, reason = route(number_of_pages, file_size,
+                                   number_of_queries, sync_depth, async_depth)
+    if selected_route == SYNC and IN_FLIGHT_TABLE_NAME:
+        record_sync_route(event['executionName'])
+
+    # the decision and its inputs are kept in the state, so the routing can be
+    # evaluated against the durations of the executions afterwards
+    decision = {
+        "route": selected_route,
+        "reason": reason,
+        "inputs": {
+            "numberOfPages": number_of_pages,
+            "fileSize": file_size,
+            "numberOfQueries": number_of_queries,
+            "syncQueueDepth": sync_depth,
+            "asyncQueueDepth": async_depth,
+            "syncMaxInFlight": SYNC_MAX_IN_FLIGHT,
+            "asyncMaxInFlight": ASYNC_MAX_IN_FLIGHT
+        }
+    }
+    logger.info(json.dumps(decision))
+    return decision
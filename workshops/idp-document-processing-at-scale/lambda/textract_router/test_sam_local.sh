@@ -0,0 +1,2 @@
+sam build
+sam local invoke -e events/event.json -n env.json
@@ -0,0 +1,110 @@
+import json
+
+import aws_cdk as cdk
+from aws_cdk.assertions import Match, Template
+
+from workflows.admission_gate import DEFAULT_MAX_IN_FLIGHT_EXECUTIONS
+from workflows.chunked_queries_workflow import ChunkedQueriesWorkflow
+
+
+def synth(chunk_size=5, max_concurrency=3, context=None):
+    app = cdk.App(context=context)
+    stack = ChunkedQueriesWorkflow(app,
+                                   "ChunkedQueries",
+                                   chunk_size=chunk_size,
+                                   max_concurrency=max_concurrency)
+    return Template.from_stack(stack)
+
+
+def workflow_states(template):
+    """States of the ChunkedQueries state machine, tokens in the definition replaced by placeholders."""
+    definitions = [
+        resource["Properties"]["DefinitionString"]
+        for name, resource in template.find_resources("AWS::StepFunctions::StateMachine").items()
+        if name.startswith("ChunkedQueries")
+    ]
+    assert len(definitions) == 1
+    definition = definitions[0]
+    if isinstance(definition, dict):
+        definition = "".join(part if isinstance(part, str) else "TOKEN"
+                             for part in definition["Fn::Join"][1])
+    return json.loads(definition)["States"]
+
+
+def test_map_state_runs_chunks_with_max_concurrency():
+    states = workflow_states(synth(max_concurrency=3))
+
+    process_chunks = states["ProcessChunks"]
+    assert process_chunks["Type"] == "Map"
+    assert process_chunks["MaxConcurrency"] == 3
+    assert process_chunks["ItemsPath"] == "$.split.chunks"
+    assert states["SplitDocument"]["Next"] == "ProcessChunks"
+
+
+def test_chunk_start_page_reaches_merge_step():
+    states = workflow_states(synth())
+
+    process_chunks = states["ProcessChunks"]
+    assert process_chunks["Parameters"]["startPage.$"] == \
+        "States.ArrayGetItem(States.StringSplit($$.Map.Item.Value, '-'), 0)"
+    chunk_states = process_chunks["Iterator"]["States"]
+    assert chunk_states["ChunkManifest"]["Parameters"]["startPage.$"] == "$.startPage"
+    assert chunk_states["ChunkResult"]["Parameters"] == {
+        "csv.$": "$.csv_output_location.TextractOutputCSVPath",
+        "startPage.$": "$.startPage"
+    }
+
+
+def test_chunk_size_reaches_document_splitter():
+    synth(chunk_size=5).has_resource_properties(
+        "AWS::Lambda::Function", {
+            "Environment": {
+                "Variables": Match.object_like({"MAX_NUMBER_OF_PAGES_PER_DOC": "5"})
+            }
+        })
+
+
+def test_merge_step_follows_map_state():
+    template = synth()
+    states = workflow_states(template)
+
+    assert states["ProcessChunks"]["Next"] == "MergeChunks"
+    merge_chunks = states["MergeChunks"]
+    assert merge_chunks["Type"] == "Task"
+    assert merge_chunks.get("End") is True
+    # payload_response_only invokes the function with the payload as the parameters
+    assert merge_chunks["Parameters"] == {
+        "chunks.$": "$.chunks",
+        "s3Path.$": "$.manifest.s3Path",
+        "executionName.$": "$$.Execution.Name"
+    }
+    assert merge_chunks["ResultPath"] == "$.csv_output_location"
+    template.has_resource_properties(
+        "AWS::Lambda::Function", {
+            "Environment": {
+                "Variables": {
+                    "CSV_S3_OUTPUT_BUCKET": Match.any_value(),
+                    "CSV_S3_OUTPUT_PREFIX": "csv-output"
+                }
+            },
+            "Timeout": 300
+        })
+
+
+def max_in_flight_executions(template):
+    variables = [
+        resource["Properties"]["Environment"]["Variables"]
+        for resource in template.find_resources("AWS::Lambda::Function").values()
+        if "MAX_IN_FLIGHT_EXECUTIONS" in resource["Properties"].get("Environment", {}).get("Variables", {})
+    ]
+    assert len(variables) == 1
+    return int(variables[0]["MAX_IN_FLIGHT_EXECUTIONS"])
+
+
+def test_admission_gate_counts_textract_jobs():
+    assert max_in_flight_executions(synth(max_concurrency=3)) == DEFAULT_MAX_IN_FLIGHT_EXECUTIONS // 3
+    # the context override is a number of Textract jobs as well
+    assert max_in_flight_executions(
+        synth(max_concurrency=4, context={"max_in_flight_executions": "40"})) == 10
+    assert max_in_flight_executions(
+        synth(max_concurrency=50, context={"max_in_flight_executions": "20"})) == 1
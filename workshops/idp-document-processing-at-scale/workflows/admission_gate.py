@@ -0,0 +1,99 @@
+from constructs import Construct
+import aws_cdk.aws_dynamodb as dynamodb
+import aws_cdk.aws_events as events
+import aws_cdk.aws_events_targets as targets
+import aws_cdk.aws_lambda as lambda_
+import aws_cdk.aws_s3 as s3
+import aws_cdk.aws_s3_notifications as s3n
+import aws_cdk.aws_sqs as sqs
+import aws_cdk.aws_stepfunctions as sfn
+from aws_cdk import (CfnOutput, RemovalPolicy, Duration)
+from aws_cdk.aws_lambda_event_sources import SqsEventSource
+
+# Default ceiling of concurrently running executions, keep it at or below the
+# Textract concurrent async job quota of the account and region
+DEFAULT_MAX_IN_FLIGHT_EXECUTIONS = 100
+
+
+class AdmissionGate(Construct):
+    """
+    Buffers uploads in SQS and lets the start lambda only start a new execution
+    while fewer than max_in_flight_executions are running.
+
+    The in-flight count is kept in a DynamoDB table. The start lambda increments
+    it before starting an execution, and the same lambda decrements it when
+    EventBridge reports that the execution reached a terminal status. The counter
+    is read once per batch; the records above the ceiling are reported as batch
+    item failures and received again after the visibility timeout.
+    """
+
+    def __init__(self,
+                 scope: Construct,
+                 construct_id: str,
+                 *,
+                 document_bucket: s3.Bucket,
+                 s3_upload_prefix: str,
+                 state_machine: sfn.StateMachine,
+                 start_function: lambda_.Function,
+                 max_in_flight_executions: int = DEFAULT_MAX_IN_FLIGHT_EXECUTIONS,
+                 max_receive_count: int = 1000) -> None:
+        super().__init__(scope, construct_id)
+
+        self.in_flight_table = dynamodb.Table(
+            self,
+            "InFlightExecutions",
+            partition_key=dynamodb.Attribute(
+                name="id", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY)
+
+        dead_letter_queue = sqs.Queue(
+            self,
+            "BufferDeadLetterQueue",
+            retention_period=Duration.days(14),
+            encryption=sqs.QueueEncryption.SQS_MANAGED)
+        # records that find the gate full are received again, so they count towards
+        # max_receive_count as well. The default, the SQS maximum, keeps a document in
+        # the buffer for about four days of waiting at the visibility timeout, which
+        # is six times the start function timeout of one minute.
+        self.buffer_queue = sqs.Queue(
+            self,
+            "BufferQueue",
+            retention_period=Duration.days(14),
+            visibility_timeout=Duration.minutes(6),
+            encryption=sqs.QueueEncryption.SQS_MANAGED,
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=max_receive_count, queue=dead_letter_queue))
+
+        document_bucket.add_event_notification(
+            s3.EventType.OBJECT_CREATED,
+            s3n.SqsDestination(self.buffer_queue),  #type: ignore
+            s3.NotificationKeyFilter(prefix=s3_upload_prefix))
+
+        start_function.add_event_source(
+            SqsEventSource(self.buffer_queue,
+                           batch_size=10,
+                           max_batching_window=Duration.seconds(5),
+                           report_batch_item_failures=True))
+        start_function.add_environment("IN_FLIGHT_TABLE_NAME",
+                                       self.in_flight_table.table_name)
+        start_function.add_environment("MAX_IN_FLIGHT_EXECUTIONS",
+                                       str(max_in_flight_executions))
+        self.in_flight_table.grant_read_write_data(start_function)
+
+        events.Rule(
+            self,
+            "ExecutionCompleted",
+            event_pattern=events.EventPattern(
+                source=["aws.states"],
+                detail_type=["Step Functions Execution Status Change"],
+                detail={
+                    "stateMachineArn": [state_machine.state_machine_arn],
+                    "status": ["SUCCEEDED", "FAILED", "TIMED_OUT", "ABORTED"]
+                }),
+            targets=[targets.LambdaFunction(start_function)])  #type: ignore
+
+        CfnOutput(self,
+                  "InFlightTableName",
+                  value=self.in_flight_table.table_name)
+        CfnOutput(self, "BufferQueueUrl", value=self.buffer_queue.queue_url)
@@ -0,0 +1,243 @@
+from constructs import Construct
+import os
+import aws_cdk.aws_s3 as s3
+import aws_cdk.aws_stepfunctions as sfn
+import aws_cdk.aws_stepfunctions_tasks as tasks
+import aws_cdk.aws_lambda as lambda_
+import aws_cdk.aws_iam as iam
+from aws_cdk import (CfnOutput, RemovalPolicy, Stack, Duration)
+import amazon_textract_idp_cdk_constructs as tcdk
+from workflows.admission_gate import AdmissionGate, DEFAULT_MAX_IN_FLIGHT_EXECUTIONS
+
+DEFAULT_CHUNK_SIZE = 10
+DEFAULT_MAX_CONCURRENCY = 10
+
+
+class ChunkedQueriesWorkflow(Stack):
+    """
+    Variant of DemoQueries for large documents. The document is split into
+    chunks of chunk_size pages, a Map state runs Textract and the CSV
+    generation on up to max_concurrency chunks at a time, and the CSV outputs
+    of the chunks are merged into one CSV per document.
+    """
+
+    def __init__(self,
+                 scope: Construct,
+                 construct_id: str,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        script_location = os.path.dirname(__file__)
+        s3_upload_prefix = "uploads"
+        s3_output_prefix = "textract-output"
+        s3_csv_output_prefix = "csv-output"
+        s3_temp_output_prefix = "textract-temp-output"
+        s3_split_output_prefix = "document-splitter-output"
+
+        # BEWARE! This is a demo/POC setup, remove the auto_delete_objects=True and
+        document_bucket = s3.Bucket(
+            self,
+            "TextractChunkedQueries",
+            auto_delete_objects=True,
+            removal_policy=RemovalPolicy.DESTROY,
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL)
+        s3_output_bucket = document_bucket.bucket_name
+        workflow_name = "ChunkedQueries"
+
+        decider_task = tcdk.TextractPOCDecider(
+            self,
+            f"{workflow_name}-Decider",
+        )
+
+        document_splitter = tcdk.DocumentSplitter(
+            self,
+            "DocumentSplitter",
+            s3_output_bucket=s3_output_bucket,
+            s3_output_prefix=s3_split_output_prefix,
+            s3_input_bucket=s3_output_bucket,
+            s3_input_prefix=s3_upload_prefix,
+            max_number_of_pages_per_doc=chunk_size)
+
+        # the splitter replaces the state with its output, running it as a
+        # branch keeps the manifest (and its queries) next to the chunk list
+        split_document = sfn.Parallel(
+            self,
+            "SplitDocument",
+            result_path="$.split",
+            result_selector={
+                "bucket.$": "$[0].documentSplitterS3OutputBucket",
+                "prefix.$": "$[0].documentSplitterS3OutputPath",
+                "chunks.$": "$[0].pages"
+            })
+        split_document.branch(document_splitter)
+
+        textract_async_task = tcdk.TextractGenericAsyncSfnTask(
+            self,
+            "TextractAsync",
+            s3_output_bucket=s3_output_bucket,
+            s3_temp_output_prefix=s3_temp_output_prefix,
+            enable_cloud_watch_metrics_and_dashboard=True,
+            integration_pattern=sfn.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+            lambda_log_level="DEBUG",
+            timeout=Duration.hours(24),
+            input=sfn.TaskInput.from_object({
+                "Token":
+                sfn.JsonPath.task_token,
+                "ExecutionId":
+                sfn.JsonPath.string_at('$$.Execution.Id'),
+                "Payload":
+                sfn.JsonPath.entire_payload,
+            }),
+            result_path="$.textract_result")
+
+        textract_async_to_json = tcdk.TextractAsyncToJSON(
+            self,
+            "AsyncToJSON",
+            s3_output_prefix=s3_output_prefix,
+            s3_output_bucket=s3_output_bucket)
+
+        generate_csv = tcdk.TextractGenerateCSV(
+            self,
+            "GenerateCsvTask",
+            csv_s3_output_bucket=s3_output_bucket,
+            csv_s3_output_prefix=s3_csv_output_prefix,
+            lambda_log_level="DEBUG",
+            output_type='CSV',
+            integration_pattern=sfn.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+            input=sfn.TaskInput.from_object({
+                "Token":
+                sfn.JsonPath.task_token,
+                "ExecutionId":
+                sfn.JsonPath.string_at('$$.Execution.Id'),
+                "Payload":
+                sfn.JsonPath.entire_payload,
+            }),
+            result_path="$.csv_output_location")
+
+        # the manifest of a chunk is the document manifest with the s3Path of the chunk
+        chunk_manifest = sfn.Pass(
+            self,
+            "ChunkManifest",
+            parameters={
+                "manifest.$": "States.JsonMerge($.manifest, $.chunk, false)",
+                "mime.$": "$.mime",
+                "startPage.$": "$.startPage"
+            })
+
+        # only the CSV location and the first page of the chunk leave the
+        # iteration, keeps the Map output small
+        chunk_result = sfn.Pass(
+            self,
+            "ChunkResult",
+            parameters={
+                "csv.$": "$.csv_output_location.TextractOutputCSVPath",
+                "startPage.$": "$.startPage"
+            })
+
+        process_chunks = sfn.Map(
+            self,
+            "ProcessChunks",
+            items_path=sfn.JsonPath.string_at("$.split.chunks"),
+            max_concurrency=max_concurrency,
+            parameters={
+                "manifest.$": "$.manifest",
+                "mime.$": "$.mime",
+                "chunk": {
+                    "s3Path.$":
+                    "States.Format('s3://{}/{}/{}', $.split.bucket, $.split.prefix, $$.Map.Item.Value)"
+                },
+                # the splitter names the chunks <start_page>-<end_page>.pdf
+                "startPage.$":
+                "States.ArrayGetItem(States.StringSplit($$.Map.Item.Value, '-'), 0)"
+            },
+            result_path="$.chunks")
+        process_chunks.iterator(
+            sfn.Chain.start(chunk_manifest).next(textract_async_task).next(
+                textract_async_to_json).next(generate_csv).next(chunk_result))
+
+        lambda_merge_function = lambda_.DockerImageFunction(
+            self,
+            "MergeChunksFunction",
+            code=lambda_.DockerImageCode.from_image_asset(
+                os.path.join(script_location, '../lambda/merge_chunks')),
+            memory_size=1024,
+            timeout=Duration.minutes(5),
+            architecture=lambda_.Architecture.X86_64,
+            environment={
+                "CSV_S3_OUTPUT_BUCKET": s3_output_bucket,
+                "CSV_S3_OUTPUT_PREFIX": s3_csv_output_prefix
+            })
+        document_bucket.grant_read_write(lambda_merge_function)
+
+        merge_chunks = tasks.LambdaInvoke(
+            self,
+            'MergeChunks',
+            lambda_function=lambda_merge_function,  #type: ignore
+            payload=sfn.TaskInput.from_object({
+                "chunks":
+                sfn.JsonPath.list_at('$.chunks'),
+                "s3Path":
+                sfn.JsonPath.string_at('$.manifest.s3Path'),
+                "executionName":
+                sfn.JsonPath.string_at('$$.Execution.Name')
+            }),
+            timeout=Duration.seconds(900),
+            payload_response_only=True,
+            result_path="$.csv_output_location")
+
+        workflow_chain = sfn.Chain \
+            .start(decider_task) \
+            .next(split_document) \
+            .next(process_chunks) \
+            .next(merge_chunks)
+
+        # GENERIC
+        state_machine = sfn.StateMachine(self,
+                                         workflow_name,
+                                         definition=workflow_chain)
+
+        lambda_step_start_step_function = lambda_.DockerImageFunction(
+            self,
+            "LambdaStartStepFunctionGeneric",
+            code=lambda_.DockerImageCode.from_image_asset(
+                os.path.join(script_location, '../lambda/start_queries')),
+            memory_size=128,
+            timeout=Duration.minutes(1),
+            architecture=lambda_.Architecture.X86_64,
+            environment={"STATE_MACHINE_ARN": state_machine.state_machine_arn})
+
+        lambda_step_start_step_function.add_to_role_policy(
+            iam.PolicyStatement(actions=['states:StartExecution'],
+                                resources=[state_machine.state_machine_arn]))
+
+        AdmissionGate(
+            self,
+            "AdmissionGate",
+            document_bucket=document_bucket,
+            s3_upload_prefix=s3_upload_prefix,
+            state_machine=state_machine,
+            start_function=lambda_step_start_step_function,
+            # every document runs up to max_concurrency Textract jobs at once, the
+            # ceiling (cdk context or default) counts Textract jobs as in the other workflows
+            max_in_flight_executions=max(
+                1,
+                int(self.node.try_get_context("max_in_flight_executions")
+                    or DEFAULT_MAX_IN_FLIGHT_EXECUTIONS) // max_concurrency))
+
+        # OUTPUT
+        CfnOutput(
+            self,
+            "DocumentUploadLocation",
+            value=f"s3://{document_bucket.bucket_name}/{s3_upload_prefix}/")
+        current_region = Stack.of(self).region
+        CfnOutput(
+            self,
+            'StepFunctionFlowLink',
+            value=
+            f"https://{current_region}.console.aws.amazon.com/states/home?region={current_region}#/statemachines/view/{state_machine.state_machine_arn}"
+        )
+        CfnOutput(self,
+                  'StepFunctionARN',
+                  value=state_machine.state_machine_arn)
@@ -1,13 +1,13 @@
 from constructs import Construct
 import os
 import aws_cdk.aws_s3 as s3
-import aws_cdk.aws_s3_notifications as s3n
 import aws_cdk.aws_stepfunctions as sfn
 import aws_cdk.aws_stepfunctions_tasks as tasks
 import aws_cdk.aws_lambda as lambda_
 import aws_cdk.aws_iam as iam
 from aws_cdk import (CfnOutput, RemovalPolicy, Stack, Duration, Aws)
 import amazon_textract_idp_cdk_constructs as tcdk
+from workflows.admission_gate import AdmissionGate, DEFAULT_MAX_IN_FLIGHT_EXECUTIONS
 
 
 class DemoQueries(Stack):
@@ -80,21 +80,38 @@ class DemoQueries(Stack):
             s3_output_prefix=s3_output_prefix,
             s3_output_bucket=s3_output_bucket)
 
-        lambda_random_function = lambda_.DockerImageFunction(
+        # routes single page documents to the sync or async task from their size,
+        # number of queries and the running executions of both tasks, which it
+        # reads from the in-flight counter of the admission gate
+        lambda_route_function = lambda_.DockerImageFunction(
             self,
-            "RandomIntFunction",
+            "TextractRouteFunction",
             code=lambda_.DockerImageCode.from_image_asset(
-                os.path.join(script_location, '../lambda/random_number')),
+                os.path.join(script_location, '../lambda/textract_router')),
             memory_size=128,
-            architecture=lambda_.Architecture.X86_64)
-
-        task_random_number = tasks.LambdaInvoke(
+            timeout=Duration.seconds(30),
+            architecture=lambda_.Architecture.X86_64,
+            environment={
+                "SYNC_MAX_IN_FLIGHT":
+                str(self.node.try_get_context("sync_max_in_flight") or 10),
+                "ASYNC_MAX_IN_FLIGHT":
+                str(self.node.try_get_context("max_in_flight_executions")
+                    or DEFAULT_MAX_IN_FLIGHT_EXECUTIONS)
+            })
+
+        task_route = tasks.LambdaInvoke(
             self,
-            'Randomize',
-            lambda_function=lambda_random_function,  #type: ignore
+            'Route',
+            lambda_function=lambda_route_function,  #type: ignore
+            payload=sfn.TaskInput.from_object({
+                "document":
+                sfn.JsonPath.entire_payload,
+                "executionName":
+                sfn.JsonPath.string_at('$$.Execution.Name'),
+            }),
             timeout=Duration.seconds(900),
             payload_response_only=True,
-            result_path='$.Random')
+            result_path='$.Route')
 
         generate_csv = tcdk.TextractGenerateCSV(
             self,
@@ -117,8 +134,8 @@ class DemoQueries(Stack):
         async_chain = sfn.Chain.start(textract_async_task).next(
             textract_async_to_json)
 
-        random_choice = sfn.Choice(self, 'Choice') \
-                           .when(sfn.Condition.number_greater_than('$.Random.randomNumber', 50), async_chain)\
+        route_choice = sfn.Choice(self, 'RouteChoice') \
+                           .when(sfn.Condition.string_equals('$.Route.route', 'ASYNC'), async_chain)\
                            .otherwise(textract_sync_task)
 
         number_queries_and_pages_choice = sfn.Choice(self, 'NumberQueriesAndPagesChoice') \
@@ -136,11 +153,11 @@ class DemoQueries(Stack):
                   sfn.Fail(self, 'TooManyQueriesOrPages',
                            error="TooManyQueriesOrPages",
                            cause="Too many queries > 30 or too many Pages > 3000. See https://docs.aws.amazon.com/textract/latest/dg/limits.html")) \
-            .otherwise(task_random_number)
+            .otherwise(task_route)
 
         textract_sync_task.next(generate_csv)
         async_chain.next(generate_csv)
-        task_random_number.next(random_choice)
+        task_route.next(route_choice)
 
         workflow_chain = sfn.Chain \
             .start(decider_task) \
@@ -157,6 +174,7 @@ class DemoQueries(Stack):
             code=lambda_.DockerImageCode.from_image_asset(
                 os.path.join(script_location, '../lambda/start_queries')),
             memory_size=128,
+            timeout=Duration.minutes(1),
             architecture=lambda_.Architecture.X86_64,
             environment={"STATE_MACHINE_ARN": state_machine.state_machine_arn})
 
@@ -164,11 +182,30 @@ class DemoQueries(Stack):
             iam.PolicyStatement(actions=['states:StartExecution'],
                                 resources=[state_machine.state_machine_arn]))
 
-        document_bucket.add_event_notification(
-            s3.EventType.OBJECT_CREATED,
-            s3n.LambdaDestination(
-                lambda_step_start_step_function),  #type: ignore
-            s3.NotificationKeyFilter(prefix=s3_upload_prefix))
+        # the queries per document type come from lambda/start_queries/app/queries_config.json,
+        # or from a config object in the document bucket given as cdk context
+        queries_config_s3_uri = self.node.try_get_context("queries_config_s3_uri")
+        if queries_config_s3_uri:
+            lambda_step_start_step_function.add_environment(
+                "QUERIES_CONFIG_S3_URI", queries_config_s3_uri)
+            document_bucket.grant_read(lambda_step_start_step_function)
+
+        # uploads are buffered in SQS and only started while fewer than
+        # max_in_flight_executions (cdk context) executions are running
+        admission_gate = AdmissionGate(
+            self,
+            "AdmissionGate",
+            document_bucket=document_bucket,
+            s3_upload_prefix=s3_upload_prefix,
+            state_machine=state_machine,
+            start_function=lambda_step_start_step_function,
+            max_in_flight_executions=int(
+                self.node.try_get_context("max_in_flight_executions")
+                or DEFAULT_MAX_IN_FLIGHT_EXECUTIONS))
+        lambda_route_function.add_environment(
+            "IN_FLIGHT_TABLE_NAME", admission_gate.in_flight_table.table_name)
+        admission_gate.in_flight_table.grant_read_write_data(
+            lambda_route_function)
 
         # OUTPUT
         CfnOutput(
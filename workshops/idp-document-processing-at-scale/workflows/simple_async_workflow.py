@@ -1,12 +1,12 @@
 from constructs import Construct
 import os
 import aws_cdk.aws_s3 as s3
-import aws_cdk.aws_s3_notifications as s3n
 import aws_cdk.aws_stepfunctions as sfn
 import aws_cdk.aws_lambda as lambda_
 import aws_cdk.aws_iam as iam
 from aws_cdk import (CfnOutput, RemovalPolicy, Stack, Duration)
 import amazon_textract_idp_cdk_constructs as tcdk
+from workflows.admission_gate import AdmissionGate, DEFAULT_MAX_IN_FLIGHT_EXECUTIONS
 
 
 class SimpleAsyncWorkflow(Stack):
@@ -94,6 +94,7 @@ class SimpleAsyncWorkflow(Stack):
             code=lambda_.DockerImageCode.from_image_asset(
                 os.path.join(script_location, '../lambda/startstepfunction')),
             memory_size=128,
+            timeout=Duration.minutes(1),
             architecture=lambda_.Architecture.X86_64,
             environment={"STATE_MACHINE_ARN": state_machine.state_machine_arn})
 
@@ -101,11 +102,18 @@ class SimpleAsyncWorkflow(Stack):
             iam.PolicyStatement(actions=['states:StartExecution'],
                                 resources=[state_machine.state_machine_arn]))
 
-        document_bucket.add_event_notification(
-            s3.EventType.OBJECT_CREATED,
-            s3n.LambdaDestination(
-                lambda_step_start_step_function),
-            s3.NotificationKeyFilter(prefix=s3_upload_prefix))
+        # uploads are buffered in SQS and only started while fewer than
+        # max_in_flight_executions (cdk context) executions are running
+        AdmissionGate(
+            self,
+            "AdmissionGate",
+            document_bucket=document_bucket,
+            s3_upload_prefix=s3_upload_prefix,
+            state_machine=state_machine,
+            start_function=lambda_step_start_step_function,
+            max_in_flight_executions=int(
+                self.node.try_get_context("max_in_flight_executions")
+                or DEFAULT_MAX_IN_FLIGHT_EXECUTIONS))
 
         # OUTPUT
         CfnOutput(